@@ -17,154 +17,290 @@ def format_channel_name(original_name):
         return f"b{match.group(1)}_ch{match.group(2)}"
     return original_name
 
-def process_file(file_path, trigger_channels=["b4ch9"], signal_channels=["b1ch2"], trigger_threshold=100.0):
+# ADC to mV conversion factors
+ADC_TO_MV_B4 = 2000.0 / 4095.0
+ADC_TO_MV_B1 = 2000.0 / 16383.0
+N_BASELINE_SAMPLES = 100
+
+def as_waveform_matrix(branch_array):
     """
-    Processes a ROOT file to extract integrated sums of waveforms based on a trigger.
-    This version reads waveforms from individual channel branches and supports multiple trigger channels.
+    Converts a branch read with library="np" to a 2-D (n_events, n_samples) array.
+    Variable-size branches come as an object array of per-event arrays; they are stacked.
+    """
+    if branch_array.dtype == object:
+        if len(branch_array) == 0:
+            return np.zeros((0, 0))
+        return np.stack(branch_array)
+    return branch_array
+
+def get_baselines(waveforms):
+    """Same as get_baseline, for a 2-D (n_events, n_samples) array: median of the first 100 samples of each row."""
+    n_baseline_samples = min(N_BASELINE_SAMPLES, waveforms.shape[1])
+    if n_baseline_samples == 0:
+        return np.zeros(len(waveforms))
+    return np.median(waveforms[:, :n_baseline_samples], axis=1)
+
+def get_trigger_mask(batch, trigger_branch_names, trigger_threshold=100.0):
     """
-    integrated_sums = []
-    
-    # ADC to mV conversion factors
-    ADC_TO_MV_B4 = 2000.0 / 4095.0
-    ADC_TO_MV_B1 = 2000.0 / 16383.0
+    True for events where any trigger channel goes below its baseline by more than trigger_threshold mV.
+    """
+    mask = None
+    for ch_name in trigger_branch_names:
+        wfs = as_waveform_matrix(batch[ch_name])
+        depth = (get_baselines(wfs) - np.min(wfs, axis=1)) * ADC_TO_MV_B4
+        fired = depth > trigger_threshold
+        mask = fired if mask is None else (mask | fired)
+    return mask
+
+def get_integrated_sums(batch, signal_branch_names, mask=None):
+    """
+    Baseline subtracted integral (mV * samples) summed over signal channels, one per event.
+    Only events where mask is True are computed.
+    """
+    total = None
+    for ch_name in signal_branch_names:
+        wfs = as_waveform_matrix(batch[ch_name])
+        if mask is not None:
+            wfs = wfs[mask]
+        baselines = get_baselines(wfs)
+        area = np.sum(-(wfs - baselines[:, None]) * ADC_TO_MV_B1, axis=1)
+        total = area if total is None else total + area
+    return total
+
+def find_triggered_entries(file_path, trigger_channels, trigger_threshold=100.0, max_triggered=None, index=None):
+    """
+    Entry numbers of triggered events. Only the trigger branches are read.
+
+    Args:
+        file_path: path to the raw root file
+        trigger_channels: ex. ['b4ch9']
+        trigger_threshold: trigger threshold in mV
+        max_triggered: stop once this many triggered entries are found (default: no limit)
+        index: optional tools.event_index.EventIndex of file_path. If it summarizes all trigger
+            channels, the trigger decision comes from it and the file is not read at all.
+
+    Returns:
+        np.ndarray of int64, sorted entry numbers
+    """
+    trigger_branch_names = ["adc_" + format_channel_name(ch) for ch in trigger_channels]
+    if index is not None and all(b in index.trigger_channels for b in trigger_branch_names):
+        entries = np.flatnonzero(index.get_triggered_mask(trigger_branch_names, trigger_threshold))
+        return entries[:max_triggered] if max_triggered is not None else entries
+
+    found = []
+    n_found = 0
+    entry_start = 0
+    with uproot.open(file_path) as file:
+        tree = file["daq"]
+        for batch in tree.iterate(expressions=trigger_branch_names, library="np"):
+            mask = get_trigger_mask(batch, trigger_branch_names, trigger_threshold)
+            found.append(entry_start + np.flatnonzero(mask))
+            n_found += len(found[-1])
+            entry_start += len(mask)
+            if max_triggered is not None and n_found >= max_triggered:
+                break
+    entries = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+    return entries[:max_triggered] if max_triggered is not None else entries
+
+def iterate_entries(file_path, entries, expressions=None, step_size=100, library="ak"):
+    """
+    Yields batches holding only the given entries, read as contiguous entry ranges.
+    Use it after find_triggered_entries to fetch all channels of the triggered events only.
+    """
+    entries = np.asarray(entries)
+    if len(entries) == 0:
+        return
+    groups = np.split(entries, np.flatnonzero(np.diff(entries) > 1) + 1)
+    with uproot.open(file_path) as file:
+        tree = file["daq"]
+        for g in groups:
+            for batch in tree.iterate(expressions=expressions, step_size=step_size, library=library,
+                                      entry_start=int(g[0]), entry_stop=int(g[-1]) + 1):
+                yield batch
+
+def process_file_multi(file_path, selections, trigger_threshold=100.0, index=None):
+    """
+    Integrated sums for several (trigger channels, signal channels) sets in one pass over the file.
+
+    Args:
+        file_path: path to the raw root file
+        selections: list of dict with keys 'trigger_channels' and 'signal_channels', ex.
+            [{'trigger_channels': ['b4ch9'], 'signal_channels': ['b1ch2']}, ...]
+        trigger_threshold: trigger threshold in mV
+        index: optional tools.event_index.EventIndex of file_path. Trigger sets summarized in it
+            are decided from the index, and their trigger branches are not read.
+
+    Returns:
+        list of np.ndarray, the integrated sums of the triggered events for each selection
+    """
+    sets = []
+    for sel in selections:
+        sets.append((
+            ["adc_" + format_channel_name(ch) for ch in sel['trigger_channels']],
+            ["adc_" + format_channel_name(ch) for ch in sel['signal_channels']],
+        ))
+    def in_index(trigger_branch_names):
+        return index is not None and all(b in index.trigger_channels for b in trigger_branch_names)
+
+    all_branches = []
+    for trigger_branch_names, signal_branch_names in sets:
+        branches = signal_branch_names if in_index(trigger_branch_names) else trigger_branch_names + signal_branch_names
+        for b in branches:
+            if b not in all_branches:
+                all_branches.append(b)
+
+    index_masks = {}
+    for trigger_branch_names, _ in sets:
+        if in_index(trigger_branch_names):
+            index_masks[tuple(trigger_branch_names)] = index.get_triggered_mask(trigger_branch_names, trigger_threshold)
 
+    results = [[] for _ in sets]
     try:
         with uproot.open(file_path) as file:
             tree = file["daq"]
-            
-            trigger_branch_names = ["adc_" + format_channel_name(ch) for ch in trigger_channels]
-            signal_branch_names = ["adc_" + format_channel_name(ch) for ch in signal_channels]
-            
-            all_branches = trigger_branch_names + signal_branch_names
-            
+            entry_start = 0
             for batch in tree.iterate(expressions=all_branches, library="np"):
-                for i in range(len(batch[trigger_branch_names[0]])): # Iterate over events in batch
-                    is_triggered = False
-                    for trigger_ch_name in trigger_branch_names:
-                        trigger_wf = batch[trigger_ch_name][i]
-                        baseline = get_baseline(trigger_wf)
-                        
-                        for sample in trigger_wf:
-                            if (-(sample - baseline) * ADC_TO_MV_B4) > trigger_threshold:
-                                is_triggered = True
-                                break
-                        if is_triggered:
-                            break
-                    
-                    if is_triggered:
-                        event_integrated_sum = 0
-                        for ch_name in signal_branch_names:
-                            signal_wf = batch[ch_name][i]
-                            baseline_signal = get_baseline(signal_wf)
-                            # Sum and convert to mV
-                            event_integrated_sum += np.sum(-(signal_wf - baseline_signal) * ADC_TO_MV_B1)
-                        
-                        integrated_sums.append(event_integrated_sum)
+                n_batch = len(batch[all_branches[0]])
+                # a channel used by several sets is only reduced once per batch
+                mask_cache = {}
+                for k, (trigger_branch_names, signal_branch_names) in enumerate(sets):
+                    key = tuple(trigger_branch_names)
+                    if key not in mask_cache:
+                        if in_index(trigger_branch_names):
+                            mask_cache[key] = index_masks[key][entry_start:entry_start + n_batch]
+                        else:
+                            mask_cache[key] = get_trigger_mask(batch, trigger_branch_names, trigger_threshold)
+                    mask = mask_cache[key]
+                    if not np.any(mask):
+                        continue
+                    results[k].append(get_integrated_sums(batch, signal_branch_names, mask))
+                entry_start += n_batch
 
     except Exception as e:
         print(f"Error processing file: {e}")
         # Reraise or handle as appropriate
         raise
-    
-    return integrated_sums
 
-def get_persistence_data(file_path, trigger_channels=["b4ch9"], signal_channels=["b1ch2"], trigger_threshold=100.0):
+    return [np.concatenate(r) if r else np.zeros(0) for r in results]
+
+def process_file(file_path, trigger_channels=["b4ch9"], signal_channels=["b1ch2"], trigger_threshold=100.0, index=None):
+    """
+    Processes a ROOT file to extract integrated sums of waveforms based on a trigger.
+    This version reads waveforms from individual channel branches and supports multiple trigger channels.
+    Batches are processed as 2-D arrays; see process_file_multi to fill several histograms in one pass.
+    """
+    return process_file_multi(
+        file_path,
+        [{'trigger_channels': trigger_channels, 'signal_channels': signal_channels}],
+        trigger_threshold=trigger_threshold,
+        index=index
+    )[0]
+
+def get_combined_waveforms(batch, signal_branch_names, mask=None):
+    """
+    Baseline subtracted, inverted waveforms in mV summed over signal channels, one row per event.
+    Only events where mask is True are returned.
+    """
+    combined = None
+    for ch_name in signal_branch_names:
+        wfs = as_waveform_matrix(batch[ch_name])
+        if mask is not None:
+            wfs = wfs[mask]
+        wf_mv = -(wfs - get_baselines(wfs)[:, None]) * ADC_TO_MV_B1
+        combined = wf_mv if combined is None else combined + wf_mv
+    return combined
+
+def iterate_triggered_waveforms(file_path, trigger_channels, signal_channels, trigger_threshold=100.0):
+    """
+    Yields, batch by batch, the combined signal waveforms (see get_combined_waveforms) of triggered events.
+    """
+    trigger_branch_names = ["adc_" + format_channel_name(ch) for ch in trigger_channels]
+    signal_branch_names = ["adc_" + format_channel_name(ch) for ch in signal_channels]
+    all_branches = list(dict.fromkeys(trigger_branch_names + signal_branch_names))
+
+    with uproot.open(file_path) as file:
+        tree = file["daq"]
+        for batch in tree.iterate(expressions=all_branches, library="np"):
+            mask = get_trigger_mask(batch, trigger_branch_names, trigger_threshold)
+            if np.any(mask):
+                yield get_combined_waveforms(batch, signal_branch_names, mask)
+
+class PersistenceAccumulator:
+    """
+    Streaming 2-D (amplitude, time) histogram of waveforms. Memory is O(number of bins),
+    whatever the number of waveforms filled.
+    """
+    def __init__(self, n_samples, amp_bins):
+        self.n_samples = n_samples
+        self.amp_bins = np.asarray(amp_bins, dtype=float)
+        self.n_amp = len(self.amp_bins) - 1
+        self.t_bins = np.linspace(0, n_samples * 2, n_samples + 1) # 2ns per sample
+        self.counts = np.zeros(self.n_amp * n_samples, dtype=np.int64)
+        self.n_waveforms = 0
+
+    def fill(self, waveforms):
+        """Adds a 2-D (n_waveforms, n_samples) batch. Values outside amp_bins are dropped."""
+        waveforms = waveforms[:, :self.n_samples]
+        n_t = waveforms.shape[1]
+        # bin k holds amp_bins[k] < value <= amp_bins[k+1]
+        amp_idx = np.searchsorted(self.amp_bins, waveforms) - 1
+        t_idx = np.broadcast_to(np.arange(n_t), waveforms.shape)
+        ok = (amp_idx >= 0) & (amp_idx < self.n_amp)
+        flat = amp_idx[ok] * self.n_samples + t_idx[ok]
+        self.counts += np.bincount(flat, minlength=len(self.counts))
+        self.n_waveforms += len(waveforms)
+
+    @property
+    def H(self):
+        return self.counts.reshape(self.n_amp, self.n_samples).astype(float)
+
+def get_persistence_data(file_path, trigger_channels=["b4ch9"], signal_channels=["b1ch2"], trigger_threshold=100.0,
+                         amp_range=None, n_amp_bins=99, max_events=None):
     """
     Generates a 2D histogram (persistence plot) of waveforms.
+    Triggered signal channels are summed, then binned batch by batch into a fixed (amplitude, time) grid.
+
+    Args:
+        amp_range: (min, max) of the amplitude axis in mV. If None, the file is read twice:
+            the first pass finds the amplitude range (padded by 10%), the second one fills the histogram.
+        n_amp_bins: number of amplitude bins
+        max_events: stop after this many triggered events (default: no limit)
+
     Returns: x_edges, y_edges, histogram_matrix
     """
-    # ADC to mV conversion factors
-    ADC_TO_MV_B4 = 2000.0 / 4095.0
-    ADC_TO_MV_B1 = 2000.0 / 16383.0
+    def triggered_batches():
+        n_events = 0
+        for waveforms in iterate_triggered_waveforms(file_path, trigger_channels, signal_channels, trigger_threshold):
+            if max_events is not None:
+                waveforms = waveforms[:max_events - n_events]
+            n_events += len(waveforms)
+            yield waveforms
+            if max_events is not None and n_events >= max_events:
+                break
 
-    accumulated_waveforms = []
-    
     try:
-        with uproot.open(file_path) as file:
-            tree = file["daq"]
-            
-            trigger_branch_names = ["adc_" + format_channel_name(ch) for ch in trigger_channels]
-            signal_branch_names = ["adc_" + format_channel_name(ch) for ch in signal_channels]
-            
-            all_branches = trigger_branch_names + signal_branch_names
-            
-            # Limit to first 1000 triggered events to avoid OOM on free tier
-            max_events = 1000
-            events_found = 0
+        if amp_range is None:
+            amp_min, amp_max = np.inf, -np.inf
+            for waveforms in triggered_batches():
+                amp_min = min(amp_min, np.min(waveforms))
+                amp_max = max(amp_max, np.max(waveforms))
+            if amp_min > amp_max:
+                return None, None, None
+            # Add some padding
+            pad = 0.1 * (amp_max - amp_min)
+            amp_range = (amp_min - pad, amp_max + pad)
+        amp_bins = np.linspace(amp_range[0], amp_range[1], n_amp_bins + 1)
 
-            for batch in tree.iterate(expressions=all_branches, library="np"):
-                if events_found >= max_events:
-                    break
-
-                for i in range(len(batch[trigger_branch_names[0]])): # Iterate over events in batch
-                    if events_found >= max_events:
-                        break
-
-                    is_triggered = False
-                    for trigger_ch_name in trigger_branch_names:
-                        trigger_wf = batch[trigger_ch_name][i]
-                        baseline = get_baseline(trigger_wf)
-                        
-                        # Check trigger condition
-                        if np.any((-(trigger_wf - baseline) * ADC_TO_MV_B4) > trigger_threshold):
-                            is_triggered = True
-                            break
-                    
-                    if is_triggered:
-                        # For persistence, we usually overlay the signal channel(s)
-                        # Let's take the first signal channel for now, or sum them?
-                        # Usually persistence is per-channel. Let's sum them to match the histogram logic.
-                        
-                        combined_wf = None
-                        for ch_name in signal_branch_names:
-                            signal_wf = batch[ch_name][i]
-                            baseline_signal = get_baseline(signal_wf)
-                            wf_mv = -(signal_wf - baseline_signal) * ADC_TO_MV_B1
-                            
-                            if combined_wf is None:
-                                combined_wf = wf_mv
-                            else:
-                                combined_wf += wf_mv
-                        
-                        if combined_wf is not None:
-                            accumulated_waveforms.append(combined_wf)
-                            events_found += 1
-
-        if not accumulated_waveforms:
-            return None, None, None
+        acc = None
+        for waveforms in triggered_batches():
+            if acc is None:
+                acc = PersistenceAccumulator(waveforms.shape[1], amp_bins)
+            acc.fill(waveforms)
 
-        # Create 2D Histogram
-        waveforms = np.array(accumulated_waveforms)
-        n_samples = waveforms.shape[1]
-        time_axis = np.arange(n_samples) * 2 # 2ns per sample
-        
-        # Flatten for histogram2d: we need pairs of (t, amp)
-        # This can be memory intensive. Let's do it efficiently.
-        
-        # Define bins
-        t_bins = np.linspace(0, n_samples * 2, n_samples + 1)
-        amp_min = np.min(waveforms)
-        amp_max = np.max(waveforms)
-        # Add some padding
-        amp_range = amp_max - amp_min
-        amp_bins = np.linspace(amp_min - 0.1*amp_range, amp_max + 0.1*amp_range, 100)
-        
-        H = np.zeros((len(amp_bins)-1, len(t_bins)-1))
-        
-        # Fill histogram
-        for wf in waveforms:
-            # For each waveform, we have (time_axis, wf) points
-            # np.histogram2d is slow for many points.
-            # Faster: iterate time slices?
-            for t_idx in range(n_samples):
-                amp_val = wf[t_idx]
-                # Find amp bin
-                amp_bin_idx = np.searchsorted(amp_bins, amp_val) - 1
-                if 0 <= amp_bin_idx < len(amp_bins) - 1:
-                    H[amp_bin_idx, t_idx] += 1
-                    
-        return t_bins, amp_bins, H
+        if acc is None:
+            return None, None, None
+        return acc.t_bins, acc.amp_bins, acc.H
 
     except Exception as e:
         print(f"Error processing persistence: {e}")
-        raise
\ No newline at end of file
+        raise
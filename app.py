@@ -20,7 +20,7 @@ os.environ['LIB_DIR'] = os.path.join(DROP_DIR, 'lib')
 # Import analysis modules
 # We need to wrap imports in try-except to handle potential missing dependencies during dev
 try:
-    from analysis import process_file, format_channel_name, get_persistence_data
+    from analysis import process_file, format_channel_name, get_persistence_data, find_triggered_entries, iterate_entries
     from tools.event_display import EventDisplay
     from display_event_gui import display_charge, display_3d_grid
 except ImportError as e:
@@ -46,11 +46,158 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 # For a local single-user tool, global state is acceptable.
 current_state = {
     'file_path': None,
+    'config_path': None,
+    'config_hash': None,
     'event_display': None,
     'min_id': 0,
     'max_id': 0
 }
 
+def _root_buffer(arr):
+    """The array that owns the memory of arr (arr itself if it is not a view)."""
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr
+
+def _estimate_nbytes(obj, depth=0, seen=None):
+    """
+    Rough memory footprint of a reconstructed object: counts numpy arrays in its attributes, dicts and lists.
+    Objects reached twice (ex. pf.wfm) and arrays sharing one buffer are counted once; a view counts the
+    whole buffer it keeps alive.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        root = _root_buffer(obj)
+        if root is obj:
+            return obj.nbytes
+        if id(root) in seen:
+            return 0
+        seen.add(id(root))
+        return root.nbytes
+    if depth > 3:
+        return 0
+    if isinstance(obj, dict):
+        return sum(_estimate_nbytes(v, depth + 1, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_estimate_nbytes(v, depth + 1, seen) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return sum(_estimate_nbytes(v, depth + 1, seen) for v in vars(obj).values())
+    return 0
+
+def _detach_views(obj, depth=0, seen=None):
+    """
+    Replace numpy views into larger buffers (ex. one event of a vectorized batch) by copies, in place, so a
+    cached event does not keep the whole batch alive.
+    """
+    if seen is None:
+        seen = set()
+    if depth > 3 or id(obj) in seen or isinstance(obj, np.ndarray):
+        return
+    seen.add(id(obj))
+    def detach(v):
+        if isinstance(v, np.ndarray) and v.base is not None and _root_buffer(v).nbytes > v.nbytes:
+            return v.copy()
+        _detach_views(v, depth + 1, seen)
+        return v
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            obj[k] = detach(v)
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            obj[i] = detach(v)
+    elif isinstance(obj, tuple):
+        for v in obj:
+            detach(v) # tuple items cannot be replaced; only look inside them
+    elif hasattr(obj, '__dict__'):
+        for k, v in vars(obj).items():
+            setattr(obj, k, detach(v))
+
+def _file_hash(path):
+    """sha1 of the file content, so an edited yaml config does not reuse old results."""
+    import hashlib
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class EventCache:
+    """
+    Bounded LRU cache of reconstructed events, keyed by (file path, config hash, event_id).
+    Each value is a (Waveform, PulseFinder) pair. Least recently used events are evicted
+    once either max_events or max_bytes is exceeded.
+    """
+    def __init__(self, max_events=256, max_bytes=512 * 1024 * 1024):
+        from collections import OrderedDict
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._data.pop(key)[1]
+        _detach_views(value)
+        size = _estimate_nbytes(value)
+        self._data[key] = (value, size)
+        self.nbytes += size
+        while self._data and (len(self._data) > self.max_events or self.nbytes > self.max_bytes):
+            if len(self._data) == 1:
+                break # always keep the newest event, even if it alone exceeds max_bytes
+            _, (_, old_size) = self._data.popitem(last=False)
+            self.nbytes -= old_size
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            'events': len(self._data),
+            'nbytes': self.nbytes,
+            'max_events': self.max_events,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+event_cache = EventCache(
+    max_events=int(os.environ.get('EVENT_CACHE_EVENTS', 256)),
+    max_bytes=int(os.environ.get('EVENT_CACHE_MB', 512)) * 1024 * 1024
+)
+
+def get_reconstructed_event(event_id):
+    """
+    Return (wfm, pf) of event_id for the loaded file, from the cache or by running
+    EventDisplay.grab_events. Return (None, None) if the event is not in the file.
+    """
+    key = (current_state['file_path'], current_state['config_hash'], int(event_id))
+    cached = event_cache.get(key)
+    if cached is not None:
+        return cached
+    ed = current_state['event_display']
+    ed.grab_events(int(event_id))
+    if int(event_id) not in ed.grabbed_event_id:
+        return None, None
+    i = ed.grabbed_event_id.index(int(event_id))
+    value = (ed.wfm_list[i], ed.pf_list[i])
+    event_cache.put(key, value)
+    return value
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -94,6 +241,8 @@ def load_file():
     try:
         current_state['file_path'] = file_path
         config_path = os.path.join(os.environ['YAML_DIR'], 'config_30t.yaml')
+        current_state['config_path'] = config_path
+        current_state['config_hash'] = _file_hash(config_path)
         
         # Initialize EventDisplay
         current_state['event_display'] = EventDisplay(file_path, config_path)
@@ -128,10 +277,12 @@ def generate_histogram():
         trigger_channels = parse_channel_string(trigger_string)
 
         if process_file:
+            ed = current_state['event_display']
             integrated_sums = process_file(
                 current_state['file_path'], 
                 trigger_channels=trigger_channels, 
-                signal_channels=signal_channels
+                signal_channels=signal_channels,
+                index=ed.index if ed else None
             )
             
             fig, ax = plt.subplots(figsize=(8, 6))
@@ -166,15 +317,7 @@ def generate_event_grid():
 
     try:
         trigger_channels = parse_channel_string(trigger_string)
-        
-        # We need to find triggered events using the EventDisplay class or similar logic
-        # Since EventDisplay is already initialized, let's use it if possible, 
-        # but EventDisplay is designed for single event access.
-        # We can iterate through events using the same logic as process_file but returning event IDs.
-        
-        # Let's use a helper to get triggered event IDs and data
-        # We need to read the file again or use the existing EventDisplay
-        
+
         ed = current_state['event_display']
         if not ed:
              return jsonify({'success': False, 'error': 'Event Display not initialized'})
@@ -182,106 +325,53 @@ def generate_event_grid():
         # Limit to first 9 triggered events for grid (3x3)
         max_events = 9
         events_data = []
-        
-        # We need to scan the file for triggers. 
-        # Re-using the logic from analysis.py but inside here for simplicity or we could add a function to analysis.py
-        # Let's add a function to analysis.py to get triggered event IDs? 
-        # Or just iterate using ed.grab_events() which might be slow if we have to check every event.
-        # Faster to use uproot directly like in analysis.py.
-        
-        # Let's use the process_file logic but adapted.
-        # Actually, let's just use uproot here to find IDs, then use ed to get data.
-        
-        import uproot
-        from analysis import format_channel_name, get_baseline
-        
-        ADC_TO_MV_B4 = 2000.0 / 4095.0
         trigger_threshold = 100.0
-        
-        with uproot.open(current_state['file_path']) as file:
-            tree = file["daq"]
-            trigger_branch_names = ["adc_" + format_channel_name(ch) for ch in trigger_channels]
-            
-            # Iterate to find triggered events
-            events_found = 0
-            events_scanned = 0
-            max_scan_events = 10000 # Safety limit to prevent timeout
-            
-            # Fetch event_id and trigger channels
-            # RunDROP needs ALL adc channels plus event info
-            all_branches = tree.keys()
-            branches_to_read = [b for b in all_branches if b.startswith('adc_')] + ['event_id', 'event_ttt_1', 'event_sanity']
-            
-            # Use default library (awkward) to be compatible with RunDROP
-            for batch in tree.iterate(expressions=branches_to_read):
-                if events_found >= max_events or events_scanned >= max_scan_events:
-                    break
-                
-                n_batch_events = len(batch)
-                
-                for i in range(n_batch_events):
-                    if events_found >= max_events or events_scanned >= max_scan_events:
-                        break
-                    
-                    events_scanned += 1
-                    is_triggered = False
-                    for trigger_ch_name in trigger_branch_names:
-                        # Convert to numpy for calculation
-                        trigger_wf = batch[trigger_ch_name][i].to_numpy()
-                        baseline = get_baseline(trigger_wf)
-                        if np.any((-(trigger_wf - baseline) * ADC_TO_MV_B4) > trigger_threshold):
-                            is_triggered = True
-                            break
-                    
-                    if is_triggered:
-                        # Get global event ID
-                        global_evt_id = int(batch['event_id'][i])
-                        
-                        # OPTIMIZATION: Process the event directly from the current batch
-                        # instead of calling grab_events() which re-reads the file from the start.
-                        
-                        # Create a mini-batch with just this event
-                        # We need to slice all arrays in the batch
-                        mini_batch = batch[i:i+1]
-                        
-                        # Use the existing EventDisplay's RunDROP instance to process this mini-batch
-                        ed.run.process_batch(mini_batch, None)
-                        
-                        # The processed waveform is now in ed.run.wfm_list
-                        if ed.run.wfm_list:
-                            wfm = ed.run.wfm_list[0] # There should be only one
-                            
-                            if wfm and wfm.amp_pe:
-                                evt_chg = []
-                                atime = []
-                                # Extract data for 3D plot
-                                for ch in ed.run.ch_names:
-                                    if 'b4' in ch: continue
-                                    charge = 0
-                                    peak_time = 0
-                                    if ch in wfm.amp_pe:
-                                        charge = np.sum(wfm.amp_pe[ch])
-                                        peak_time = np.argmax(wfm.amp_pe[ch]) * 2
-                                    evt_chg.append(charge)
-                                    atime.append(peak_time)
-                                
-                                events_data.append({
-                                    'event_id': global_evt_id,
-                                    'chg': evt_chg,
-                                    'atime': atime
-                                })
-                                events_found += 1
-                            
-                            # Clear the list to free memory/reset for next iteration
-                            ed.run.wfm_list = []
-                            ed.run.pf_list = []
-                        else:
-                            print(f"Debug: Failed to process event {global_evt_id}")
+
+        # Find triggered entries from the trigger branches (or the event index) only,
+        # then read all channels of those entries and reconstruct them with RunDROP.
+        entries = find_triggered_entries(
+            current_state['file_path'], trigger_channels, trigger_threshold,
+            max_triggered=max_events, index=ed.index
+        )
+
+        for batch in iterate_entries(current_state['file_path'], entries,
+                expressions=ed.run.get_daq_branches(), library="np"):
+            ed.run.process_batch(batch, None)
+            for wfm, pf in zip(ed.run.wfm_list, ed.run.pf_list):
+                global_evt_id = int(wfm.event_id)
+                event_cache.put(
+                    (current_state['file_path'], current_state['config_hash'], global_evt_id),
+                    (wfm, pf)
+                )
+                if not wfm.amp_pe:
+                    print(f"Debug: Failed to process event {global_evt_id}")
+                    continue
+                evt_chg = []
+                atime = []
+                # Extract data for 3D plot
+                for ch in ed.run.ch_names:
+                    if 'b4' in ch: continue
+                    charge = 0
+                    peak_time = 0
+                    if ch in wfm.amp_pe:
+                        charge = np.sum(wfm.amp_pe[ch])
+                        peak_time = np.argmax(wfm.amp_pe[ch]) * 2
+                    evt_chg.append(charge)
+                    atime.append(peak_time)
+
+                events_data.append({
+                    'event_id': global_evt_id,
+                    'chg': evt_chg,
+                    'atime': atime
+                })
+            # Clear the list to free memory/reset for next iteration
+            ed.run.wfm_list = []
+            ed.run.pf_list = []
 
         if not events_data:
              return jsonify({
                  'success': False, 
-                 'error': f'No events found matching trigger. Scanned {events_found} triggered events out of {max_events} requested. (Check trigger channels and threshold). Debug: Last checked ID {global_evt_id if "global_evt_id" in locals() else "None"}'
+                 'error': f'No events found matching trigger ({len(entries)} triggered entries). Check trigger channels and threshold.'
              })
 
         # Plotting
@@ -317,8 +407,7 @@ def generate_event_display():
 
     try:
         ed = current_state['event_display']
-        ed.grab_events(event_id)
-        wfm = ed.get_all_waveform(event_id)
+        wfm, pf = get_reconstructed_event(event_id)
 
         if not wfm:
              return jsonify({'success': False, 'error': f'Event {event_id} not found'})
@@ -371,7 +460,7 @@ def generate_waveform():
 
     try:
         ed = current_state['event_display']
-        wfm = ed.get_all_waveform(event_id)
+        wfm, pf = get_reconstructed_event(event_id)
 
         if wfm and wfm.amp_pe:
             channels_with_data = [ch for ch in ed.run.ch_names if ch in wfm.amp_pe]
@@ -407,6 +496,10 @@ def generate_waveform():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(event_cache.stats())
+
 def parse_channel_string(channel_string):
     import re
     channels = []
@@ -0,0 +1,126 @@
+'''
+Time alignment of the channels, for run_drop.py.
+
+Each channel gets a start sample: the daisy chain trigger delay of its board,
+plus an optional per-channel delay read from an alignment file. The aligned
+waveform of a channel is the window [start, start+length) of its samples. All
+shifted channels (daisy chain boards, or with a delay) with the same number of
+raw samples get the same length, so they can be summed sample by sample.
+Channels that are not shifted (ex. V1740 b4) keep their whole waveform.
+
+Daisy chain: the trigger goes from board to board in the order of
+daisy_chain_boards, daisy_chain_delay_ns later on each. With k boards, the
+i-th one (from 0) starts (k-i)*delay later, ex. b1, b2, b3 start 3, 2 and 1
+delays later. Boards not in the chain (ex. V1740 b4) are not shifted.
+
+Alignment file (yaml key channel_delay_file): json or yaml dict of channel ->
+delay in ns. Channels follow the YamlReader::get_ch_names conventions (101,
+'b1_ch1', 'adc_b1_ch1'), or are PMT names (ex. 'bt_p1') of the pmt column of
+the SPE calibration. A channel delayed by d ns starts d//SAMPLE_TO_NS samples
+later.
+'''
+
+import os
+import sys
+import json
+import yaml
+import numpy as np
+
+from yaml_reader import SAMPLE_TO_NS
+
+def _board_of(ch):
+    return int(ch.split('_b')[1].split('_')[0])
+
+def load_channel_delays(fpath, cfg, pmt_to_ch=None):
+    """
+    Read an alignment file.
+
+    Args:
+        fpath (str): json or yaml file. Relative paths are looked up in
+            $YAML_DIR if not found.
+        cfg (YamlReader): for the channel name conventions
+        pmt_to_ch (dict): PMT name -> channel name
+
+    Return:
+        dict of channel name -> delay in ns
+    """
+    if not os.path.exists(fpath) and not os.path.isabs(fpath):
+        fpath = os.path.join(os.environ.get('YAML_DIR', ''), fpath)
+    try:
+        with open(fpath, 'r') as f:
+            if fpath.endswith('.json'):
+                data = json.load(f)
+            else:
+                data = yaml.safe_load(f)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        sys.exit('ERROR: cannot read channel_delay_file %s (%s)' % (fpath, e))
+    if not isinstance(data, dict):
+        sys.exit('ERROR: channel_delay_file %s is not a dict of channel: delay_ns' % fpath)
+    if pmt_to_ch is None:
+        pmt_to_ch = {}
+    delays = {}
+    for key, val in data.items():
+        if key in pmt_to_ch:
+            ch = pmt_to_ch[key]
+        elif isinstance(key, int) or key.isdigit() or 'ch' in key:
+            ch = cfg.get_ch_names([key])[0]
+        else:
+            # PMT not in this detector (ex. the file covers more PMTs)
+            continue
+        delays[ch] = float(val)
+    return delays
+
+class ChannelAlignment():
+    """
+    Start sample of every channel. Built once per run; the windows of a list
+    of channels are cached.
+    """
+    def __init__(self, cfg, pmt_to_ch=None):
+        """
+        Args:
+            cfg (YamlReader): daisy_chain_boards, daisy_chain_delay_ns,
+                channel_delay_file
+            pmt_to_ch (dict): PMT name -> channel name, to read alignment
+                files keyed by PMT
+        """
+        self.chain_step = int(cfg.daisy_chain_delay_ns//int(SAMPLE_TO_NS))
+        n_chain = len(cfg.daisy_chain_boards)
+        self.board_shift = dict((int(b), self.chain_step*(n_chain-i)) for i, b in enumerate(cfg.daisy_chain_boards))
+        # the trigger position moves by the shift of the second board, as before
+        self.trg_shift = self.chain_step*max(n_chain-1, 0)
+        self.ch_delay_ns = {}
+        if cfg.channel_delay_file:
+            self.ch_delay_ns = load_channel_delays(cfg.channel_delay_file, cfg, pmt_to_ch)
+            print('Info: channel delays of %d channels from %s' % (len(self.ch_delay_ns), cfg.channel_delay_file))
+        self._windows = {}
+
+    def get_windows(self, ch_names, n_samp):
+        """
+        Aligned window of each channel.
+
+        Args:
+            ch_names (list): channel names (adc_bX_chY)
+            n_samp (list): number of samples of each channel
+
+        Return:
+            (start, length): int arrays, one per channel
+        """
+        key = (tuple(ch_names), tuple(n_samp))
+        if key not in self._windows:
+            start = np.zeros(len(ch_names), dtype=np.int64)
+            for k, ch in enumerate(ch_names):
+                start[k] = self.board_shift.get(_board_of(ch), 0)
+                if ch in self.ch_delay_ns:
+                    start[k] += int(self.ch_delay_ns[ch]//int(SAMPLE_TO_NS))
+            if np.any(start<0):
+                sys.exit('ERROR: negative channel delay for %s' % [ch for ch, s in zip(ch_names, start) if s<0])
+            n_samp = np.asarray(n_samp, dtype=np.int64)
+            shifted = np.array([_board_of(ch) in self.board_shift or ch in self.ch_delay_ns for ch in ch_names], dtype=bool)
+            length = n_samp.copy()
+            for n in np.unique(n_samp[shifted]):
+                same = shifted & (n_samp==n)
+                length[same] = n - start[same].max()
+            if np.any(length<=0):
+                sys.exit('ERROR: channel delays longer than the waveforms')
+            self._windows[key] = (start, length)
+        return self._windows[key]
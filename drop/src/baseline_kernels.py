@@ -0,0 +1,156 @@
+"""
+Compiled baseline kernels
+
+Flat baseline of waveforms: median, and sigma as half the 15.87-84.13%
+quantile range (MY_QUANTILES), along the last axis of (..., n_samples)
+arrays. The algorithm is selected by `baseline_algo` in the yaml file:
+
+- 'quantile': np.quantile, one partition per waveform (reference).
+- 'histogram': raw ADC values are bounded integers (14-bit V1730, 12-bit
+  V1740), so the order statistics are read from a counting histogram of each
+  waveform, in one numba-compiled pass over all (events x channels) rows.
+  Float waveforms (ex. summed channels) are sorted once instead of going
+  through np.quantile.
+
+Both use the linear interpolation of np.quantile, and give exactly the same
+result. If numba is not installed, 'histogram' falls back to np.quantile for
+integer waveforms.
+
+Both implementations are compared in test/test_baseline_kernels.py.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+BASELINE_ALGOS = ('quantile', 'histogram')
+
+def _jit(f):
+    if HAVE_NUMBA:
+        return njit(cache=True)(f)
+    return f
+
+_rank_cache = {}
+
+def _ranks(n, q):
+    """
+    Order statistics needed by the 'linear' method of np.quantile for n
+    samples: lower rank, upper rank and interpolation weight per quantile,
+    plus the sorted distinct ranks and where lo/hi are in them. Cached, as
+    every waveform of a channel has the same length.
+    """
+    key = (n, tuple(q))
+    if key not in _rank_cache:
+        virtual = (n-1)*np.asarray(q, dtype=np.float64)
+        lo = np.floor(virtual)
+        gamma = virtual - lo
+        hi = lo + 1
+        lo = np.clip(lo, 0, n-1).astype(np.int64)
+        hi = np.clip(hi, 0, n-1).astype(np.int64)
+        ranks, inv = np.unique(np.concatenate([lo, hi]), return_inverse=True)
+        _rank_cache[key] = (lo, hi, gamma, ranks, inv[:len(lo)], inv[len(lo):])
+    return _rank_cache[key]
+
+@_jit
+def _hist_quantiles_nb(val, ranks, i_lo, i_hi, gamma):
+    n_rows, n = val.shape
+    n_q = len(gamma)
+    out = np.empty((n_rows, n_q))
+    at_rank = np.empty(len(ranks), dtype=np.int64)
+    hist = np.zeros(1, dtype=np.int64)
+    for r in range(n_rows):
+        row = val[r]
+        mn = np.int64(row[0])
+        mx = mn
+        for j in range(n):
+            x = np.int64(row[j])
+            if x<mn:
+                mn = x
+            elif x>mx:
+                mx = x
+        if mx-mn+1>len(hist):
+            hist = np.zeros(mx-mn+1, dtype=np.int64)
+        for j in range(n):
+            hist[np.int64(row[j])-mn] += 1
+        # walk up the histogram until the highest rank needed
+        cum = 0
+        t = 0
+        v = 0
+        while t<len(ranks):
+            cum += hist[v]
+            while t<len(ranks) and ranks[t]<cum:
+                at_rank[t] = v + mn
+                t += 1
+            v += 1
+        for j in range(n):
+            hist[np.int64(row[j])-mn] = 0
+        # same arithmetic as np.quantile (numpy _lerp)
+        for i in range(n_q):
+            a = at_rank[i_lo[i]]
+            b = at_rank[i_hi[i]]
+            g = gamma[i]
+            d = np.float64(b - a)
+            if g>=0.5:
+                out[r, i] = b - d*(1-g)
+            else:
+                out[r, i] = a + d*g
+    return out
+
+def _hist_quantiles(val, q):
+    n = val.shape[-1]
+    _, _, gamma, ranks, i_lo, i_hi = _ranks(n, q)
+    rows = np.ascontiguousarray(val).reshape(-1, n)
+    out = _hist_quantiles_nb(rows, ranks, i_lo, i_hi, gamma)
+    return out.reshape(val.shape[:-1] + (len(q),))
+
+def _sorted_quantiles(val, q):
+    n = val.shape[-1]
+    lo, hi, gamma = _ranks(n, q)[:3]
+    s = np.sort(val, axis=-1)
+    a = s[..., lo]
+    b = s[..., hi]
+    # same arithmetic as np.quantile (numpy _lerp)
+    diff = b - a
+    out = np.where(gamma>=0.5, b - diff*(1-gamma), a + diff*gamma)
+    if s.dtype.kind=='f':
+        # np.quantile gives nan if there is any nan (sorted last)
+        nan = np.isnan(s[..., -1:])
+        out = np.where(nan, s[..., -1:], out)
+    return out
+
+def quantiles(val, q, algo='quantile', use_numba=HAVE_NUMBA):
+    """
+    Quantiles q of val along the last axis.
+
+    Args:
+        val: array (..., n_samples), integer (raw ADC) or float
+        q: array of quantiles in [0, 1]
+        algo (str): 'quantile' or 'histogram', see BASELINE_ALGOS
+        use_numba (bool): use the compiled histogram kernel (default: if
+            numba is available)
+
+    Return:
+        array (..., len(q)). For 1D val, same as np.quantile(val, q).
+    """
+    val = np.asarray(val)
+    if algo=='quantile' or val.ndim==0 or val.shape[-1]==0:
+        return np.moveaxis(np.asarray(np.quantile(val, q, axis=-1)), 0, -1)
+    if val.dtype.kind in 'ui':
+        if use_numba and HAVE_NUMBA:
+            return _hist_quantiles(val, q)
+        return np.moveaxis(np.quantile(val, q, axis=-1), 0, -1)
+    return _sorted_quantiles(val, q)
+
+def flat_baseline(val, q, algo='quantile', use_numba=HAVE_NUMBA):
+    """
+    Flat baseline along the last axis: median, and half the distance between
+    the first and last quantiles of q (q = MY_QUANTILES).
+
+    Return:
+        med, std: arrays of shape val.shape[:-1]
+    """
+    qx = quantiles(val, q, algo, use_numba)
+    return qx[..., 1], abs(qx[..., 2]-qx[..., 0])/2
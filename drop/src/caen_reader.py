@@ -1,6 +1,8 @@
 from numpy import nan, zeros, fromfile, dtype, uint32, uint64
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from os import path
+import sys
 import matplotlib.pylab as plt
 
 # =============================================
@@ -31,7 +33,9 @@ class RawDataFile:
         self.DAQ_Software = DAQ_Software
         self.trigger_counter=0
         self.verbosity=1
-        
+        self.headers = None # header table, see scan_headers
+        self._words = None # memory map of the file, 32-bit words
+
     def get_next_n_words(self, n_words=4):
         """
         CAEN binary is 32-bit (4-byte) per word. Get next n words from binary file.
@@ -64,19 +68,22 @@ class RawDataFile:
             print("Number of words read must be 9")
             print(len(words))
             return None
-        samps = []
-        for i in range(len(words)//3):
-            s0 = (words[i*3] & 0x00000FFF)
-            s1 = (words[i*3] & 0x00FFF000) >> (3*4)
-            s2 = ((words[i*3+1] & 0x0000000F) << (2*4)) + ((words[i*3] & 0xFF000000) >> (6*4))
-            s3 = (words[i*3+1] & 0x0000FFF0) >> (1*4)
-            s4 = (words[i*3+1] & 0x0FFF0000) >> (4*4)
-            s5 = ((words[i*3+2] & 0x000000FF) << (1*4)) + ((words[i*3+1] & 0xF0000000) >> (7*4))
-            s6 = (words[i*3+2] & 0x000FFF00) >> (2*4)
-            s7 = (words[i*3+2] & 0xFFF00000) >> (5*4)
-
-            samps += [s0, s1, s2, s3, s4, s5, s6, s7]
-        return samps
+        return unpack_12bit(words).tolist()
+
+    def decode_V1740_group(self, words):
+        """
+        Decode the whole record of one V1740 group (8 channels) at once.
+
+        Args:
+            words: array of 32-bit words, a multiple of 9 (3 samples per channel each)
+
+        Return:
+            np.ndarray of uint16, shape (8, n_samples)
+        """
+        n9 = len(words)//9
+        samps = unpack_12bit(words[:n9*9])
+        # every 9 words: 8 channels x 3 samples, channel by channel
+        return samps.reshape(n9, 8, 3).transpose(1, 0, 2).reshape(8, 3*n9)
 
     def getNextTrigger(self):
         """
@@ -281,21 +288,11 @@ class RawDataFile:
 
                     # If not zero length encoded
                     if not zLE:
-                        # Create a 32-bit datatype with correct endianness
-                        dt = dtype('<u4')
-
-                        # Loop over all samples in group
-                        for j in range(self.recordLen//3):
-                            # Read 9 words
-                            words = self.get_next_n_words(9)
-
-                            # Decode 24 samples
-                            samps = self.decode_V1740_data(words)
-
-                            # Add samples to trace
-                            for k in range(len(samps)//3):
-                                name = "b" + str(boardId) + "_ch" + str(ind*8 + k)
-                                trigger.traces[name] += samps[3*k:3*k+3]
+                        # Read the whole group record, 9 words per 3 samples per channel
+                        words = self.get_next_n_words(9*(self.recordLen//3))
+                        group = self.decode_V1740_group(words)
+                        for chan in range(8):
+                            trigger.traces["b" + str(boardId) + "_ch" + str(ind*8 + chan)] = group[chan]
 
                     else:
                         print("Error! Zero-Length Encoding not implemented for V1740")
@@ -303,12 +300,268 @@ class RawDataFile:
             self.trigger_counter += 1
             return trigger
 
+    def _map_words(self):
+        """
+        Memory-map the whole file as 32-bit words (and 16-bit samples). Nothing
+        is read until the pages are touched.
+        """
+        if self._words is None:
+            order = '>' if self.DAQ_Software=='LabVIEW' else '<'
+            n_bytes = path.getsize(self.fileName)
+            if n_bytes<16:
+                self._words = np.zeros(0, dtype=order+'u4')
+                self._samples = np.zeros(0, dtype=order+'u2')
+            else:
+                self._words = np.memmap(self.fileName, dtype=order+'u4', mode='r', shape=(n_bytes//4,))
+                self._samples = self._words.view(order+'u2') # same mapping
+        return self._words
+
+    def _find_header_candidates(self, chunk_words=1<<24):
+        """
+        Word positions whose top 4 bits are 0xa, i.e. that may start an event.
+        Done in chunks so that a big file does not need a full-size temporary.
+        """
+        w = self._map_words()
+        cand = []
+        for i in range(0, len(w), chunk_words):
+            cand.append(np.flatnonzero((w[i:i+chunk_words] >> 28) == 0xa) + i)
+        return np.concatenate(cand) if cand else np.zeros(0, dtype=np.int64)
+
+    def _walk_headers(self, cand):
+        """
+        Follow the event-size chain from the start of the file, one event at
+        a time. Used when the vectorized scan finds the chain broken (corrupted
+        words, or V1740 data words that look like headers). Same recovery as
+        getNextTrigger: skip to the next word that looks like a header.
+        """
+        w = self._words
+        n_words = len(w)
+        offsets = []
+        pos = 0
+        while pos+4<=n_words:
+            size = int(w[pos]) & 0x0FFFFFFF
+            if (int(w[pos]) >> 28)!=0xa or size<4:
+                if self.verbosity>=1:
+                    print('Info: Read did not pass sanity check at word %d, skipping to the next header' % pos)
+                k = np.searchsorted(cand, pos, side='right')
+                if k>=len(cand):
+                    break
+                pos = int(cand[k])
+                continue
+            offsets.append(pos)
+            pos += size
+        return np.array(offsets, dtype=np.int64)
+
+    def scan_headers(self):
+        """
+        Decode the 4-word header of every event in the file in one pass over a
+        memory map, without reading any trace.
+
+        If every header found points (through its event size) to the next one,
+        the chain is taken as is, fully vectorized. Otherwise the chain is walked
+        event by event, with the same resynchronization as getNextTrigger.
+
+        Return:
+            dict of np.ndarray, one entry per event:
+                offset: position of the header, in 32-bit words
+                size: event size in words, header included
+                board_id, channel_mask (group mask for V1740), n_channels,
+                zle, event_counter, ttt (rollover corrected, as getNextTrigger),
+                record_len (samples per channel, non-ZLE)
+
+        Notes:
+            A truncated last event (file still being written) is dropped.
+        """
+        w = self._map_words()
+        n_words = len(w)
+        cand = self._find_header_candidates()
+        size = (w[cand] & 0x0FFFFFFF).astype(np.int64)
+        nxt = cand + size
+        chained = len(cand)>0 and cand[0]==0 and np.all(size>=4) and np.all(nxt[:-1]==cand[1:])
+        if chained:
+            offsets = cand
+        else:
+            offsets = self._walk_headers(cand)
+            size = (w[offsets] & 0x0FFFFFFF).astype(np.int64)
+        # drop a truncated last event
+        if len(offsets)>0 and offsets[-1]+size[-1]>n_words:
+            if self.verbosity>=1:
+                print('Info: last event is truncated, ignored')
+            offsets = offsets[:-1]
+            size = size[:-1]
+
+        i1 = np.asarray(w[offsets+1], dtype=np.uint64)
+        i2 = np.asarray(w[offsets+2], dtype=np.uint64)
+        i3 = np.asarray(w[offsets+3], dtype=np.uint64)
+        board_id = ((i1 & 0xf8000000) >> 27).astype(np.uint8)
+        is_v1740 = board_id==5
+        # V1730: 16-bit channel mask split over 2 words; V1740: 8-bit group mask
+        channel_mask = np.where(is_v1740, i1 & 0xff, (i1 & 0xff) + ((i2 & 0xff000000) >> 16)).astype(np.uint32)
+        n_channels = np.zeros(len(offsets), dtype=np.int64)
+        for k in range(16):
+            n_channels += (channel_mask >> k) & 1
+        zle = (i1 & 0x01000000)!=0
+        event_counter = (i2 & 0x00ffffff).astype(np.uint32)
+        if self.ETTT_flag:
+            pattern = (i1 >> 8) & 0xffff
+            ttt = pattern * 2**32 + i3
+            rollover = 2**48
+        else:
+            ttt = i3 & 0x7FFFFFFF
+            rollover = 2**31
+        ttt = ttt.astype(np.int64)
+        # a board's time tag rolls over whenever it goes backwards
+        n_rollover = np.zeros(len(offsets), dtype=np.int64)
+        for b in np.unique(board_id):
+            sel = np.flatnonzero(board_id==b)
+            back = np.diff(ttt[sel], prepend=0)<0
+            n_rollover[sel] = np.cumsum(back)
+        payload = 4*size-16 # bytes
+        record_len = np.where(n_channels>0, payload//np.where(is_v1740, 12, 2)//np.maximum(n_channels, 1), 0)
+
+        self.headers = {
+            'offset': offsets,
+            'size': size,
+            'board_id': board_id,
+            'channel_mask': channel_mask,
+            'n_channels': n_channels,
+            'zle': zle,
+            'event_counter': event_counter,
+            'ttt': (ttt + n_rollover*rollover).astype(np.uint64),
+            'record_len': record_len,
+        }
+        return self.headers
+
+    def get_traces(self, board_id):
+        """
+        All traces of one V1730 board without ZLE, as a single array. If the
+        board's events are evenly spaced in the file (the usual case, fixed
+        record length), this is a zero-copy strided view of the memory map.
+
+        Args:
+            board_id: int
+
+        Return:
+            (rows, ch_names, traces): rows of the header table used, list of
+            channel names, and np.ndarray of uint16 shaped (n_event, n_ch, n_samp)
+        """
+        if board_id==5:
+            sys.exit('Error! get_traces does not support V1740 boards')
+        if self.headers is None:
+            self.scan_headers()
+        h = self.headers
+        rows = np.flatnonzero((h['board_id']==board_id) & ~h['zle'])
+        if len(rows)==0:
+            return rows, [], np.zeros((0, 0, 0), dtype=np.uint16)
+        mask = h['channel_mask'][rows]
+        rec = h['record_len'][rows]
+        if np.any(mask!=mask[0]) or np.any(rec!=rec[0]):
+            sys.exit('Error! board %d changes channel mask or record length during the run' % board_id)
+        n_ch = int(h['n_channels'][rows[0]])
+        n_samp = int(rec[0])
+        ch_names = ['b%d_ch%d' % (board_id, k) for k in range(16) if int(mask[0]) & 1 << k]
+        first = 2*(h['offset'][rows]+4) # in 16-bit samples
+        step = np.diff(first)
+        a = self._samples
+        if len(rows)==1 or np.all(step==step[0]):
+            stride = int(step[0]) if len(rows)>1 else n_ch*n_samp
+            traces = as_strided(a[first[0]:], shape=(len(rows), n_ch, n_samp),
+                strides=(stride*a.itemsize, n_samp*a.itemsize, a.itemsize), writeable=False)
+        else:
+            idx = first[:, None] + np.arange(n_ch*n_samp)[None, :]
+            traces = a[idx].reshape(len(rows), n_ch, n_samp)
+        return rows, ch_names, traces
+
+    def iter_triggers(self, start=0):
+        """
+        Iterate over the triggers of the file, using the header table from
+        scan_headers. Drop-in replacement for calling getNextTrigger in a loop:
+        yields the same RawTrigger objects, in the same order.
+
+        V1730 traces without ZLE are zero-copy views of the memory map (read
+        only). V1740 traces are unpacked from the memory map. ZLE triggers
+        are decoded by getNextTrigger.
+
+        Args:
+            start: int. first row of the header table
+        """
+        if self.headers is None:
+            self.scan_headers()
+        h = self.headers
+        a = self._samples
+        for i in range(start, len(h['offset'])):
+            if h['n_channels'][i]<=0:
+                return
+            off = int(h['offset'][i])
+            board_id = int(h['board_id'][i])
+            if h['zle'][i]:
+                self.file.seek(4*off)
+                trigger = self.getNextTrigger()
+                if trigger is None:
+                    return
+                trigger.triggerTimeTag = h['ttt'][i]
+                trigger.triggerTime = trigger.triggerTimeTag * 8e-3
+                yield trigger
+                continue
+
+            trigger = RawTrigger()
+            trigger.filePos = 4*off
+            trigger.boardId = board_id
+            trigger.eventCounter = int(h['event_counter'][i])
+            trigger.triggerTimeTag = h['ttt'][i]
+            trigger.triggerTime = trigger.triggerTimeTag * 8e-3
+            self.recordLen = int(h['record_len'][i])
+            mask = int(h['channel_mask'][i])
+            n_ch = int(h['n_channels'][i])
+            if board_id==5:
+                # V1740: n_ch counts groups of 8 channels
+                n_words = 9*(self.recordLen//3)
+                for j, g in enumerate([k for k in range(8) if mask & 1 << k]):
+                    group = self.decode_V1740_group(self._words[off+4+j*n_words:off+4+(j+1)*n_words])
+                    for chan in range(8):
+                        trigger.traces["b" + str(board_id) + "_ch" + str(g*8 + chan)] = group[chan]
+                self.trigger_counter += 1
+                yield trigger
+                continue
+            first = 2*(off+4)
+            payload = a[first:first+n_ch*self.recordLen].reshape(n_ch, self.recordLen)
+            # the left two bits should be empty
+            if np.any(payload >> 14):
+                trigger.sanity = 1
+            j = 0
+            for k in range(16):
+                if mask & 1 << k:
+                    trigger.traces["b" + str(board_id) + "_ch" + str(k)] = payload[j]
+                    j += 1
+            self.trigger_counter += 1
+            yield trigger
+
     def close(self):
         """
         Close the open data file. Helpful when doing on-the-fly testing
         """
         self.file.close()
-
+        self._words = None
+        self._samples = None
+
+
+def unpack_12bit(words):
+    """
+    Unpack a stream of 12-bit samples packed into 32-bit words (V1740),
+    lowest bits first: every 3 words hold 8 samples.
+
+    Args:
+        words: array of 32-bit words, length a multiple of 3
+
+    Return:
+        np.ndarray of uint16, 8 samples per 3 words
+    """
+    # as a little-endian byte stream, every 3 bytes hold 2 samples
+    b = np.ascontiguousarray(words, dtype='<u4').view(np.uint8).reshape(-1, 3).astype(np.uint16)
+    samps = np.empty((len(b), 2), dtype=np.uint16)
+    samps[:, 0] = b[:, 0] | ((b[:, 1] & 0x0F) << 8)
+    samps[:, 1] = (b[:, 1] >> 4) | (b[:, 2] << 4)
+    return samps.ravel()
 
 # =============================================
 # ============ Raw Trigger Class ==============
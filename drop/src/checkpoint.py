@@ -0,0 +1,166 @@
+'''
+Checkpoints of run_drop.py, so a job that died (OOM, preemption) can resume,
+and a raw file that is still growing can be processed incrementally.
+
+The checkpoint is a json file next to the RQ output (<rq file>.ckpt.json). It
+is rewritten after each batch whose RQs are committed to the output file, with
+the next daq entry to process, the number of RQ events in the file, the last
+event_id done, the batch index, and sha1 of the config and of the calibration.
+See run_drop.py --resume and --incremental.
+
+In --workers mode, each partial output (<rq file>_part<k>.root) gets its own
+checkpoint once it is complete, with the entry range it covers. A resumed job
+reuses the complete parts and only processes the others.
+'''
+
+import os
+import sys
+import json
+import hashlib
+from collections import deque
+from datetime import datetime
+
+CHECKPOINT_SUFFIX = '.ckpt.json'
+# yaml options that do not change the RQ content; may differ when resuming
+CKPT_IGNORED_CFG = ('batch_size', 'debug', 'rq_compression', 'rq_compression_level', 'async_rq_writer')
+# checkpoint fields that must match to reuse the RQs already written
+CKPT_MATCH_KEYS = ('input', 'cfg_sha1', 'calib_sha1')
+
+def config_sha1(cfg_data, start_id, end_id):
+    """
+    sha1 of the yaml config (dict) and of the event_id selection.
+    """
+    data = dict((k, v) for k, v in cfg_data.items() if k not in CKPT_IGNORED_CFG)
+    data['start_id'] = int(start_id)
+    data['end_id'] = int(end_id)
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def calibration_sha1(df):
+    """
+    sha1 of the SPE calibration used (RunDROP.spe_fit_results), after the
+    interpolation if any.
+    """
+    if df is None:
+        return ''
+    return hashlib.sha1(df.to_csv().encode()).hexdigest()
+
+class Checkpoint():
+    """
+    Bookkeeping of the batches done. In async RQ writer mode a batch is only
+    recorded once the writer thread committed its basket to file.
+    """
+    def __init__(self, of_path, run):
+        """
+        Args:
+            of_path (str): path to the RQ output file
+            run (RunDROP): for the input path, config and calibration
+        """
+        self.path = of_path + CHECKPOINT_SUFFIX
+        self.record = {
+            'input': os.path.abspath(run.if_path),
+            'output': os.path.abspath(of_path),
+            'status': 'running',
+            'next_entry': 0,
+            'n_events': 0,
+            'last_event_id': -1,
+            'batch_id': 0,
+            'cfg_sha1': config_sha1(run.cfg.data, run.start_id, run.end_id),
+            'calib_sha1': calibration_sha1(run.spe_fit_results),
+        }
+        self.pending = deque()
+
+    def load(self):
+        """
+        Return the checkpoint saved on disk as dict, None if there is none.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            sys.exit('ERROR: cannot read checkpoint %s (%s). Run without --resume/--incremental.' % (self.path, e))
+
+    def check(self, saved):
+        """
+        Exit if saved (a loaded checkpoint) was made with another input,
+        config or calibration: the RQs already written would not match.
+        """
+        for key in CKPT_MATCH_KEYS:
+            if saved.get(key)!=self.record[key]:
+                sys.exit('ERROR: %s differs from checkpoint %s. Config, calibration or input changed; run without --resume/--incremental.' % (key, self.path))
+        return None
+
+    def matches(self, saved):
+        """
+        True if saved (a loaded checkpoint) was made with the same input,
+        config and calibration.
+        """
+        return all(saved.get(key)==self.record[key] for key in CKPT_MATCH_KEYS)
+
+    def start_from(self, saved):
+        """
+        Continue counting from a loaded checkpoint.
+        """
+        for key in ('next_entry', 'n_events', 'last_event_id', 'batch_id'):
+            self.record[key] = saved[key]
+        self.record['status'] = 'running'
+        self.save()
+        return None
+
+    def batch_done(self, next_entry, n_events, last_event_id, n_events_written):
+        """
+        Call after each batch is handed to the writer.
+
+        Args:
+            next_entry (int): daq entry after this batch
+            n_events (int): RQ events of this batch
+            last_event_id (int): last event_id of this batch
+            n_events_written (int): RQ events committed to the output file so
+                far, including the ones copied when resuming
+        """
+        last = self.pending[-1] if self.pending else (self.record['next_entry'],
+            self.record['n_events'], self.record['last_event_id'], self.record['batch_id'])
+        self.pending.append((int(next_entry), last[1]+int(n_events), int(last_event_id), last[3]+1))
+        self.commit(n_events_written)
+        return None
+
+    def commit(self, n_events_written):
+        """
+        Save the last batch whose events are all in the file.
+        """
+        done = None
+        while self.pending and self.pending[0][1]<=n_events_written:
+            done = self.pending.popleft()
+        if done is not None:
+            self._set(done)
+            self.save()
+        return None
+
+    def finish(self, next_entry):
+        """
+        Output closed: every batch is in the file.
+        """
+        if self.pending:
+            self._set(self.pending[-1])
+            self.pending.clear()
+        self.record['next_entry'] = int(next_entry)
+        self.record['status'] = 'done'
+        self.save()
+        return None
+
+    def _set(self, state):
+        keys = ('next_entry', 'n_events', 'last_event_id', 'batch_id')
+        self.record.update(zip(keys, state))
+        return None
+
+    def save(self):
+        """
+        Write the checkpoint atomically (tmp file + rename).
+        """
+        self.record['updated'] = datetime.now().isoformat(timespec='seconds')
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.record, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        return None
@@ -6,8 +6,10 @@ import os
 import sys
 from waveform import Waveform
 from yaml_reader import YamlReader, SAMPLE_TO_NS, MY_QUANTILES
+from baseline_kernels import quantiles
 sys.path.append(os.environ['LIB_DIR'])
 from utilities import generate_colormap, digitial_butter_highpass_filter
+from pulse_kernels import pulse_features, pulse_boundaries, PULSE_FEATURES, SUM_GROUPS
 # import utilities_numba as util_nb
 
 def linear_interpolation(x_arr, y_arr, y, rising_edge=True):
@@ -203,7 +205,7 @@ class PulseFinder():
                 continue
             a = self.wfm.amp_pe[ch]
             #print ('ch, val, a ',ch,' ',val,'    value:    ',a)
-            qx = np.quantile(a[0:150], MY_QUANTILES)
+            qx = quantiles(a[0:150], MY_QUANTILES, self.cfg.baseline_algo)
             std = abs(qx[2]-qx[0])
             med = qx[1]
             self.base_med_pe[ch] = med
@@ -225,80 +227,42 @@ class PulseFinder():
         This function assume pulse is postively polarized, only run this after
         baseline subtraction, and flip polarity. See Waveform::subtract_flat_baseline.
         """
+        peaks = self.sort_peaks()
+        # walk from each peak to where the sum waveform is back to baseline
+        start, end = pulse_boundaries(self.wfm.amp_pe['sum'], peaks, self.base_med_pe['sum'],
+            self.cfg.pulse_start_search_window, self.cfg.pulse_end_search_window)
+        self.start = start.astype(uint32)
+        self.end = end.astype(uint32)
+
+    def sort_peaks(self):
+        """
+        Peaks of the sum channel, sorted by prominence in decending order. One
+        pulse per peak: set n_pulses and pulse id.
+
+        Return:
+            peak positions in sample
+        """
         if not bool(self.peaks):
             self.scipy_find_peaks()
-
-        # peaks found at sum channel, sorted by prominence
         idx = argsort(self.peak_properties['sum']['prominences'])[::-1] # decending
         peaks = self.peaks['sum'][idx]
-        pprop = {}
-        for k, val in self.peak_properties['sum'].items():
-            pprop[k] = val[idx]
         self.n_pulses = len(peaks)
-        self.id = zeros(self.n_pulses, dtype=uint32)
-        self.start = zeros(self.n_pulses, dtype=uint32)
-        self.end = zeros(self.n_pulses, dtype=uint32)
-        a = self.wfm.amp_pe['sum']
-        #print ('npulse, start, end ',self.n_pulses, ' ', self.start, ' ', self.end)
-        for i in range(self.n_pulses):
-            self.id[i] = i
-            pk = peaks[i]
-            pk_l = pk
-            pk_r = pk
-            for j in range(8):
-                pk_l -= 1
-                left_thresh = self.base_med_pe['sum']
-                if a[pk_l]<=left_thresh or pk_l<=0:
-                    break
-            for j in range(42):
-                pk_r += 1
-                right_thresh = self.base_med_pe['sum']
-                if a[pk_r]<=right_thresh or pk_r>=(len(a)-1):
-                    break
-            self.start[i] = pk_l
-            self.end[i] = pk_r
+        self.id = arange(self.n_pulses, dtype=uint32)
+        return peaks
 
     def calc_pulse_ch_info(self):
         """
         Calculate pulse x channel variables.
         One per pulse per channel, excluding padles and summed channels.
 
+        They are computed together with the pulse-level variables, see
+        calc_pulse_info.
+
         TODO: these variables are calcualted but not yet saved.
         """
-        if self.n_pulses<=0:
-            return None
-
-        # calcualte channel x pulse level variables (one per ch per pulse)
-        # pulse area, height, coincidence
-        for i in self.id:
-            start = self.start[i] # start of pulse i in sample
-            #end = self.end[i] # end of pulse i in sample
-            end = 0
-            area_pe = {} # integral within start to end
-            height_pe = {} # pulse height within start to end
-            start_b5 = 0
-            end_b5 = 0
-            #end_b5 = min(len(self.wfm.amp_pe['adc_b5_ch1']), end)
-            #print(self.wfm.amp_pe.keys())
-            #print('i, start, end, ', i,' ',start,' ',end)
-            for ch in self.wfm.amp_pe.keys():
-                if 'b5' in ch:
-                    area_pe[ch] = a_int[end_b5]-a_int[start_b5]
-                    height_pe[ch] = np.max(a[start_b5:end_b5])
-                else:
-                    a = self.wfm.amp_pe[ch]
-                    #print ('a ', a)
-                    a_int = self.wfm.amp_pe_int[ch]
-                    #print ('a_int ', a_int)
-                    #print(i,' ',ch,' ',len(a_int),' ',end,' ',start)
-                    area_pe[ch] = a_int[end]-a_int[start]
-                    # height_pe[ch] = np.max(a[start:end])
-                    if end == 0:
-                        height_pe[ch] = 0.0
-                    else:
-                        height_pe[ch] = np.max(a[start:end])
-            self.height_ch_pe.append(height_pe)
-            self.area_ch_pe.append(area_pe)
+        if self.n_pulses>0 and not self.height_ch_pe:
+            self.calc_pulse_info()
+        return None
 
     def calc_pulse_info(self):
         """
@@ -311,169 +275,52 @@ class PulseFinder():
         coincidence: number of PMTs whose pulse height pass threshold
         area_max_frac: fraction of light in max PMTs
         ... [add more if you wish]
+
+        All pulses and channels are done in one pass by pulse_kernels
+        (numba-compiled if available). Per channel area and height are
+        saved in area_ch_pe and height_ch_pe.
         """
-        t_ax = self.wfm.time_axis_ns
-        spe_thr = self.cfg.spe_height_threshold
-        # calcualte pulse level variables (one per pulse)
-        for i in self.id:
-            start = self.start[i] # start of pulse i in sample
-            #end = self.end[i] # end of pulse i in sample
-            end = 0
-            start_b5 = 0
-            end_b5 = 0
-            #end_b5 = min(len(self.wfm.amp_pe['adc_b5_ch1']), end) 
-            #print ("test ", len(self.wfm.amp_pe['adc_b5_ch1']), ' ', end)
-            a_sum = self.wfm.amp_pe['sum']
-            a_sum_int = self.wfm.amp_pe_int['sum']
-            a_bot = self.wfm.amp_pe['sum_bot']
-            a_bot_int = self.wfm.amp_pe_int['sum_bot']
-            a_side = self.wfm.amp_pe['sum_side']
-            a_side_int = self.wfm.amp_pe_int['sum_side']
-            
-            a_row1 = self.wfm.amp_pe['sum_row1']
-            a_row2 = self.wfm.amp_pe['sum_row2']
-            a_row3 = self.wfm.amp_pe['sum_row3']
-            a_row4 = self.wfm.amp_pe['sum_row4']
-            a_row5 = self.wfm.amp_pe['sum_row5']
-            a_row6 = self.wfm.amp_pe['sum_row6']
-            a_row7 = self.wfm.amp_pe['sum_row7']
-            
-            a_row1_int = self.wfm.amp_pe_int['sum_row1']
-            a_row2_int = self.wfm.amp_pe_int['sum_row2']
-            a_row3_int = self.wfm.amp_pe_int['sum_row3']
-            a_row4_int = self.wfm.amp_pe_int['sum_row4']
-            a_row5_int = self.wfm.amp_pe_int['sum_row5']
-            a_row6_int = self.wfm.amp_pe_int['sum_row6']
-            a_row7_int = self.wfm.amp_pe_int['sum_row7']
-            
-            a_col1 = self.wfm.amp_pe['sum_col1']
-            a_col2 = self.wfm.amp_pe['sum_col2']
-            a_col3 = self.wfm.amp_pe['sum_col3']
-            a_col4 = self.wfm.amp_pe['sum_col4']
-            a_col5 = self.wfm.amp_pe['sum_col5']
-            a_col6 = self.wfm.amp_pe['sum_col6']
-            a_col7 = self.wfm.amp_pe['sum_col7']
-            a_col8 = self.wfm.amp_pe['sum_col8']
-            
-            a_col1_int = self.wfm.amp_pe_int['sum_col1']
-            a_col2_int = self.wfm.amp_pe_int['sum_col2']
-            a_col3_int = self.wfm.amp_pe_int['sum_col3']
-            a_col4_int = self.wfm.amp_pe_int['sum_col4']
-            a_col5_int = self.wfm.amp_pe_int['sum_col5']
-            a_col6_int = self.wfm.amp_pe_int['sum_col6']
-            a_col7_int = self.wfm.amp_pe_int['sum_col7']
-            a_col8_int = self.wfm.amp_pe_int['sum_col8']
-            
-            a_user = self.wfm.amp_pe['sum_user']
-            a_user_int = self.wfm.amp_pe_int['sum_user']
-            self.area_sum_pe.append(a_sum_int[end]-a_sum_int[start])
-            self.area_bot_pe.append(a_bot_int[end]-a_bot_int[start])
-            self.area_side_pe.append(a_side_int[end]-a_side_int[start])
-            
-            self.area_row1_pe.append(a_row1_int[end]-a_row1_int[start])
-            self.area_row2_pe.append(a_row2_int[end]-a_row2_int[start])
-            self.area_row3_pe.append(a_row3_int[end]-a_row3_int[start])
-            self.area_row4_pe.append(a_row4_int[end]-a_row4_int[start])
-            self.area_row5_pe.append(a_row5_int[end]-a_row5_int[start])
-            self.area_row6_pe.append(a_row6_int[end]-a_row6_int[start])
-            self.area_row7_pe.append(a_row7_int[end]-a_row7_int[start])
-            
-            self.area_col1_pe.append(a_col1_int[end]-a_col1_int[start])
-            self.area_col2_pe.append(a_col2_int[end]-a_col2_int[start])
-            self.area_col3_pe.append(a_col3_int[end]-a_col3_int[start])
-            self.area_col4_pe.append(a_col4_int[end]-a_col4_int[start])
-            self.area_col5_pe.append(a_col5_int[end]-a_col5_int[start])
-            self.area_col6_pe.append(a_col6_int[end]-a_col6_int[start])
-            self.area_col7_pe.append(a_col7_int[end]-a_col7_int[start])
-            self.area_col8_pe.append(a_col8_int[end]-a_col8_int[start])
-            
-            self.area_user_pe.append(a_user_int[end]-a_user_int[start])
-            self.aft10_sum_ns.append(aft(t_ax[start:end], a_sum_int[start:end], 0.1))
-            self.aft10_bot_ns.append(aft(t_ax[start:end], a_bot_int[start:end], 0.1))
-            self.aft10_side_ns.append(aft(t_ax[start:end], a_side_int[start:end], 0.1))
-            
-            self.aft10_row1_ns.append(aft(t_ax[start:end], a_row1_int[start:end], 0.1))
-            self.aft10_row2_ns.append(aft(t_ax[start:end], a_row2_int[start:end], 0.1))
-            self.aft10_row3_ns.append(aft(t_ax[start:end], a_row3_int[start:end], 0.1))
-            self.aft10_row4_ns.append(aft(t_ax[start:end], a_row4_int[start:end], 0.1))
-            self.aft10_row5_ns.append(aft(t_ax[start:end], a_row5_int[start:end], 0.1))
-            self.aft10_row6_ns.append(aft(t_ax[start:end], a_row6_int[start:end], 0.1))
-            self.aft10_row7_ns.append(aft(t_ax[start:end], a_row7_int[start:end], 0.1))
-            
-            self.aft90_sum_ns.append(aft(t_ax[start:end], a_sum_int[start:end], 0.9))
-            self.aft90_bot_ns.append(aft(t_ax[start:end], a_bot_int[start:end], 0.9))
-            self.aft90_side_ns.append(aft(t_ax[start:end], a_side_int[start:end], 0.9))
-            
-            self.aft90_row1_ns.append(aft(t_ax[start:end], a_row1_int[start:end], 0.9))
-            self.aft90_row2_ns.append(aft(t_ax[start:end], a_row2_int[start:end], 0.9))
-            self.aft90_row3_ns.append(aft(t_ax[start:end], a_row3_int[start:end], 0.9))
-            self.aft90_row4_ns.append(aft(t_ax[start:end], a_row4_int[start:end], 0.9))
-            self.aft90_row5_ns.append(aft(t_ax[start:end], a_row5_int[start:end], 0.9))
-            self.aft90_row6_ns.append(aft(t_ax[start:end], a_row6_int[start:end], 0.9))
-            self.aft90_row7_ns.append(aft(t_ax[start:end], a_row7_int[start:end], 0.9))
-            
-            # print('debug: ', t_ax[start:end], a_sum[start:end], a_bot[start:end], a_side[start:end])
-            self.rise_sum_ns.append(rise_time(t_ax[start:end], a_sum[start:end], spe_thr))
-            self.rise_bot_ns.append(rise_time(t_ax[start:end], a_bot[start:end], spe_thr))
-            self.rise_side_ns.append(rise_time(t_ax[start:end], a_side[start:end], spe_thr))
-            self.fall_sum_ns.append(fall_time(t_ax[start:end], a_sum[start:end], spe_thr))
-            self.fall_bot_ns.append(fall_time(t_ax[start:end], a_bot[start:end], spe_thr))
-            self.fall_side_ns.append(fall_time(t_ax[start:end], a_side[start:end], spe_thr))
-            end_fp40 = min(start+20, end);
-            end_fp30 = min(start+15, end);
-            end_fp20 = min(start+10, end);
-            self.fp40_sum.append((a_sum_int[end_fp40]-a_sum_int[start])/self.area_sum_pe[-1])
-            self.fp40_bot.append((a_bot_int[end_fp40]-a_bot_int[start])/self.area_bot_pe[-1])
-            self.fp40_side.append((a_side_int[end_fp40]-a_side_int[start])/self.area_side_pe[-1])
-            self.fp30_sum.append((a_sum_int[end_fp30]-a_sum_int[start])/self.area_sum_pe[-1])
-            self.fp30_bot.append((a_bot_int[end_fp30]-a_bot_int[start])/self.area_bot_pe[-1])
-            self.fp30_side.append((a_side_int[end_fp30]-a_side_int[start])/self.area_side_pe[-1])
-            self.fp20_sum.append((a_sum_int[end_fp20]-a_sum_int[start])/self.area_sum_pe[-1])
-            self.fp20_bot.append((a_bot_int[end_fp20]-a_bot_int[start])/self.area_bot_pe[-1])
-            self.fp20_side.append((a_side_int[end_fp20]-a_side_int[start])/self.area_side_pe[-1])
-            # self.height_sum_pe.append(np.max(a_sum[start:end]))
-            # self.height_bot_pe.append(np.max(a_bot[start:end]))
-            # self.height_side_pe.append(np.max(a_side[start:end]))
-            self.height_sum_pe.append(np.max(a_sum[start:end]))
-            self.height_bot_pe.append(np.max(a_bot[start:end]))
-            self.height_side_pe.append(np.max(a_side[start:end]))
-            self.ptime_ns.append( (argmax(a_sum[start:end])+start)*SAMPLE_TO_NS )
-            sba = (self.area_side_pe[-1]-self.area_bot_pe[-1])/self.area_sum_pe[-1]
-            self.sba.append( sba ) # side-to-bottom asymmetry
-            area_max_frac = 0
-            area_max_ch_id = 0
-            area_bot_max_frac = 0
-            area_bot_max_ch_id = 0
-            coin=0
-            pulse_saturated = False
-            for ch in self.wfm.amp_pe.keys():
-                if ch[0:4]=='adc_':
-                    a = self.wfm.amp_pe[ch]
-                    a_int = self.wfm.amp_pe_int[ch]
-                    if 'b5' in ch:
-                        #print ('len ', len(self.wfm.amp_pe['adc_b5_ch1']))
-                        area = a_int[end_b5-1]-a_int[start_b5]
-                    else:
-                        area = a_int[end]-a_int[start]
-                    if self.height_ch_pe[i][ch]>spe_thr:
-                        coin += 1
-                    if area>area_max_frac:
-                        area_max_frac = area
-                        area_max_ch_id = self.wfm.ch_name_to_id_dict[ch]
-                    if ch in self.cfg.bottom_pmt_channels and area>area_bot_max_frac:
-                        area_bot_max_frac = area
-                        area_bot_max_ch_id = self.wfm.ch_name_to_id_dict[ch]
-                    if self.wfm.ch_saturated[ch]:
-                        val = self.wfm.raw_data[ch][start:end]
-                        if val.min()<=self.cfg.ch_saturated_threshold:
-                            pulse_saturated=True
-            area_max_frac /= self.area_sum_pe[-1]
-            self.area_max_frac.append(area_max_frac)
-            self.area_max_ch_id.append(area_max_ch_id)
-            self.area_bot_max_frac.append(area_bot_max_frac)
-            self.area_bot_max_ch_id.append(area_bot_max_ch_id)
-            self.coincidence.append(coin)
-            self.pulse_saturated.append(pulse_saturated)
+        if self.n_pulses<=0:
+            return None
+        wfm = self.wfm
+        t_ax = wfm.time_axis_ns
+        n_samp = len(t_ax)
+        grp_amp = np.zeros((len(SUM_GROUPS), n_samp))
+        grp_int = np.zeros((len(SUM_GROUPS), n_samp))
+        for g, ch in enumerate(SUM_GROUPS):
+            grp_amp[g] = wfm.amp_pe[ch] # empty groups are 0
+            grp_int[g] = wfm.amp_pe_int[ch]
+
+        chs = [ch for ch in wfm.amp_pe.keys() if ch[0:4]=='adc_']
+        n_ch = len(chs)
+        ch_len = np.array([len(wfm.amp_pe[ch]) for ch in chs], dtype=np.int64)
+        raw_len = np.array([len(wfm.raw_data[ch]) for ch in chs], dtype=np.int64)
+        ch_amp = np.zeros((n_ch, ch_len.max()))
+        ch_int = np.zeros((n_ch, ch_len.max()))
+        raw = np.zeros((n_ch, raw_len.max()))
+        ch_sat = np.zeros(n_ch, dtype=bool)
+        for c, ch in enumerate(chs):
+            ch_amp[c, :ch_len[c]] = wfm.amp_pe[ch]
+            ch_int[c, :ch_len[c]] = wfm.amp_pe_int[ch]
+            ch_sat[c] = wfm.ch_saturated[ch]
+            if ch_sat[c]:
+                raw[c, :raw_len[c]] = wfm.raw_data[ch]
+        ch_id = np.array([wfm.ch_name_to_id_dict[ch] for ch in chs], dtype=np.int64)
+        ch_is_bot = np.array([ch in self.cfg.bottom_pmt_channels for ch in chs], dtype=bool)
+
+        out, ch_area, ch_height = pulse_features(t_ax, grp_amp, grp_int,
+            ch_amp, ch_int, ch_len, ch_id, ch_is_bot, ch_sat, raw, raw_len,
+            self.start.astype(np.int64), self.end.astype(np.int64),
+            float(self.cfg.spe_height_threshold), float(self.cfg.ch_saturated_threshold),
+            float(SAMPLE_TO_NS))
+        for j, name in enumerate(PULSE_FEATURES):
+            setattr(self, name, out[:, j])
+        self.coincidence = self.coincidence.astype(uint32)
+        self.area_max_ch_id = self.area_max_ch_id.astype(uint32)
+        self.area_bot_max_ch_id = self.area_bot_max_ch_id.astype(uint32)
+        self.pulse_saturated = self.pulse_saturated.astype(bool)
+        self.area_ch_pe = [dict(zip(chs, ch_area[i])) for i in range(self.n_pulses)]
+        self.height_ch_pe = [dict(zip(chs, ch_height[i])) for i in range(self.n_pulses)]
         return None
 
 
@@ -512,3 +359,28 @@ class PulseFinder():
         else:
             print("ERROR: ch type is wrong")
             return None
+
+def find_pulses_batch(pf_list, amp_sum):
+    """
+    PulseFinder::find_pulses for all events of a WaveformBatch: peaks are
+    found event by event, and the pulse boundaries of the whole batch in one
+    pulse_boundaries call.
+
+    Args:
+        pf_list (list): PulseFinder of each event of the batch
+        amp_sum: (n_events, n_samples) sum channel of the batch, in PE
+    """
+    if len(pf_list)==0:
+        return None
+    cfg = pf_list[0].cfg
+    peaks = [pf.sort_peaks() for pf in pf_list]
+    n_peaks = [len(p) for p in peaks]
+    ev = np.repeat(np.arange(len(pf_list)), n_peaks)
+    thresh = [pf.base_med_pe['sum'] for pf in pf_list]
+    start, end = pulse_boundaries(amp_sum, np.concatenate(peaks), thresh,
+        cfg.pulse_start_search_window, cfg.pulse_end_search_window, ev=ev)
+    bounds = np.cumsum(n_peaks)[:-1]
+    for pf, s, e in zip(pf_list, np.split(start, bounds), np.split(end, bounds)):
+        pf.start = s.astype(uint32)
+        pf.end = e.astype(uint32)
+    return None
@@ -0,0 +1,351 @@
+"""
+Compiled pulse kernels
+
+Pulse boundaries of all peaks of an event (or batch) are found in one call
+(pulse_boundaries). All pulse-level RQs of one event (every pulse, every
+summed channel and every PMT channel) are computed in a single numba-compiled
+pass (pulse_features). If numba is not installed, pulse boundaries fall back
+to numpy, and pulse features to the python reference implementation, which
+uses aft, rise_time and fall_time from pulse_finder.py.
+
+Both implementations are compared in test/test_pulse_kernels.py.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+# summed channels, in the row order of the grp_amp/grp_int arrays
+SUM_GROUPS = ['sum', 'sum_bot', 'sum_side',
+    'sum_row1', 'sum_row2', 'sum_row3', 'sum_row4', 'sum_row5', 'sum_row6', 'sum_row7',
+    'sum_col1', 'sum_col2', 'sum_col3', 'sum_col4', 'sum_col5', 'sum_col6', 'sum_col7', 'sum_col8',
+    'sum_user']
+_GRP = [g[4:] if g!='sum' else 'sum' for g in SUM_GROUPS] # sum, bot, side, row1, ...
+N_AFT_GROUPS = 10 # aft10/aft90 for sum, bot, side, row1-7
+N_SHAPE_GROUPS = 3 # rise/fall/fp/height for sum, bot, side
+
+# PulseFinder attributes, in the column order of the feature matrix
+PULSE_FEATURES = (
+    ['area_%s_pe' % g for g in _GRP] +
+    ['aft10_%s_ns' % g for g in _GRP[:N_AFT_GROUPS]] +
+    ['aft90_%s_ns' % g for g in _GRP[:N_AFT_GROUPS]] +
+    ['rise_%s_ns' % g for g in _GRP[:N_SHAPE_GROUPS]] +
+    ['fall_%s_ns' % g for g in _GRP[:N_SHAPE_GROUPS]] +
+    ['fp40_%s' % g for g in _GRP[:N_SHAPE_GROUPS]] +
+    ['fp30_%s' % g for g in _GRP[:N_SHAPE_GROUPS]] +
+    ['fp20_%s' % g for g in _GRP[:N_SHAPE_GROUPS]] +
+    ['height_%s_pe' % g for g in _GRP[:N_SHAPE_GROUPS]] +
+    ['ptime_ns', 'sba', 'coincidence', 'area_max_frac', 'area_max_ch_id',
+     'area_bot_max_frac', 'area_bot_max_ch_id', 'pulse_saturated']
+)
+N_GRP = len(SUM_GROUPS)
+_I_AFT10 = N_GRP
+_I_AFT90 = _I_AFT10 + N_AFT_GROUPS
+_I_RISE = _I_AFT90 + N_AFT_GROUPS
+_I_FALL = _I_RISE + N_SHAPE_GROUPS
+_I_FP40 = _I_FALL + N_SHAPE_GROUPS
+_I_FP30 = _I_FP40 + N_SHAPE_GROUPS
+_I_FP20 = _I_FP30 + N_SHAPE_GROUPS
+_I_HEIGHT = _I_FP20 + N_SHAPE_GROUPS
+_I_PTIME = _I_HEIGHT + N_SHAPE_GROUPS
+N_FEATURES = len(PULSE_FEATURES)
+
+def _jit(f):
+    if HAVE_NUMBA:
+        # error_model='numpy': x/0 gives inf/nan as in the python version
+        return njit(cache=True, error_model='numpy')(f)
+    return f
+
+@_jit
+def _aft_nb(t, a_int, s, e, y):
+    """ Same as pulse_finder.aft(t[s:e], a_int[s:e], y) """
+    if e<=s:
+        return 0.
+    a0 = a_int[s]
+    a1 = a_int[e-1]
+    if a1==a0:
+        return t[s]
+    for i in range(s, e-1):
+        y_l = (a_int[i]-a0)/(a1-a0)
+        y_h = (a_int[i+1]-a0)/(a1-a0)
+        if y_l<=y and y<y_h:
+            return t[i]+(t[i+1]-t[i])/(y_h-y_l)*(y-y_l)
+    return t[s]
+
+@_jit
+def _edge_time_nb(t, a, s, e, spe_thresh, rising):
+    """ Same as pulse_finder.rise_time (rising=True) or fall_time on t[s:e], a[s:e] """
+    if e<=s:
+        return -1.
+    imax = s
+    for i in range(s, e):
+        if a[i]>a[imax]:
+            imax = i
+    ymax = a[imax]
+    if ymax<spe_thresh:
+        return -1.
+    if imax==s:
+        return 0.
+    y10 = ymax*0.1
+    y90 = ymax*0.9
+    i10 = -1
+    i90 = -1
+    for i in range(s, e-1):
+        y_l = a[i]; y_h = a[i+1]
+        if rising:
+            if i10<0 and y_l<=y10 and y10<y_h:
+                i10 = i
+            if i90<0 and y_l<=y90 and y90<y_h:
+                i90 = i
+        else:
+            if i10<0 and y_l>=y10 and y10>y_h:
+                i10 = i
+            if i90<0 and y_l>=y90 and y90>y_h:
+                i90 = i
+    if i10<0 or i90<0:
+        return -2.
+    t10 = t[i10]+(t[i10+1]-t[i10])/(a[i10+1]-a[i10])*(y10-a[i10])
+    t90 = t[i90]+(t[i90+1]-t[i90])/(a[i90+1]-a[i90])*(y90-a[i90])
+    if rising:
+        return t90-t10
+    return t10-t90
+
+@_jit
+def _pulse_features_nb(t_ax, grp_amp, grp_int, ch_amp, ch_int, ch_len, ch_id,
+        ch_is_bot, ch_sat, raw, raw_len, start, end, spe_thr, sat_thr, sample_to_ns):
+    n_pulses = len(start)
+    n_ch = len(ch_len)
+    out = np.zeros((n_pulses, N_FEATURES))
+    out_ch_area = np.zeros((n_pulses, n_ch))
+    out_ch_height = np.zeros((n_pulses, n_ch))
+    for p in range(n_pulses):
+        s = start[p]
+        e = end[p]
+        for g in range(N_GRP):
+            out[p, g] = grp_int[g, e]-grp_int[g, s]
+        for g in range(N_AFT_GROUPS):
+            out[p, _I_AFT10+g] = _aft_nb(t_ax, grp_int[g], s, e, 0.1)
+            out[p, _I_AFT90+g] = _aft_nb(t_ax, grp_int[g], s, e, 0.9)
+        e40 = min(s+20, e)
+        e30 = min(s+15, e)
+        e20 = min(s+10, e)
+        for g in range(N_SHAPE_GROUPS):
+            out[p, _I_RISE+g] = _edge_time_nb(t_ax, grp_amp[g], s, e, spe_thr, True)
+            out[p, _I_FALL+g] = _edge_time_nb(t_ax, grp_amp[g], s, e, spe_thr, False)
+            area = out[p, g]
+            out[p, _I_FP40+g] = (grp_int[g, e40]-grp_int[g, s])/area
+            out[p, _I_FP30+g] = (grp_int[g, e30]-grp_int[g, s])/area
+            out[p, _I_FP20+g] = (grp_int[g, e20]-grp_int[g, s])/area
+            h = grp_amp[g, s]
+            for i in range(s+1, e):
+                if grp_amp[g, i]>h:
+                    h = grp_amp[g, i]
+            out[p, _I_HEIGHT+g] = h
+        imax = s
+        for i in range(s+1, e):
+            if grp_amp[0, i]>grp_amp[0, imax]:
+                imax = i
+        out[p, _I_PTIME] = imax*sample_to_ns
+        area_sum = out[p, 0]
+        out[p, _I_PTIME+1] = (out[p, 2]-out[p, 1])/area_sum
+
+        # channel loop: coincidence, max fraction, saturation
+        coin = 0
+        area_max = 0.
+        area_max_ch_id = 0
+        area_bot_max = 0.
+        area_bot_max_ch_id = 0
+        saturated = False
+        for c in range(n_ch):
+            cs = min(s, ch_len[c]-1)
+            ce = min(e, ch_len[c]-1)
+            area = ch_int[c, ce]-ch_int[c, cs]
+            h = 0.
+            if ce>cs:
+                h = ch_amp[c, cs]
+                for i in range(cs+1, ce):
+                    if ch_amp[c, i]>h:
+                        h = ch_amp[c, i]
+            out_ch_area[p, c] = area
+            out_ch_height[p, c] = h
+            if h>spe_thr:
+                coin += 1
+            if area>area_max:
+                area_max = area
+                area_max_ch_id = ch_id[c]
+            if ch_is_bot[c] and area>area_bot_max:
+                area_bot_max = area
+                area_bot_max_ch_id = ch_id[c]
+            if ch_sat[c]:
+                re = min(e, raw_len[c])
+                for i in range(s, re):
+                    if raw[c, i]<=sat_thr:
+                        saturated = True
+                        break
+        out[p, _I_PTIME+2] = coin
+        out[p, _I_PTIME+3] = area_max/area_sum
+        out[p, _I_PTIME+4] = area_max_ch_id
+        out[p, _I_PTIME+5] = area_bot_max
+        out[p, _I_PTIME+6] = area_bot_max_ch_id
+        out[p, _I_PTIME+7] = saturated
+    return out, out_ch_area, out_ch_height
+
+def _pulse_features_py(t_ax, grp_amp, grp_int, ch_amp, ch_int, ch_len, ch_id,
+        ch_is_bot, ch_sat, raw, raw_len, start, end, spe_thr, sat_thr, sample_to_ns):
+    """
+    Python reference of _pulse_features_nb, one pulse and one channel at a
+    time with the original pulse_finder helpers.
+    """
+    from pulse_finder import aft, rise_time, fall_time
+    n_pulses = len(start)
+    n_ch = len(ch_len)
+    out = np.zeros((n_pulses, N_FEATURES))
+    out_ch_area = np.zeros((n_pulses, n_ch))
+    out_ch_height = np.zeros((n_pulses, n_ch))
+    for p in range(n_pulses):
+        s = int(start[p])
+        e = int(end[p])
+        t = t_ax[s:e]
+        for g in range(N_GRP):
+            out[p, g] = grp_int[g][e]-grp_int[g][s]
+        for g in range(N_AFT_GROUPS):
+            out[p, _I_AFT10+g] = aft(t, grp_int[g][s:e], 0.1)
+            out[p, _I_AFT90+g] = aft(t, grp_int[g][s:e], 0.9)
+        for g in range(N_SHAPE_GROUPS):
+            out[p, _I_RISE+g] = rise_time(t, grp_amp[g][s:e], spe_thr)
+            out[p, _I_FALL+g] = fall_time(t, grp_amp[g][s:e], spe_thr)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[p, _I_FP40+g] = (grp_int[g][min(s+20, e)]-grp_int[g][s])/out[p, g]
+                out[p, _I_FP30+g] = (grp_int[g][min(s+15, e)]-grp_int[g][s])/out[p, g]
+                out[p, _I_FP20+g] = (grp_int[g][min(s+10, e)]-grp_int[g][s])/out[p, g]
+            out[p, _I_HEIGHT+g] = np.max(grp_amp[g][s:e])
+        out[p, _I_PTIME] = (np.argmax(grp_amp[0][s:e])+s)*sample_to_ns
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[p, _I_PTIME+1] = (out[p, 2]-out[p, 1])/out[p, 0]
+
+        coin = 0
+        area_max = 0
+        area_max_ch_id = 0
+        area_bot_max = 0
+        area_bot_max_ch_id = 0
+        saturated = False
+        for c in range(n_ch):
+            cs = min(s, ch_len[c]-1)
+            ce = min(e, ch_len[c]-1)
+            area = ch_int[c][ce]-ch_int[c][cs]
+            h = np.max(ch_amp[c][cs:ce]) if ce>cs else 0.
+            out_ch_area[p, c] = area
+            out_ch_height[p, c] = h
+            if h>spe_thr:
+                coin += 1
+            if area>area_max:
+                area_max = area
+                area_max_ch_id = ch_id[c]
+            if ch_is_bot[c] and area>area_bot_max:
+                area_bot_max = area
+                area_bot_max_ch_id = ch_id[c]
+            if ch_sat[c]:
+                val = raw[c][s:min(e, raw_len[c])]
+                if len(val)>0 and val.min()<=sat_thr:
+                    saturated = True
+        out[p, _I_PTIME+2] = coin
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[p, _I_PTIME+3] = np.float64(area_max)/out[p, 0]
+        out[p, _I_PTIME+4] = area_max_ch_id
+        out[p, _I_PTIME+5] = area_bot_max
+        out[p, _I_PTIME+6] = area_bot_max_ch_id
+        out[p, _I_PTIME+7] = saturated
+    return out, out_ch_area, out_ch_height
+
+def pulse_features(*args, use_numba=HAVE_NUMBA):
+    """
+    Compute every pulse-level RQ of one event.
+
+    Args:
+        t_ax: (n_samp,) time axis in ns
+        grp_amp, grp_int: (len(SUM_GROUPS), n_samp) summed waveforms and their integrals
+        ch_amp, ch_int: (n_ch, n_max) PMT waveforms and integrals, zero padded
+        ch_len: (n_ch,) length of each PMT waveform
+        ch_id: (n_ch,) boardId*100 + chID
+        ch_is_bot, ch_sat: (n_ch,) bottom PMT flag, channel saturation flag
+        raw, raw_len: (n_ch, n_raw_max) raw ADC waveforms, and their lengths
+        start, end: (n_pulses,) pulse boundaries in samples
+        spe_thr, sat_thr, sample_to_ns: float
+        use_numba (bool): use the compiled kernel (default: if numba is available)
+
+    Return:
+        features (n_pulses, N_FEATURES), in PULSE_FEATURES order
+        ch_area, ch_height (n_pulses, n_ch)
+    """
+    if use_numba and HAVE_NUMBA:
+        return _pulse_features_nb(*args)
+    return _pulse_features_py(*args)
+
+@_jit
+def _pulse_boundaries_nb(a, ev, peaks, thresh, left_window, right_window):
+    n = len(peaks)
+    n_samp = a.shape[1]
+    start = np.zeros(n, dtype=np.int64)
+    end = np.zeros(n, dtype=np.int64)
+    for p in range(n):
+        k = ev[p]
+        pk_l = peaks[p]
+        for j in range(left_window):
+            pk_l -= 1
+            if a[k, pk_l]<=thresh[k] or pk_l<=0:
+                break
+        pk_r = peaks[p]
+        for j in range(right_window):
+            pk_r += 1
+            if a[k, pk_r]<=thresh[k] or pk_r>=n_samp-1:
+                break
+        start[p] = pk_l
+        end[p] = pk_r
+    return start, end
+
+def _pulse_boundaries_np(a, ev, peaks, thresh, left_window, right_window):
+    n_samp = a.shape[1]
+    thr = thresh[ev][:, None]
+    # left: first k in 1..left_window with a[pk-k]<=thresh or pk-k<=0
+    idx = peaks[:, None] - np.arange(1, left_window+1)
+    stop = (a[ev[:, None], np.clip(idx, 0, n_samp-1)]<=thr) | (idx<=0)
+    k = np.where(stop.any(axis=1), stop.argmax(axis=1)+1, left_window)
+    start = peaks - k
+    # right: first k in 1..right_window with a[pk+k]<=thresh or pk+k>=n_samp-1
+    idx = peaks[:, None] + np.arange(1, right_window+1)
+    stop = (a[ev[:, None], np.clip(idx, 0, n_samp-1)]<=thr) | (idx>=n_samp-1)
+    k = np.where(stop.any(axis=1), stop.argmax(axis=1)+1, right_window)
+    end = peaks + k
+    return start, end
+
+def pulse_boundaries(a, peaks, thresh, left_window=8, right_window=42, ev=None, use_numba=HAVE_NUMBA):
+    """
+    Pulse start and end around each peak: walk at most left_window samples
+    to the left and right_window samples to the right, stopping at the first
+    sample at or below thresh (or at the waveform edge).
+
+    Args:
+        a: (n_samp,) waveform of one event, or (n_events, n_samp) for a batch
+        peaks: (n_pulses,) peak positions in samples
+        thresh: float, or (n_events,) one per event
+        left_window, right_window (int): search windows in samples
+        ev: (n_pulses,) event index of each peak, for a batch
+        use_numba (bool): use the compiled kernel (default: if numba is available)
+
+    Return:
+        start, end: (n_pulses,) int64 arrays
+    """
+    a = np.atleast_2d(np.asarray(a, dtype=np.float64))
+    peaks = np.asarray(peaks, dtype=np.int64)
+    if ev is None:
+        ev = np.zeros(len(peaks), dtype=np.int64)
+    ev = np.asarray(ev, dtype=np.int64)
+    thresh = np.broadcast_to(np.asarray(thresh, dtype=np.float64), (a.shape[0],)).copy()
+    if len(peaks)==0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if use_numba and HAVE_NUMBA:
+        return _pulse_boundaries_nb(a, ev, peaks, thresh, int(left_window), int(right_window))
+    return _pulse_boundaries_np(a, ev, peaks, thresh, int(left_window), int(right_window))
@@ -0,0 +1,197 @@
+'''
+Convert many raw binary files to root in parallel, one RawDataRooter per file.
+
+A manifest (json) keeps, for every input file, the conversion status, event
+and trigger counts, byte sizes, timing and the sha1 of the output. It is
+rewritten after each file finishes, so an interrupted batch can simply be run
+again: files already converted, whose input did not change and whose output
+still matches the recorded checksum, are skipped.
+
+Usage:
+    python raw_data_batch.py -i /path/to/binary/dir --output_dir /path/to/raw_root --workers 8
+    python raw_data_batch.py -i "/path/to/binary/*_2506*.dat" file_list.txt --output_dir ...
+
+Each file's print out goes to <output file>.log. The exit status is nonzero if
+any file failed.
+'''
+
+import argparse
+import sys
+import os
+import glob
+import json
+import time
+import hashlib
+import contextlib
+from types import SimpleNamespace
+from datetime import datetime
+from multiprocessing import get_context
+
+import raw_data_rooter
+from raw_data_rooter import get_output_path, MAX_N_TRIGGERS
+
+RAW_EXTENSIONS = ('.dat', '.bin')
+MANIFEST_NAME = 'raw_data_manifest.json'
+
+def find_inputs(inputs):
+    """
+    Expand inputs into a sorted list of raw binary files.
+
+    Args:
+        inputs (list): directories (all .dat/.bin files inside), glob patterns,
+            files, or .txt file lists (one path per line, # for comments)
+    """
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for ext in RAW_EXTENSIONS:
+                files.update(glob.glob(os.path.join(item, '*' + ext)))
+        elif item.endswith('.txt') and os.path.isfile(item):
+            with open(item) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        files.add(line)
+        else:
+            matched = glob.glob(item)
+            if not matched:
+                print('Warning: no file matches', item)
+            files.update(matched)
+    return sorted(os.path.abspath(f) for f in files)
+
+def file_sha1(file_path, chunk_size=1<<22):
+    """
+    sha1 hex digest of a file, read in chunks.
+    """
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_manifest(manifest_path):
+    """
+    Return the manifest as dict of input path -> record, empty if not there.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f).get('files', {})
+    except (OSError, ValueError) as e:
+        print('Warning: cannot read manifest %s (%s), starting a new one' % (manifest_path, e))
+        return {}
+
+def save_manifest(manifest_path, files):
+    """
+    Write the manifest atomically (tmp file + rename), so a crash never
+    leaves a truncated one.
+    """
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'updated': datetime.now().isoformat(timespec='seconds'), 'files': files}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+    return None
+
+def is_done(record, if_path):
+    """
+    True if record says if_path was converted, the input is unchanged, and
+    the output exists with the recorded size and checksum.
+    """
+    if record is None or record.get('status')!='done':
+        return False
+    st = os.stat(if_path)
+    if record.get('input_bytes')!=st.st_size or record.get('input_mtime')!=st.st_mtime:
+        return False
+    of_path = record.get('output')
+    if not of_path or not os.path.exists(of_path):
+        return False
+    if os.path.getsize(of_path)!=record.get('output_bytes'):
+        return False
+    return file_sha1(of_path)==record.get('output_sha1')
+
+def convert_one(if_path, output_dir, pipeline=False):
+    """
+    Convert one file with raw_data_rooter. Runs in a worker process.
+
+    Return:
+        dict, the manifest record of this file
+    """
+    of_path = os.path.abspath(get_output_path(if_path, output_dir))
+    st = os.stat(if_path)
+    record = {
+        'output': of_path,
+        'input_bytes': st.st_size,
+        'input_mtime': st.st_mtime,
+        'started': datetime.now().isoformat(timespec='seconds'),
+    }
+    args = SimpleNamespace(if_path=if_path, output_dir=output_dir, start_id=0,
+        end_id=MAX_N_TRIGGERS, pipeline=pipeline)
+    t0 = time.time()
+    try:
+        with open(of_path + '.log', 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            rooter = raw_data_rooter.convert(args)
+        record['status'] = 'done'
+        record['n_events'] = int(rooter.tot_n_evt_proc)
+        record['n_triggers'] = int(rooter.n_trg_read)
+        record['output_bytes'] = os.path.getsize(of_path)
+        record['output_sha1'] = file_sha1(of_path)
+    except (Exception, SystemExit) as e: # the rooter exits on bad files
+        record['status'] = 'failed'
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    record['seconds'] = round(time.time()-t0, 3)
+    return if_path, record
+
+def main(argv):
+    """
+    Main function. Usage:
+    python raw_data_batch.py --help
+    """
+    parser = argparse.ArgumentParser(description='Convert many raw binary files to root in parallel')
+    parser.add_argument('--output_dir', type=str, default="", help='Optional. output directory. If not specified, next to each input file.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Optional. number of files converted at once (default: number of cores)')
+    parser.add_argument('--manifest', type=str, default="", help='Optional. manifest path (default: %s in output_dir, or in the current directory)' % MANIFEST_NAME)
+    parser.add_argument('--pipeline', action='store_true', help='Optional. use the pipelined mode of raw_data_rooter in each worker')
+    parser.add_argument('--force', action='store_true', help='Optional. convert again files already done')
+    required = parser.add_argument_group('Required Arguments')
+    required.add_argument('-i', '--inputs', type=str, nargs='+', help='Required. directories, glob patterns, files, or .txt file lists', required=True)
+    args = parser.parse_args(argv)
+
+    if args.output_dir!="":
+        os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.output_dir or '.', MANIFEST_NAME)
+    files = load_manifest(manifest_path)
+
+    inputs = find_inputs(args.inputs)
+    todo = []
+    for if_path in inputs:
+        if not args.force and is_done(files.get(if_path), if_path):
+            continue
+        todo.append(if_path)
+    print('Info: %d files found, %d already converted, %d to convert with %d workers'
+        % (len(inputs), len(inputs)-len(todo), len(todo), args.workers))
+    if not todo:
+        return None
+
+    t0 = time.time()
+    n_failed = 0
+    jobs = [(f, args.output_dir, args.pipeline) for f in todo]
+    with get_context("spawn").Pool(max(1, min(args.workers, len(todo)))) as pool:
+        for k, (if_path, record) in enumerate(pool.imap_unordered(_convert_one, jobs)):
+            files[if_path] = record
+            save_manifest(manifest_path, files)
+            if record['status']=='done':
+                print('[%d/%d] %s: %d events, %.1f s' % (k+1, len(todo), os.path.basename(if_path), record['n_events'], record['seconds']))
+            else:
+                n_failed += 1
+                print('[%d/%d] %s: FAILED (%s), see %s.log' % (k+1, len(todo), os.path.basename(if_path), record['error'], record['output']))
+    print('Info: done in %.1f s, %d failed. Manifest: %s' % (time.time()-t0, n_failed, manifest_path))
+    if n_failed>0:
+        sys.exit('ERROR: %d of %d files failed, see the manifest %s' % (n_failed, len(todo), manifest_path))
+    return None
+
+def _convert_one(job):
+    return convert_one(*job)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -19,6 +19,8 @@ Notes:
 
 import argparse
 import sys
+import threading
+import queue
 from numpy import array, isscalar, zeros, uint32, uint16, uint64
 import numpy as np
 from os import path
@@ -38,8 +40,11 @@ MAX_N_TRIGGERS = 999999 # Arbitary large. Larger than n_triggers in raw binary f
 DUMP_SIZE = 3000 # number of triggers to accumulate in queue before dump
 INITIAL_BASKET_CAPACITY=1000 # number of basket per file
 MAX_EVENT_QUEUE = 10000 # throw warning if event queue is getting too big. No action yet.
+RING_CAPACITY = 2*DUMP_SIZE//N_BOARDS # initial number of complete events held before writing; grows if needed
 ETTT_FLAG=True # False: use the default 32-bit time counter; True: use extended trigger time tag (ETTT) which is is a 48-bit time counter. 
 VERBOSITY=0 # Integer. 0 is quiet mode (less print out). Higher is more. 
+PIPELINE_QUEUE_SIZE = 4 # --pipeline: max number of trigger chunks / baskets waiting between stages
+READ_CHUNK_SIZE = 100 # --pipeline: triggers handed from the reader to the event builder at a time
 
 if DUMP_SIZE<=10:
     print("Info: write small baskets is not recommended by Jim \
@@ -47,6 +52,26 @@ if DUMP_SIZE<=10:
     100 kb/basket/branch. See: \
     https://github.com/scikit-hep/uproot4/pull/428")
 
+def get_output_path(if_path, output_dir=""):
+    """
+    Output root file of a raw binary file: same name, .bin replaced by (or
+    other names appended with) .root.
+
+    Args:
+        if_path (str): raw binary file
+        output_dir (str): if empty, the directory of if_path
+    """
+    if output_dir=="":
+        if if_path[-4:]=='.bin':
+            return if_path[:-4] +'.root'
+        else:
+            return if_path +'.root'
+    fname = path.basename(if_path)
+    if fname[-4:]=='.bin':
+        return output_dir + '/' + fname[:-4] + '.root'
+    else:
+        return output_dir + '/' + fname + '.root'
+
 class RunStatus(Enum):
     NORMAL = 0 # all good, keep going
     STOP = 1 # stop the run
@@ -68,17 +93,8 @@ class RawDataRooter():
         self.end_id = int(args.end_id)
         self.raw_data_file = RawDataFile(args.if_path, n_boards=N_BOARDS, ETTT_flag=ETTT_FLAG, DAQ_Software=DAQ_SOFTWARE)
         self.raw_data_file.verbosity=VERBOSITY
-        if args.output_dir=="":
-            if args.if_path[-4:]=='.bin':
-                self.of_path = args.if_path[:-4] +'.root'
-            else:
-                self.of_path = args.if_path +'.root'
-        else:
-            fname = path.basename( args.if_path)
-            if fname[-4:]=='.bin':
-                self.of_path = args.output_dir + '/' + fname[:-4] + '.root'
-            else:
-                self.of_path = args.output_dir + '/' + fname + '.root'
+        self.triggers = self.raw_data_file.iter_triggers() # bulk decoder, see caen_reader
+        self.of_path = get_output_path(args.if_path, args.output_dir)
 
         # useful variables
         self.n_trg_read = 0 # number of trigger read from binary (updated in next())
@@ -143,6 +159,7 @@ class RawDataRooter():
 
         print("Info: current active channels are:")
         print(self.ch_names)
+        self.min_boardId = min(self.boardId) # its ttt is the event ttt
         if len(self.boardId) != N_BOARDS:
             print("-----> Attention <-----")
             print("WARNING:  N_BOARDS does not match! preview_file read",len(self.boardId), 'boards, but N_BOARDS=', N_BOARDS)
@@ -158,7 +175,19 @@ class RawDataRooter():
         Returns:
             RunStatus: NORMAL, SKIP, STOP
         '''
-        trg = self.raw_data_file.getNextTrigger()
+        trg = next(self.triggers, None)
+        return self.process_trigger(trg)
+
+    def process_trigger(self, trg):
+        '''
+        Check one trigger and add it to the event queue. See next.
+
+        Args:
+            trg (RawTrigger): None at the end of file
+
+        Returns:
+            RunStatus: NORMAL, SKIP, STOP
+        '''
         if trg is None: # end of file?
             print("Info: End of file. Close!")
             self.raw_data_file.close()
@@ -212,8 +241,72 @@ class RawDataRooter():
     def reset_event_queue(self):
         """
         Reset the event queue.
+
+        The event queue only holds events still waiting for some boards. Each
+        queued event counts the channels it has received, so completeness is
+        known in O(1) when a trigger arrives. Complete events are moved right
+        away into a preallocated uint16 ring buffer (see move_to_ring), in
+        completion order, so a dump is a contiguous slice of it.
         """
         self.event_queue = {}
+        self.event_n_ch = {} # event_id -> number of channels received
+        self.event_boards = {} # event_id -> bit mask of boards received
+        self.ch_list = sorted(self.ch_names)
+        self.ch_set = set(self.ch_names)
+        self.allocate_ring(RING_CAPACITY)
+        return None
+
+    def allocate_ring(self, capacity):
+        """
+        Allocate (or grow) the ring buffer of complete events.
+
+        Events are addressed by a running counter, slot = counter % capacity:
+            [ring_tail, ring_dump): dumped to a basket, not yet written
+            [ring_dump, ring_head): complete, not yet dumped
+
+        Baskets handed to the writer are views of the ring; growing allocates
+        new arrays, so the views stay valid.
+
+        Args:
+            capacity (int): number of events
+        """
+        old = getattr(self, 'ring', None)
+        ring = {}
+        for ch in self.ch_list:
+            ring['adc_' + ch] = zeros([capacity, self.n_samples], dtype=uint16)
+        ring['event_id'] = zeros(capacity, dtype=uint32)
+        ring['event_ttt'] = zeros(capacity, dtype=uint64)
+        ring['event_sanity'] = zeros(capacity, dtype=uint16)
+        if old is None:
+            self.ring_head = 0
+            self.ring_dump = 0
+            self.ring_tail = 0
+        else:
+            live = np.arange(self.ring_tail, self.ring_head)
+            for b_name, val in ring.items():
+                val[live % capacity] = old[b_name][live % self.ring_capacity]
+        self.ring = ring
+        self.ring_capacity = capacity
+        return None
+
+    def move_to_ring(self, trg_id):
+        """
+        Move a complete event from the event queue to the ring buffer.
+        """
+        # the writer releases slots by advancing ring_tail
+        if self.ring_head - self.ring_tail >= self.ring_capacity:
+            self.allocate_ring(2*self.ring_capacity)
+        i = self.ring_head % self.ring_capacity
+        ev = self.event_queue.pop(trg_id)
+        del self.event_n_ch[trg_id]
+        del self.event_boards[trg_id]
+        self.ring['event_id'][i] = trg_id
+        self.ring['event_ttt'][i] = ev['ttt']
+        self.ring['event_sanity'][i] = ev['sanity']
+        for ch in self.ch_list:
+            self.ring['adc_' + ch][i] = ev[ch]
+        self.ring_head += 1
+        self.dumped_event_id.add(trg_id) # keep a record of event_id out of the queue
         return None
 
     def fill_event_queue(self, trg):
@@ -232,76 +325,78 @@ class RawDataRooter():
         """
         boardId = trg.boardId
         trg_id = trg.eventCounter
+        n_ch = len(trg.traces)
+        if not self.ch_set.issuperset(trg.traces.keys()):
+            print("WARNING: trigger has channels not seen in preview_file, skipped")
+            self.skipped_event_id = trg_id
+            return RunStatus.SKIP
         if trg_id in self.event_queue:
-            for ch, val in trg.traces.items():
-                if ch in self.event_queue[trg_id]:
-                    # duplicated, send warning
-                    print("WARNING: duplicated trigger ???")
-                    self.skipped_event_id = trg_id
-                    return RunStatus.SKIP
-                else:
-                    self.event_queue[trg_id][ch] = val
+            if self.event_boards[trg_id] & 1 << boardId:
+                # duplicated, send warning
+                print("WARNING: duplicated trigger ???")
+                self.skipped_event_id = trg_id
+                return RunStatus.SKIP
+            self.event_queue[trg_id].update(trg.traces)
             self.event_queue[trg_id]['sanity'] += 10**(boardId-1) * trg.sanity
+            self.event_n_ch[trg_id] += n_ch
+            self.event_boards[trg_id] |= 1 << boardId
         else:
             self.event_queue[trg_id] = trg.traces
             self.event_queue[trg_id]['sanity'] = 10**(boardId-1) * trg.sanity
+            self.event_n_ch[trg_id] = n_ch
+            self.event_boards[trg_id] = 1 << boardId
 
         # add ttt to the queue
         ttt = trg.triggerTimeTag
-        if boardId == min(self.boardId):
+        if boardId == self.min_boardId:
             self.event_queue[trg_id]['ttt']=ttt
-        return RunStatus.NORMAL
 
-
-    def get_full_queue_id(self):
-        """
-        Return a set of event_id in queue that have all info filled
-        """
-        all_keys = self.ch_names.copy()
-        all_keys.add('ttt')
-        all_keys.add('sanity')
-        full_event_id = set()
-        for i, ev in self.event_queue.items():
-            if set(ev.keys()) == all_keys:
-                full_event_id.add(i)
-        return full_event_id
+        if self.event_n_ch[trg_id]==len(self.ch_list):
+            self.move_to_ring(trg_id)
+        return RunStatus.NORMAL
 
     def dump_events(self):
         """
         Dump fully filled events from queue to tree
         """
-        # get rows from queue
-        id_set = self.get_full_queue_id()
-        n_evts = len(id_set)
+        basket = self.build_basket()
+        if basket is not None:
+            self.write_basket(basket)
+        return None
 
+    def build_basket(self):
+        """
+        Take the complete events from the ring buffer.
+
+        Return:
+            dict of branch name -> array, or None if no event is complete.
+            The arrays are views of the ring buffer (copies if the events wrap
+            around its end), valid until write_basket.
+        """
+        n_evts = self.ring_head - self.ring_dump
         if n_evts==0:
             return None
-        # create a basket
+        i0 = self.ring_dump % self.ring_capacity
+        i1 = i0 + n_evts
         basket = {}
-        for ch in self.ch_names:
-            b_name = 'adc_' + ch
-            basket[b_name] = zeros([n_evts, self.n_samples])
-        basket['event_id'] = zeros(n_evts, dtype=uint32)
-        basket['event_ttt'] = zeros(n_evts, dtype=uint64)
-        basket['event_sanity'] = zeros(n_evts, dtype=uint16)
-
-        # fill basket
-        for i, ID in enumerate(id_set):
-            ev = self.event_queue[ID]
-            basket['event_id'][i]=ID
-            basket['event_ttt'][i]=ev['ttt']
-            basket['event_sanity'][i]=ev['sanity']
-            for ch in self.ch_names:
-                b_name = 'adc_' + ch
-                basket[b_name][i] = ev[ch]
-        self.file["daq"].extend(basket)
-        # remove events from queue
-        for ID in id_set:
-            del self.event_queue[ID]
-            self.dumped_event_id.add(ID) # keep a record of deleted event_id
-        self.tot_n_evt_proc = len(self.dumped_event_id)
+        for b_name, val in self.ring.items():
+            if i1<=self.ring_capacity:
+                basket[b_name] = val[i0:i1]
+            else:
+                basket[b_name] = np.concatenate([val[i0:], val[:i1-self.ring_capacity]])
+        self.ring_dump = self.ring_head
+        self.tot_n_evt_proc = self.ring_dump
         # keep track of num. of dumps
         self.dump_counter += 1
+        return basket
+
+    def write_basket(self, basket):
+        """
+        Extend the daq tree with a basket from build_basket.
+        """
+        self.file["daq"].extend(basket)
+        # free the slots
+        self.ring_tail += len(basket['event_id'])
         return None
 
     def dump_run_info(self):
@@ -355,6 +450,138 @@ class RawDataRooter():
             print('read %d th trggers,' % self.n_trg_read, " dumped %d events" % tot_n_evt_proc)
         return None
 
+def _put(q, item, stop):
+    """
+    Put item on a bounded queue, unless the pipeline is being stopped.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q, stop):
+    """
+    Get an item from a queue, unless the pipeline is being stopped.
+
+    Return:
+        (bool, item): False if stopped
+    """
+    while not stop.is_set():
+        try:
+            return True, q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return False, None
+
+def run_pipelined(rooter):
+    """
+    Same as the serial loop in main, split in three stages connected by
+    bounded queues, so that file reading, decoding and ROOT compression
+    overlap:
+        - reader thread: decode triggers from the binary file
+        - main thread: build events (event queue), fill baskets
+        - writer thread: extend the daq tree
+
+    Args:
+        rooter (RawDataRooter): with output file created
+    """
+    trg_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    basket_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            chunk = []
+            for trg in rooter.triggers:
+                chunk.append(trg)
+                if len(chunk)==READ_CHUNK_SIZE:
+                    if not _put(trg_queue, chunk, stop):
+                        return
+                    chunk = []
+            if chunk:
+                _put(trg_queue, chunk, stop)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            _put(trg_queue, None, stop) # end of file
+
+    def write():
+        while True:
+            ok, basket = _get(basket_queue, stop)
+            if not ok or basket is None:
+                return
+            try:
+                rooter.write_basket(basket)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+                return
+
+    reader = threading.Thread(target=read, name='rooter-reader', daemon=True)
+    writer = threading.Thread(target=write, name='rooter-writer', daemon=True)
+    reader.start()
+    writer.start()
+
+    try:
+        i = 0
+        done = False
+        while not done and not stop.is_set():
+            ok, chunk = _get(trg_queue, stop)
+            if not ok or errors: # a stage failed, do not mistake it for end of file
+                break
+            for trg in (chunk if chunk is not None else [None]):
+                status = rooter.process_trigger(trg)
+                if status==RunStatus.STOP:
+                    basket = rooter.build_basket()
+                    if basket is not None:
+                        _put(basket_queue, basket, stop)
+                    if len(rooter.event_queue)>0:
+                        if VERBOSITY>=1:
+                            print("Leftover in queue (event_id, keys):")
+                            for ID, ev in rooter.event_queue.items():
+                                print(ID, ev.keys())
+                    done = True
+                    break
+                elif status==RunStatus.SKIP:
+                    tot_n_evt_proc = len(rooter.dumped_event_id)
+                    print('SKIP:', i, rooter.skipped_event_id, tot_n_evt_proc)
+                else:
+                    if rooter.n_trg_read % DUMP_SIZE == 0:
+                        basket = rooter.build_basket()
+                        if basket is not None:
+                            _put(basket_queue, basket, stop)
+                        n_queue = len(rooter.event_queue)
+                        if n_queue>MAX_EVENT_QUEUE:
+                            print("WARNING: your event queue is getting too big.")
+                    rooter.show_progress()
+                i += 1
+                if i>=MAX_N_TRIGGERS:
+                    done = True
+                    break
+    except BaseException:
+        # the threads would wait forever for the next chunk or basket
+        stop.set()
+        raise
+    finally:
+        # let the writer finish, then stop the reader if it is still going
+        if not stop.is_set():
+            _put(basket_queue, None, stop)
+        else:
+            try:
+                basket_queue.put_nowait(None)
+            except queue.Full:
+                pass # the writer also checks stop
+        writer.join()
+        stop.set()
+        reader.join()
+    if errors:
+        raise errors[0]
+    return None
+
 def main(argv):
     """
     Main function. Usage:
@@ -365,17 +592,33 @@ def main(argv):
     parser.add_argument('--start_id', type=int, default=0, help='Optional. start process from start_id (default: 0)')
     parser.add_argument('--end_id', type=int, default=MAX_N_TRIGGERS, help='Optional. stop process at end_id (defalt: Arbiarty large)')
     parser.add_argument('--output_dir', type=str, default="", help='Optional. output directory. Default: not specified. If not specified, use input binary file directory.' )
+    parser.add_argument('--pipeline', action='store_true', help='Optional. read, build events and write in parallel stages (default: serial)')
     required = parser.add_argument_group('Required Arguments')
     required.add_argument('-i', '--if_path', type=str, help='Required. full path to the raw data file', required=True)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    convert(args)
+    return None
 
+def convert(args):
+    """
+    Convert one binary file. See main for args.
+
+    Return:
+        RawDataRooter, after the output file is closed
+    """
     rooter = RawDataRooter(args)
     rooter.create_output_file()
+    if args.pipeline:
+        run_pipelined(rooter)
+        rooter.dump_run_info()
+        rooter.print_summary()
+        rooter.close_file()
+        return rooter
     for i in range(MAX_N_TRIGGERS):
         status = rooter.next()
         if status==RunStatus.STOP:
+            rooter.dump_events()
             if len(rooter.event_queue)>0:
-                rooter.dump_events()
                 if VERBOSITY>=1:
                     print("Leftover in queue (event_id, keys):")
                     for i, ev in rooter.event_queue.items():
@@ -395,6 +638,7 @@ def main(argv):
     rooter.dump_run_info()
     rooter.print_summary()
     rooter.close_file()
+    return rooter
 
 if __name__ == "__main__":
    main(sys.argv[1:])
@@ -68,6 +68,7 @@ class RawDataRooter():
         self.end_id = int(args.end_id)
         self.raw_data_file = RawDataFile(args.if_path, n_boards=N_BOARDS, ETTT_flag=ETTT_FLAG, DAQ_Software=DAQ_SOFTWARE)
         self.raw_data_file.verbosity=VERBOSITY
+        self.triggers = self.raw_data_file.iter_triggers() # bulk decoder, see caen_reader
         if args.output_dir=="":
             if args.if_path[-4:]=='.bin':
                 self.of_path = args.if_path[:-4] +'.root'
@@ -165,7 +166,7 @@ class RawDataRooter():
         Returns:
             RunStatus: NORMAL, SKIP, STOP
         '''
-        trg = self.raw_data_file.getNextTrigger()
+        trg = next(self.triggers, None)
         if trg is None: # end of file?
             print("Info: End of file. Close!")
             self.raw_data_file.close()
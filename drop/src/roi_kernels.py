@@ -0,0 +1,69 @@
+"""
+ROI kernels
+
+Variables of every region of interest (ROI) of every channel, in one
+vectorized step over arrays of shape (..., n_samples), ex. (n_ch, n_samples)
+for one event or (n_events, n_ch, n_samples) for a batch:
+
+- area: difference of the accumulated integral (amp_pe_int) at the ROI edges
+- height, low: max and min, all ROIs at once with np.maximum/minimum.reduceat
+- std: around the mean of each window (np.std), one call per ROI over all
+  channels and events
+
+The ROI windows are the same as before: roi_start_ns/roi_end_ns from the yaml
+file, relative to the trigger position, clipped to the waveform. Board 4
+windows are clipped to the shorter of the board 4 and the other waveforms,
+like the original per-channel loop. Any number of ROIs is supported.
+"""
+import sys
+import numpy as np
+
+from yaml_reader import SAMPLE_TO_NS
+
+def roi_windows(cfg, trg_pos, n_samp):
+    """
+    Sample windows of the ROIs.
+
+    Args:
+        cfg (YamlReader): roi_start_ns, roi_end_ns
+        trg_pos (int): trigger position, in samples
+        n_samp (int): number of samples of the waveforms
+
+    Return:
+        (start, end): int arrays (n_roi,). The ROI is [start, end) for
+        height, low and std, and the area is int[end]-int[start].
+    """
+    start = trg_pos + np.asarray(cfg.roi_start_ns)//int(SAMPLE_TO_NS)
+    end = trg_pos + np.asarray(cfg.roi_end_ns)//int(SAMPLE_TO_NS)
+    start = np.maximum(0, start)
+    end = np.minimum(n_samp-1, end)
+    if np.any(start>=end):
+        sys.exit('ERROR: empty ROI %s for waveforms of %d samples (trigger at %d)' % (np.flatnonzero(start>=end).tolist(), n_samp, trg_pos))
+    return start.astype(np.int64), end.astype(np.int64)
+
+def roi_info(amp, amp_int, start, end):
+    """
+    Area, height, low and std of every ROI.
+
+    Args:
+        amp: array (..., n_samples), waveforms in PE
+        amp_int: accumulated integral of amp, cumsum(amp)*SAMPLE_TO_NS
+        start, end: int arrays (n_roi,), see roi_windows
+
+    Return:
+        area, height, low, std: arrays (..., n_roi)
+    """
+    idx = np.empty(2*len(start), dtype=np.int64)
+    idx[0::2] = start
+    idx[1::2] = end
+    # even entries reduce over [start, end), odd ones are not used
+    height = np.maximum.reduceat(amp, idx, axis=-1)[..., 0::2]
+    low = np.minimum.reduceat(amp, idx, axis=-1)[..., 0::2]
+    area = amp_int[..., end] - amp_int[..., start]
+
+    # two-pass std around the window mean, the one-pass s2/n-mean**2 form
+    # cancels for windows with a large mean and a small spread
+    std = np.empty(area.shape)
+    for r in range(len(start)):
+        std[..., r] = np.std(amp[..., start[r]:end[r]], axis=-1)
+    return area, height, low, std
@@ -8,12 +8,159 @@ from os.path import splitext, basename, dirname
 from pulse_finder import PulseFinder
 from waveform import Waveform
 from pandas import DataFrame
+import sys
+import threading
+import queue
+import time
+
+# Event level RQs: (branch name, dtype, Waveform attribute)
+EVENT_RQ = [
+    ('event_id', uint32, 'event_id'),
+    ('event_ttt', np.uint64, 'event_ttt'),
+    ('event_sanity', uint32, 'event_sanity'),
+    ('event_saturated', bool, 'event_saturated'),
+]
+
+# PMT channel level RQs, one value per signal channel:
+# (branch name, dtype, Waveform attribute, roi index or None for plain dict)
+CH_RQ = [
+    ('ch_saturated', bool, 'ch_saturated', None),
+]
+
+# ROI RQs, ch_roi<i>_<name> for each ROI of the yaml file: (name, Waveform
+# attribute). The Waveform attributes are arrays of (n_roi, n_ch), see
+# Waveform::calc_roi_info.
+ROI_RQ = [
+    ('height_pe', 'roi_height_pe'),
+    ('area_pe', 'roi_area_pe'),
+    ('low_pe', 'roi_low_pe'),
+    ('std_pe', 'roi_std_pe'),
+]
+
+def get_ch_rq(n_roi):
+    """
+    Channel level RQs (see CH_RQ) for n_roi ROIs. std in mV is only saved for
+    the first ROI.
+    """
+    rq = list(CH_RQ)
+    for name, attr in ROI_RQ:
+        rq += [('ch_roi%d_%s' % (r, name), float32, attr, r) for r in range(n_roi)]
+    if n_roi>0:
+        rq.append(('ch_roi0_std_mV', float32, 'roi_std_mV', 0))
+    return rq
+
+# Pulse level RQs, variable length per event: (field name, dtype, PulseFinder attribute)
+# saved as pulse_<field name> branches
+PULSE_RQ = [
+    ('id', uint32, 'id'),
+    ('start', uint32, 'start'),
+    ('end', uint32, 'end'),
+    ('area_sum_pe', float32, 'area_sum_pe'),
+    ('area_bot_pe', float32, 'area_bot_pe'),
+    ('area_side_pe', float32, 'area_side_pe'),
+
+    ('area_row1_pe', float32, 'area_row1_pe'),
+    ('area_row2_pe', float32, 'area_row2_pe'),
+    ('area_row3_pe', float32, 'area_row3_pe'),
+    ('area_row4_pe', float32, 'area_row4_pe'),
+    ('area_row5_pe', float32, 'area_row5_pe'),
+    ('area_row6_pe', float32, 'area_row6_pe'),
+    ('area_row7_pe', float32, 'area_row7_pe'),
+
+    ('area_col1_pe', float32, 'area_col1_pe'),
+    ('area_col2_pe', float32, 'area_col2_pe'),
+    ('area_col3_pe', float32, 'area_col3_pe'),
+    ('area_col4_pe', float32, 'area_col4_pe'),
+    ('area_col5_pe', float32, 'area_col5_pe'),
+    ('area_col6_pe', float32, 'area_col6_pe'),
+    ('area_col7_pe', float32, 'area_col7_pe'),
+    ('area_col8_pe', float32, 'area_col8_pe'),
+
+    ('area_user_pe', float32, 'area_user_pe'),
+    ('aft10_sum_ns', float32, 'aft10_sum_ns'),
+    ('aft10_bot_ns', float32, 'aft10_bot_ns'),
+    ('aft10_side_ns', float32, 'aft10_side_ns'),
+
+    ('aft10_row1_ns', float32, 'aft10_row1_ns'),
+    ('aft10_row2_ns', float32, 'aft10_row2_ns'),
+    ('aft10_row3_ns', float32, 'aft10_row3_ns'),
+    ('aft10_row4_ns', float32, 'aft10_row4_ns'),
+    ('aft10_row5_ns', float32, 'aft10_row5_ns'),
+    ('aft10_row6_ns', float32, 'aft10_row6_ns'),
+    ('aft10_row7_ns', float32, 'aft10_row7_ns'),
+
+    ('aft90_sum_ns', float32, 'aft90_sum_ns'),
+    ('aft90_bot_ns', float32, 'aft90_bot_ns'),
+    ('aft90_side_ns', float32, 'aft90_side_ns'),
+
+    ('aft90_row1_ns', float32, 'aft90_row1_ns'),
+    ('aft90_row2_ns', float32, 'aft90_row2_ns'),
+    ('aft90_row3_ns', float32, 'aft90_row3_ns'),
+    ('aft90_row4_ns', float32, 'aft90_row4_ns'),
+    ('aft90_row5_ns', float32, 'aft90_row5_ns'),
+    ('aft90_row6_ns', float32, 'aft90_row6_ns'),
+    ('aft90_row7_ns', float32, 'aft90_row7_ns'),
+
+    ('rise_sum_ns', float32, 'rise_sum_ns'),
+    ('rise_bot_ns', float32, 'rise_bot_ns'),
+    ('rise_side_ns', float32, 'rise_side_ns'),
+    ('fall_sum_ns', float32, 'fall_sum_ns'),
+    ('fall_bot_ns', float32, 'fall_bot_ns'),
+    ('fall_side_ns', float32, 'fall_side_ns'),
+    ('fp40_sum', float32, 'fp40_sum'),
+    ('fp40_bot', float32, 'fp40_bot'),
+    ('fp40_side', float32, 'fp40_side'),
+    ('fp30_sum', float32, 'fp30_sum'),
+    ('fp30_bot', float32, 'fp30_bot'),
+    ('fp30_side', float32, 'fp30_side'),
+    ('fp20_sum', float32, 'fp20_sum'),
+    ('fp20_bot', float32, 'fp20_bot'),
+    ('fp20_side', float32, 'fp20_side'),
+    ('height_sum_pe', float32, 'height_sum_pe'),
+    ('height_bot_pe', float32, 'height_bot_pe'),
+    ('height_side_pe', float32, 'height_side_pe'),
+    ('sba', float32, 'sba'),
+    ('ptime_ns', float32, 'ptime_ns'),
+    ('coincidence', uint32, 'coincidence'),
+    ('area_max_frac', float32, 'area_max_frac'),
+    ('area_max_ch_id', uint32, 'area_max_ch_id'),
+    ('area_bot_max_frac', float32, 'area_bot_max_frac'),
+    ('area_bot_max_ch_id', uint32, 'area_bot_max_ch_id'),
+    ('saturated', bool, 'pulse_saturated'),
+]
+
+# compression algorithms of the RQ file (see get_compression)
+COMPRESSION_ALGOS = ('ZLIB', 'LZMA', 'LZ4', 'ZSTD')
+
+def get_compression(algo='ZLIB', level=1):
+    """
+    uproot compression object from an algorithm name and level.
+
+    Args:
+        algo (str): 'ZLIB', 'LZMA', 'LZ4', 'ZSTD', or 'NONE' for no compression
+        level (int): compression level, low is fast, high is small
+
+    Return:
+        uproot.compression.Compression, or None if algo is 'NONE'
+    """
+    algo = str(algo).upper()
+    if algo=='NONE':
+        return None
+    if algo not in COMPRESSION_ALGOS:
+        sys.exit("ERROR: unknown rq_compression '%s'. Use one of %s or NONE" % (algo, ', '.join(COMPRESSION_ALGOS)))
+    try:
+        compression = getattr(uproot.compression, algo)(int(level))
+        uproot.compression.compress(bytes(512), compression) # fail now, not at the first basket, if lz4/zstandard is missing
+    except (ValueError, ModuleNotFoundError) as e:
+        sys.exit("ERROR: rq_compression %s level %s: %s" % (algo, level, e))
+    return compression
 
 class RQWriter:
     """
     Write to file
     """
-    def __init__(self, args, n_pmt_ch, n_aux_ch, basket_size=1000):
+    def __init__(self, args, n_pmt_ch, n_aux_ch, basket_size=1000,
+                 compression='ZLIB', compression_level=1, async_write=False, n_roi=3):
         """
         Constructor: create root tree structure, fill, and write. The n_ch and
         n_aux_ch variables are needed to define branch structure (static array).
@@ -25,11 +172,27 @@ class RQWriter:
             n_ch: number of channels used for PMTs (n_active_ch - n_aux_ch)
             n_aux_ch: number of auxiliary (not-signal) channels
             batch_size: number of entries per batch
+            compression (str): 'ZLIB', 'LZMA', 'LZ4', 'ZSTD' or 'NONE'
+            compression_level (int): compression level
+            async_write (bool): compress and write baskets in a background
+                thread, see dump_event_rq
+            n_roi (int): number of ROIs in the yaml file
         """
 
         self.args = args
+        self.compression = get_compression(compression, compression_level)
+        self.async_write = async_write
+        self.write_thread = None
+        self.write_error = None
+        self.spare_buffers = None
+        self.n_written = 0
+        self.n_events_written = 0
+        self.write_s = 0.
+        self.wait_s = 0.
         self.n_pmt_ch = n_pmt_ch
         self.n_aux_ch = n_aux_ch
+        self.ch_rq = get_ch_rq(n_roi)
+        self._roi_cols = None # (Waveform.roi_ch, column of each signal channel in it, channel has a column)
         self.basket_size = basket_size
         self.init_basket_cap = 100
         if self.basket_size<=10:
@@ -42,129 +205,78 @@ class RQWriter:
     def reset(self):
         """
         Variables that needs to be reset per batch of events
+
+        Each RQ has a preallocated column buffer of basket_size rows. Pulse
+        RQs are variable length, so they are stored as one flat content
+        buffer per field plus the number of pulses per event (offsets). The
+        buffers are reused from batch to batch, and grow if needed.
+        """
+        cap = max(self.basket_size, 1)
+        self.n_filled = 0
+        self.n_pulse_filled = 0
+        if getattr(self, 'capacity', 0) < cap:
+            self._allocate(cap, max(4*cap, 16))
+        return None
+
+    def _allocate(self, capacity, pulse_capacity):
+        """
+        Allocate (or grow, keeping the filled part) the column buffers.
+
+        Args:
+            capacity (int): number of events
+            pulse_capacity (int): number of pulses, summed over events
         """
-        # Event level variable
-        self.event_id=[]
-        self.event_ttt=[]
-        self.event_sanity=[]
-        self.event_saturated=[]
-
-        # pmt channel level variables
-        self.ch_id = [] # boardId*100 + chID
-        self.ch_saturated = []
-        self.ch_roi0_height_pe = []
-        self.ch_roi1_height_pe = []
-        self.ch_roi2_height_pe = []
-        self.ch_roi0_area_pe = []
-        self.ch_roi1_area_pe = []
-        self.ch_roi2_area_pe = []
-        self.ch_roi0_low_pe = []
-        self.ch_roi1_low_pe = []
-        self.ch_roi2_low_pe = []
-        self.ch_roi0_std_pe = []
-        self.ch_roi1_std_pe = []
-        self.ch_roi2_std_pe = []
-        self.ch_roi0_std_mV = []
-
-        # non-signal channel info (auxiliary channels)
-        self.aux_ch_id = []
-        self.aux_ch_area_mV = []
-
-        # pulse level variables
-        self.n_pulses=[]
-        self.pulse_id = []
-        self.pulse_start = []
-        self.pulse_end = []
-        self.pulse_area_sum_pe = []
-        self.pulse_area_bot_pe = []
-        self.pulse_area_side_pe = []
-        
-        self.pulse_area_row1_pe = []
-        self.pulse_area_row2_pe = []
-        self.pulse_area_row3_pe = []
-        self.pulse_area_row4_pe = []
-        self.pulse_area_row5_pe = []
-        self.pulse_area_row6_pe = []
-        self.pulse_area_row7_pe = []
-        
-        self.pulse_area_col1_pe = []
-        self.pulse_area_col2_pe = []
-        self.pulse_area_col3_pe = []
-        self.pulse_area_col4_pe = []
-        self.pulse_area_col5_pe = []
-        self.pulse_area_col6_pe = []
-        self.pulse_area_col7_pe = []
-        self.pulse_area_col8_pe = []
-        
-        self.pulse_area_user_pe = []
-        self.pulse_aft10_sum_ns = []
-        self.pulse_aft10_bot_ns = []
-        self.pulse_aft10_side_ns = []
-        
-        self.pulse_aft10_row1_ns = []
-        self.pulse_aft10_row2_ns = []
-        self.pulse_aft10_row3_ns = []
-        self.pulse_aft10_row4_ns = []
-        self.pulse_aft10_row5_ns = []
-        self.pulse_aft10_row6_ns = []
-        self.pulse_aft10_row7_ns = []
-        
-        self.pulse_aft90_sum_ns = []
-        self.pulse_aft90_bot_ns = []
-        self.pulse_aft90_side_ns = []
-        
-        self.pulse_aft90_row1_ns = []
-        self.pulse_aft90_row2_ns = []
-        self.pulse_aft90_row3_ns = []
-        self.pulse_aft90_row4_ns = []
-        self.pulse_aft90_row5_ns = []
-        self.pulse_aft90_row6_ns = []
-        self.pulse_aft90_row7_ns = []
-        
-        self.pulse_rise_sum_ns = []
-        self.pulse_rise_bot_ns = []
-        self.pulse_rise_side_ns= []
-        self.pulse_fall_sum_ns = []
-        self.pulse_fall_bot_ns = []
-        self.pulse_fall_side_ns= []
-        self.pulse_fp40_sum = []
-        self.pulse_fp40_bot = []
-        self.pulse_fp40_side = []
-        self.pulse_fp30_sum = []
-        self.pulse_fp30_bot = []
-        self.pulse_fp30_side = []
-        self.pulse_fp20_sum = []
-        self.pulse_fp20_bot = []
-        self.pulse_fp20_side = []
-        self.pulse_height_sum_pe = []
-        self.pulse_height_bot_pe = []
-        self.pulse_height_side_pe = []
-        self.pulse_sba = []
-        self.pulse_ptime_ns = []
-        self.pulse_coincidence = []
-        self.pulse_area_max_frac = []
-        self.pulse_area_max_ch_id = []
-        self.pulse_area_bot_max_frac = []
-        self.pulse_area_bot_max_ch_id = []
-        self.pulse_saturated = []
-
-        # channel x pulse variables (not yet implemented)
-        self.pulse_ch_area_pe = []
-        self.pulse_ch_height_pe = []
+        def grow(old, shape, dtype):
+            new = zeros(shape, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+
+        old_event = getattr(self, 'event_buf', {})
+        old_ch = getattr(self, 'ch_buf', {})
+        old_pulse = getattr(self, 'pulse_buf', {})
+        self.event_buf = {}
+        for name, dtype, _ in EVENT_RQ:
+            self.event_buf[name] = grow(old_event.get(name), capacity, dtype)
+        self.ch_buf = {}
+        self.ch_buf['ch_id'] = grow(old_ch.get('ch_id'), (capacity, self.n_pmt_ch), uint16)
+        for name, dtype, _, _ in self.ch_rq:
+            self.ch_buf[name] = grow(old_ch.get(name), (capacity, self.n_pmt_ch), dtype)
+        self.ch_buf['aux_ch_id'] = grow(old_ch.get('aux_ch_id'), (capacity, self.n_aux_ch), uint16)
+        self.ch_buf['aux_ch_area_mV'] = grow(old_ch.get('aux_ch_area_mV'), (capacity, self.n_aux_ch), float32)
+        self.n_pulses = grow(getattr(self, 'n_pulses', None), capacity, np.int64)
+        self.pulse_buf = {}
+        for name, dtype, _ in PULSE_RQ:
+            self.pulse_buf[name] = grow(old_pulse.get(name), pulse_capacity, dtype)
+        self.capacity = capacity
+        self.pulse_capacity = pulse_capacity
         return None
 
-    def create_output(self):
+    def get_output_path(self, suffix=''):
+        """
+        Output file name, based on the input file name: name_rq<suffix>.root
+        in args.output_dir, or next to the input file.
+
+        Args:
+            suffix (str): appended to the file name (default: '')
+        """
+        output_dir = str(self.args.output_dir)
+        if output_dir=="":
+            output_dir = dirname(self.args.if_path)
+        name, f_ext = splitext(basename(self.args.if_path))
+        return output_dir + '/' + name +'_rq' + suffix + '.root'
+
+    def create_output(self, suffix=''):
         """
         First create output file name based on input file names
         Then create empty tree via mktree
+
+        Args:
+            suffix (str): appended to the file name, ex. '_part0' gives
+                name_rq_part0.root (default: '')
         """
-        self.output_dir = str(self.args.output_dir)
-        if self.output_dir=="":
-            self.output_dir = dirname(self.args.if_path)
-        fname = basename(self.args.if_path)
-        name, f_ext = splitext(fname)
-        self.of_path = self.output_dir + '/' + name +'_rq.root'
-        self.file = uproot.recreate(self.of_path)
+        self.of_path = self.get_output_path(suffix)
+        self.file = uproot.recreate(self.of_path, compression=self.compression)
 
         bs = self.basket_size
         type_ch_uint16 = ak.Array(zeros([bs, self.n_pmt_ch], dtype=uint16)).type
@@ -173,112 +285,18 @@ class RQWriter:
         type_aux_ch_uint16 = ak.Array(zeros([bs, self.n_aux_ch], dtype=uint16)).type
         type_aux_ch_float = ak.Array(zeros([bs, self.n_aux_ch], dtype=float32)).type
 
-        type_event={
-            'event_id': 'uint32',
-            'event_ttt': 'uint64',
-            'event_sanity': 'uint32',
-            'event_saturated': 'bool',
-
-            'ch_id': type_ch_uint16,
-            'ch_saturated': type_ch_bool,
-            'ch_roi0_height_pe': type_ch_float,
-            'ch_roi1_height_pe': type_ch_float,
-            'ch_roi2_height_pe': type_ch_float,
-            'ch_roi0_area_pe': type_ch_float,
-            'ch_roi1_area_pe': type_ch_float,
-            'ch_roi2_area_pe': type_ch_float,
-            'ch_roi0_low_pe': type_ch_float,
-            'ch_roi1_low_pe': type_ch_float,
-            'ch_roi2_low_pe': type_ch_float,
-            'ch_roi0_std_pe': type_ch_float,
-            'ch_roi1_std_pe': type_ch_float,
-            'ch_roi2_std_pe': type_ch_float,
-            'ch_roi0_std_mV': type_ch_float,
-
-            'aux_ch_id': type_aux_ch_uint16,
-            'aux_ch_area_mV': type_aux_ch_float,
-        }
-
-        type_uint = ak.values_astype([[0], []], uint32)
-        type_float = ak.values_astype([[0.], []], float32)
-        type_bool = ak.values_astype([[0.], []], bool)
-        type_pulse={
-            'id': type_uint,
-            'start': type_uint,
-            'end': type_uint,
-            'area_sum_pe': type_float,
-            'area_bot_pe': type_float,
-            'area_side_pe': type_float,
-            
-            'area_row1_pe': type_float,
-            'area_row2_pe': type_float,
-            'area_row3_pe': type_float,
-            'area_row4_pe': type_float,
-            'area_row5_pe': type_float,
-            'area_row6_pe': type_float,
-            'area_row7_pe': type_float,
-            
-            'area_col1_pe': type_float,
-            'area_col2_pe': type_float,
-            'area_col3_pe': type_float,
-            'area_col4_pe': type_float,
-            'area_col5_pe': type_float,
-            'area_col6_pe': type_float,
-            'area_col7_pe': type_float,
-            'area_col8_pe': type_float,
-            
-            'area_user_pe': type_float,
-            'aft10_sum_ns': type_float,
-            'aft10_bot_ns': type_float,
-            'aft10_side_ns': type_float,
-            
-            'aft10_row1_ns': type_float,
-            'aft10_row2_ns': type_float,
-            'aft10_row3_ns': type_float,
-            'aft10_row4_ns': type_float,
-            'aft10_row5_ns': type_float,
-            'aft10_row6_ns': type_float,
-            'aft10_row7_ns': type_float,
-            
-            'aft90_sum_ns': type_float,
-            'aft90_bot_ns': type_float,
-            'aft90_side_ns': type_float,
-            
-            'aft90_row1_ns': type_float,
-            'aft90_row2_ns': type_float,
-            'aft90_row3_ns': type_float,
-            'aft90_row4_ns': type_float,
-            'aft90_row5_ns': type_float,
-            'aft90_row6_ns': type_float,
-            'aft90_row7_ns': type_float,
-            
-            'rise_sum_ns': type_float,
-            'rise_bot_ns': type_float,
-            'rise_side_ns': type_float,
-            'fall_sum_ns': type_float,
-            'fall_bot_ns': type_float,
-            'fall_side_ns': type_float,
-            'fp40_sum': type_float,
-            'fp40_bot': type_float,
-            'fp40_side': type_float,
-            'fp30_sum': type_float,
-            'fp30_bot': type_float,
-            'fp30_side': type_float,
-            'fp20_sum': type_float,
-            'fp20_bot': type_float,
-            'fp20_side': type_float,
-            'height_sum_pe': type_float,
-            'height_bot_pe': type_float,
-            'height_side_pe': type_float,
-            'sba': type_float,
-            'ptime_ns': type_float,
-            'coincidence': type_uint,
-            'area_max_frac': type_float,
-            'area_max_ch_id': type_uint,
-            'area_bot_max_frac': type_float,
-            'area_bot_max_ch_id': type_uint,
-            'saturated': type_bool,
-        }
+        type_event={}
+        for name, dtype, _ in EVENT_RQ:
+            type_event[name] = np.dtype(dtype).name
+        type_event['ch_id'] = type_ch_uint16
+        for name, dtype, _, _ in self.ch_rq:
+            type_event[name] = type_ch_bool if dtype is bool else type_ch_float
+        type_event['aux_ch_id'] = type_aux_ch_uint16
+        type_event['aux_ch_area_mV'] = type_aux_ch_float
+
+        type_pulse={}
+        for name, dtype, _ in PULSE_RQ:
+            type_pulse[name] = ak.values_astype([[0], []], dtype)
         type_event['pulse']=ak.zip(type_pulse).type
 
         #a=ak.values_astype(a, np.uint16)
@@ -286,180 +304,82 @@ class RQWriter:
                          initial_basket_capacity=self.init_basket_cap)
         print('\nInfo: creating tree structure as the following: ')
         self.file['event'].show()
+        if self.async_write:
+            self.jobs = queue.Queue(maxsize=1)
+            self.write_thread = threading.Thread(target=self._write_loop, name='drop-rq-writer', daemon=True)
+            self.write_thread.start()
         return None
 
     def fill(self, wfm: Waveform, pf: PulseFinder):
         """
-        Add variables to the basket. Append one event at a time.
+        Add variables to the basket. Write one event at a time into row
+        n_filled of the column buffers.
 
         Args:
             wfm (Waveform): waveform from Waveform class.
             pf (PulseFinder): from PulseFinder class
 
         Notes:
-            The small but growing list of data types can be written as TTrees:
-                * dict of NumPy arrays
-                * Single numpy array
-                * Awkward Array containing one level of variable length
-                * a single Pandas DataFrame
-
-        So a list of numpy array is not an acceptable format. A list of
-        list, on the other hand, is okay because it can be casted into
-        a awkward array at extend stage. Hence, call tolist() below. I
-        hope there is a better solution.
-        https://uproot.readthedocs.io/en/latest/basic.html
+            Pulse variables that are not computed for this event (empty,
+            while pf.n_pulses>0) are written as 0, so that all pulse fields
+            share the same offsets.
         """
-        # event level
-        self.event_id.append(wfm.event_id)
-        self.event_ttt.append(wfm.event_ttt)
-        self.event_sanity.append(wfm.event_sanity)
-        self.event_saturated.append(wfm.event_saturated)
-
         # channel level
-        n_ch = len(wfm.ch_id)-self.n_aux_ch
+        n_ch = len(wfm.ch_name_to_id_dict)-self.n_aux_ch
         if n_ch != self.n_pmt_ch:
             print('wfm.event_id=', wfm.event_id)
-            msg = "ERROR: len(wfm.ch_id)=%d while n_aux_ch=%d, but n_ch=%d" % (len(wfm.ch_id), self.n_aux_ch , n_ch)
+            msg = "ERROR: %d active channels while n_aux_ch=%d, but n_ch=%d" % (len(wfm.ch_name_to_id_dict), self.n_aux_ch , n_ch)
             sys.exit(msg)
-        ch_id = zeros(n_ch)
-        ch_saturated = np.full(n_ch, False)
-        roi0_h = zeros(n_ch)
-        roi1_h = zeros(n_ch)
-        roi2_h = zeros(n_ch)
-        roi0_a = zeros(n_ch)
-        roi1_a = zeros(n_ch)
-        roi2_a = zeros(n_ch)
-        roi0_l = zeros(n_ch)
-        roi1_l = zeros(n_ch)
-        roi2_l = zeros(n_ch)
-        roi0_s = zeros(n_ch)
-        roi1_s = zeros(n_ch)
-        roi2_s = zeros(n_ch)
-        roi0_s_mV = zeros(n_ch)
-        i=0
-        for ch in wfm.ch_names:
-            if ch in wfm.cfg.non_signal_channels:
-                continue
-            ch_id[i] = wfm.ch_name_to_id_dict[ch]
-            ch_saturated[i] = wfm.ch_saturated[ch]
-            roi0_h[i] = wfm.roi_height_pe[0][ch]
-            roi1_h[i] = wfm.roi_height_pe[1][ch]
-            roi2_h[i] = wfm.roi_height_pe[2][ch]
-            roi0_a[i] = wfm.roi_area_pe[0][ch]
-            roi1_a[i] = wfm.roi_area_pe[1][ch]
-            roi2_a[i] = wfm.roi_area_pe[2][ch]
-            roi0_l[i] = wfm.roi_low_pe[0][ch]
-            roi1_l[i] = wfm.roi_low_pe[1][ch]
-            roi2_l[i] = wfm.roi_low_pe[2][ch]
-            roi0_s[i] = wfm.roi_std_pe[0][ch]
-            roi1_s[i] = wfm.roi_std_pe[1][ch]
-            roi2_s[i] = wfm.roi_std_pe[2][ch]
-            roi0_s_mV[i] = wfm.roi_std_mV[0][ch]
-            i+=1
-        self.ch_id.append( ch_id )
-        self.ch_saturated.append( ch_saturated )
-        self.ch_roi0_height_pe.append(roi0_h)
-        self.ch_roi1_height_pe.append(roi1_h)
-        self.ch_roi2_height_pe.append(roi2_h)
-        self.ch_roi0_area_pe.append(roi0_a)
-        self.ch_roi1_area_pe.append(roi1_a)
-        self.ch_roi2_area_pe.append(roi2_a)
-        self.ch_roi0_low_pe.append(roi0_l)
-        self.ch_roi1_low_pe.append(roi1_l)
-        self.ch_roi2_low_pe.append(roi2_l)
-        self.ch_roi0_std_pe.append(roi0_s)
-        self.ch_roi1_std_pe.append(roi1_s)
-        self.ch_roi2_std_pe.append(roi2_s)
-        self.ch_roi0_std_mV.append(roi0_s_mV)
+
+        n_pulses = int(pf.n_pulses)
+        if self.n_filled >= self.capacity or self.n_pulse_filled+n_pulses > self.pulse_capacity:
+            self._allocate(max(self.capacity, 2*self.n_filled+1),
+                max(self.pulse_capacity, 2*(self.n_pulse_filled+n_pulses)))
+        i = self.n_filled
+
+        # event level
+        for name, _, attr in EVENT_RQ:
+            self.event_buf[name][i] = getattr(wfm, attr)
+
+        # channel level; signal channel order is fixed for the whole file. All
+        # active channels have a column; skipped PMTs (skip_pmt_channels) are
+        # not processed, and are written as NaN (False for flags)
+        sig_ch = [ch for ch in wfm.ch_name_to_id_dict if ch not in wfm.cfg.non_signal_channels]
+        self.ch_buf['ch_id'][i] = [wfm.ch_name_to_id_dict[ch] for ch in sig_ch]
+        # ROI arrays: columns of the signal channels, kept while roi_ch is the same
+        if self._roi_cols is None or (self._roi_cols[0] is not wfm.roi_ch and self._roi_cols[0]!=wfm.roi_ch):
+            col = dict((ch, k) for k, ch in enumerate(wfm.roi_ch))
+            roi_col = np.array([col.get(ch, -1) for ch in sig_ch], dtype=np.int64)
+            self._roi_cols = (wfm.roi_ch, roi_col, roi_col>=0)
+        _, roi_col, has_col = self._roi_cols
+        for name, dtype, attr, roi in self.ch_rq:
+            if roi is None:
+                val = getattr(wfm, attr)
+                missing = False if dtype is bool else np.nan
+                self.ch_buf[name][i] = [val.get(ch, missing) for ch in sig_ch]
+            elif has_col.all():
+                self.ch_buf[name][i] = getattr(wfm, attr)[roi, roi_col]
+            else:
+                self.ch_buf[name][i] = np.nan
+                self.ch_buf[name][i][has_col] = getattr(wfm, attr)[roi, roi_col[has_col]]
 
         # auxiliary channel
-        n_aux_ch = len(wfm.cfg.non_signal_channels)
-        aux_ch_id = zeros(n_aux_ch)
-        aux_ch_area_mV = zeros(n_aux_ch)
-        for i in range(n_aux_ch):
-            ch = wfm.cfg.non_signal_channels[i]
-            aux_ch_id[i] = wfm.ch_name_to_id_dict[ch]
-            aux_ch_area_mV[i] = wfm.aux_ch_area_mV[ch]
-        self.aux_ch_id.append(aux_ch_id)
-        self.aux_ch_area_mV.append(aux_ch_area_mV)
+        aux_ch = wfm.cfg.non_signal_channels
+        self.ch_buf['aux_ch_id'][i] = [wfm.ch_name_to_id_dict[ch] for ch in aux_ch]
+        self.ch_buf['aux_ch_area_mV'][i] = [wfm.aux_ch_area_mV[ch] for ch in aux_ch]
 
         # pulse level
-        self.n_pulses.append(pf.n_pulses)
-        self.pulse_id.append(pf.id)
-        self.pulse_start.append(pf.start)
-        self.pulse_end.append(pf.end)
-        self.pulse_area_sum_pe.append(pf.area_sum_pe)
-        self.pulse_area_bot_pe.append(pf.area_bot_pe)
-        self.pulse_area_side_pe.append(pf.area_side_pe)
-        
-        self.pulse_area_row1_pe.append(pf.area_row1_pe)
-        self.pulse_area_row2_pe.append(pf.area_row2_pe)
-        self.pulse_area_row3_pe.append(pf.area_row3_pe)
-        self.pulse_area_row4_pe.append(pf.area_row4_pe)
-        self.pulse_area_row5_pe.append(pf.area_row5_pe)
-        self.pulse_area_row6_pe.append(pf.area_row6_pe)
-        self.pulse_area_row7_pe.append(pf.area_row7_pe)
-        
-        self.pulse_area_col1_pe.append(pf.area_col1_pe)
-        self.pulse_area_col2_pe.append(pf.area_col2_pe)
-        self.pulse_area_col3_pe.append(pf.area_col3_pe)
-        self.pulse_area_col4_pe.append(pf.area_col4_pe)
-        self.pulse_area_col5_pe.append(pf.area_col5_pe)
-        self.pulse_area_col6_pe.append(pf.area_col6_pe)
-        self.pulse_area_col7_pe.append(pf.area_col7_pe)
-        self.pulse_area_col8_pe.append(pf.area_col8_pe)
-        
-        self.pulse_area_user_pe.append(pf.area_user_pe)
-        self.pulse_aft10_sum_ns.append(pf.aft10_sum_ns)
-        self.pulse_aft10_bot_ns.append(pf.aft10_bot_ns)
-        self.pulse_aft10_side_ns.append(pf.aft10_side_ns)
-        
-        self.pulse_aft10_row1_ns.append(pf.aft10_row1_ns)
-        self.pulse_aft10_row2_ns.append(pf.aft10_row2_ns)
-        self.pulse_aft10_row3_ns.append(pf.aft10_row3_ns)
-        self.pulse_aft10_row4_ns.append(pf.aft10_row4_ns)
-        self.pulse_aft10_row5_ns.append(pf.aft10_row5_ns)
-        self.pulse_aft10_row6_ns.append(pf.aft10_row6_ns)
-        self.pulse_aft10_row7_ns.append(pf.aft10_row7_ns)
-        
-        self.pulse_aft90_sum_ns.append(pf.aft90_sum_ns)
-        self.pulse_aft90_bot_ns.append(pf.aft90_bot_ns)
-        self.pulse_aft90_side_ns.append(pf.aft90_side_ns)
-        
-        self.pulse_aft90_row1_ns.append(pf.aft90_row1_ns)
-        self.pulse_aft90_row2_ns.append(pf.aft90_row2_ns)
-        self.pulse_aft90_row3_ns.append(pf.aft90_row3_ns)
-        self.pulse_aft90_row4_ns.append(pf.aft90_row4_ns)
-        self.pulse_aft90_row5_ns.append(pf.aft90_row5_ns)
-        self.pulse_aft90_row6_ns.append(pf.aft90_row6_ns)
-        self.pulse_aft90_row7_ns.append(pf.aft90_row7_ns)
-        
-        self.pulse_rise_sum_ns.append(pf.rise_sum_ns)
-        self.pulse_rise_bot_ns.append(pf.rise_bot_ns)
-        self.pulse_rise_side_ns.append(pf.rise_side_ns)
-        self.pulse_fall_sum_ns.append(pf.fall_sum_ns)
-        self.pulse_fall_bot_ns.append(pf.fall_bot_ns)
-        self.pulse_fall_side_ns.append(pf.fall_side_ns)
-        self.pulse_fp40_sum.append(pf.fp40_sum)
-        self.pulse_fp40_bot.append(pf.fp40_bot)
-        self.pulse_fp40_side.append(pf.fp40_side)
-        self.pulse_fp30_sum.append(pf.fp30_sum)
-        self.pulse_fp30_bot.append(pf.fp30_bot)
-        self.pulse_fp30_side.append(pf.fp30_side)
-        self.pulse_fp20_sum.append(pf.fp20_sum)
-        self.pulse_fp20_bot.append(pf.fp20_bot)
-        self.pulse_fp20_side.append(pf.fp20_side)
-        self.pulse_height_sum_pe.append(pf.height_sum_pe)
-        self.pulse_height_bot_pe.append(pf.height_bot_pe)
-        self.pulse_height_side_pe.append(pf.height_side_pe)
-        self.pulse_sba.append(pf.sba)
-        self.pulse_ptime_ns.append(pf.ptime_ns)
-        self.pulse_coincidence.append(pf.coincidence)
-        self.pulse_area_max_frac.append(pf.area_max_frac)
-        self.pulse_area_max_ch_id.append(pf.area_max_ch_id)
-        self.pulse_area_bot_max_frac.append(pf.area_bot_max_frac)
-        self.pulse_area_bot_max_ch_id.append(pf.area_bot_max_ch_id)
-        self.pulse_saturated.append(pf.pulse_saturated)
+        self.n_pulses[i] = n_pulses
+        j = self.n_pulse_filled
+        for name, _, attr in PULSE_RQ:
+            val = getattr(pf, attr)
+            buf = self.pulse_buf[name]
+            if val is None or len(val)==0:
+                buf[j:j+n_pulses] = 0
+            else:
+                buf[j:j+n_pulses] = val
+        self.n_pulse_filled += n_pulses
+        self.n_filled += 1
 
         # pulse x channel level
         # self.pulse_area_pe.append(pf.area_pe.tolist()) # actually adc*ns
@@ -468,15 +388,93 @@ class RQWriter:
 
     def close(self):
         """
-        remember to close file after done
+        remember to close file after done. In async mode, wait for the
+        baskets still queued to be written first.
+        """
+        try:
+            self.flush()
+        finally:
+            if self.write_thread is not None:
+                self.jobs.put(None) # stop the writer thread
+                self.write_thread.join()
+                self.write_thread = None
+                print('Info: async RQ writer: %d baskets, %.2f s writing in background, main thread waited %.2f s'
+                    % (self.n_written, self.write_s, self.wait_s))
+            print("Info: closing file", self.of_path)
+            self.file.close()
+
+    def flush(self):
+        """
+        Async mode: block until every queued basket is written, and raise the
+        error of the writer thread, if any. Nothing to do otherwise.
+        """
+        if self.write_thread is None:
+            return None
+        t0 = time.time()
+        self.jobs.join()
+        self.wait_s += time.time()-t0
+        if self.write_error is not None:
+            print("ERROR: RQ writer thread failed writing %s: %r" % (self.of_path, self.write_error))
+            error, self.write_error = self.write_error, None
+            raise error
+        return None
+
+    def _write_loop(self):
+        """
+        Writer thread: extend the event tree with the baskets of the queue,
+        until None. After an error, the remaining baskets are dropped.
+        """
+        while True:
+            data_event = self.jobs.get()
+            try:
+                if data_event is None:
+                    return
+                if self.write_error is None:
+                    t0 = time.time()
+                    self.file['event'].extend(data_event)
+                    self.write_s += time.time()-t0
+                    self.n_written += 1
+                    self.n_events_written += len(data_event['event_id'])
+            except Exception as e:
+                self.write_error = e
+            finally:
+                self.jobs.task_done()
+
+    def _extend(self, data_event):
         """
-        print("Info: closing file", self.of_path)
-        self.file.close()
+        Append one basket to the event tree, now, or through the writer
+        thread in async mode.
+        """
+        if self.write_thread is None:
+            self.file['event'].extend(data_event)
+            self.n_written += 1
+            self.n_events_written += len(data_event['event_id'])
+            return None
+        self.flush()
+        self.jobs.put(data_event)
+        return None
+
+    def _swap_buffers(self):
+        """
+        Double buffering of the async mode: the buffers just handed to the
+        writer thread become the spare set, and the next batch is filled into
+        the other one. flush() in _extend guarantees the writer is done with
+        the spare set before it comes back.
+        """
+        current = (self.event_buf, self.ch_buf, self.n_pulses, self.pulse_buf,
+                   self.capacity, self.pulse_capacity)
+        if self.spare_buffers is None:
+            self.spare_buffers = ({}, {}, None, {}, 0, 0) # allocated by the next reset()
+        (self.event_buf, self.ch_buf, self.n_pulses, self.pulse_buf,
+         self.capacity, self.pulse_capacity) = self.spare_buffers
+        self.spare_buffers = current
+        return None
 
     def dump_run_rq(self, rq: dict):
         """
         Write one per run/file. No need to loop.
         """
+        self.flush()
         rq['n_pmt_ch']=[self.n_pmt_ch]
         rq['n_aux_ch']=[self.n_aux_ch]
         self.file['run_info'] = rq
@@ -487,6 +485,7 @@ class RQWriter:
         """
         if df is None:
             return None
+        self.flush()
 
         df = df.astype({
             "ch_id": uint16,
@@ -511,117 +510,70 @@ class RQWriter:
         }
         self.file['pmt_info']=pmt_info
 
+    def append_event_rq(self, path, entry_stop=None):
+        """
+        Copy the event tree of another RQ file, ex. a partial output of the
+        run_drop.py --workers mode, to the end of this file's event tree.
+
+        Args:
+            path (str): path to the RQ file to copy from
+            entry_stop (int): copy only the first entry_stop events (default: all)
+        """
+        with uproot.open(path) as f:
+            self._append_tree(f['event'], entry_stop)
+        return None
+
+    def _append_tree(self, tree, entry_stop):
+        # uproot cannot read back the zero-width aux_ch_* branches written
+        # with n_aux_ch=0 (empty baskets), so they are rebuilt instead
+        aux_rq = {'aux_ch_id': uint16, 'aux_ch_area_mV': float32}
+        skip = aux_rq if self.n_aux_ch==0 else {}
+        names = [k for k in tree.keys() if k not in skip]
+        for arr in tree.iterate(names, step_size=self.basket_size, entry_stop=entry_stop):
+            # pulse variables are saved as npulse + pulse_* branches. zip back.
+            data_pulse = {}
+            data_event = {}
+            for k in arr.fields:
+                if k.startswith('pulse_'):
+                    data_pulse[k[len('pulse_'):]] = arr[k]
+                elif k != 'npulse':
+                    data_event[k] = arr[k]
+            for k, dtype in skip.items():
+                data_event[k] = zeros((len(arr), 0), dtype=dtype)
+            data_event['pulse'] = ak.zip(data_pulse)
+            self._extend(data_event)
+        return None
+
     def dump_event_rq(self):
         """
-        Write one basket at a time
+        Write one basket at a time. The filled part of the column buffers is
+        handed to uproot as numpy arrays; pulse RQs are rebuilt as awkward
+        lists from their counts and flat content, without python lists.
+
+        In async mode the basket is compressed and written by the writer
+        thread while the next batch is reconstructed into the other buffer
+        set. Errors of the writer thread are raised here, at the next dump,
+        or at close().
         """
-        if not self.n_pulses:
+        n = self.n_filled
+        if n==0:
             print("WARNING: Empty list. Nothing to dump")
             return None
 
-        data_event = {
-            "event_id": self.event_id,
-            "event_ttt": self.event_ttt,
-            'event_sanity': self.event_sanity,
-            'event_saturated': self.event_saturated,
-
-            'ch_id': self.ch_id,
-            'ch_saturated': self.ch_saturated,
-            'ch_roi0_height_pe': self.ch_roi0_height_pe,
-            'ch_roi1_height_pe': self.ch_roi1_height_pe,
-            'ch_roi2_height_pe': self.ch_roi2_height_pe,
-            'ch_roi0_area_pe': self.ch_roi0_area_pe,
-            'ch_roi1_area_pe': self.ch_roi1_area_pe,
-            'ch_roi2_area_pe': self.ch_roi2_area_pe,
-            'ch_roi0_low_pe': self.ch_roi0_low_pe,
-            'ch_roi1_low_pe': self.ch_roi1_low_pe,
-            'ch_roi2_low_pe': self.ch_roi2_low_pe,
-            'ch_roi0_std_pe': self.ch_roi0_std_pe,
-            'ch_roi1_std_pe': self.ch_roi1_std_pe,
-            'ch_roi2_std_pe': self.ch_roi2_std_pe,
-            'ch_roi0_std_mV': self.ch_roi0_std_mV,
-            'aux_ch_id': self.aux_ch_id,
-            'aux_ch_area_mV': self.aux_ch_area_mV
-        }
-
-        data_pulse = {
-            'id': self.pulse_id,
-            'start': self.pulse_start,
-            'end': self.pulse_end,
-            'area_sum_pe': self.pulse_area_sum_pe,
-            'area_bot_pe': self.pulse_area_bot_pe,
-            'area_side_pe': self.pulse_area_side_pe,
-            
-            'area_row1_pe': self.pulse_area_row1_pe,
-            'area_row2_pe': self.pulse_area_row2_pe,
-            'area_row3_pe': self.pulse_area_row3_pe,
-            'area_row4_pe': self.pulse_area_row4_pe,
-            'area_row5_pe': self.pulse_area_row5_pe,
-            'area_row6_pe': self.pulse_area_row6_pe,
-            'area_row7_pe': self.pulse_area_row7_pe,
-            
-            'area_col1_pe': self.pulse_area_col1_pe,
-            'area_col2_pe': self.pulse_area_col2_pe,
-            'area_col3_pe': self.pulse_area_col3_pe,
-            'area_col4_pe': self.pulse_area_col4_pe,
-            'area_col5_pe': self.pulse_area_col5_pe,
-            'area_col6_pe': self.pulse_area_col6_pe,
-            'area_col7_pe': self.pulse_area_col7_pe,
-            'area_col8_pe': self.pulse_area_col8_pe,
-            
-            'area_user_pe': self.pulse_area_user_pe,
-            'aft10_sum_ns': self.pulse_aft10_sum_ns,
-            'aft10_bot_ns': self.pulse_aft10_bot_ns,
-            'aft10_side_ns': self.pulse_aft10_side_ns,
-            
-            'aft10_row1_ns': self.pulse_aft10_row1_ns,
-            'aft10_row2_ns': self.pulse_aft10_row2_ns,
-            'aft10_row3_ns': self.pulse_aft10_row3_ns,
-            'aft10_row4_ns': self.pulse_aft10_row4_ns,
-            'aft10_row5_ns': self.pulse_aft10_row5_ns,
-            'aft10_row6_ns': self.pulse_aft10_row6_ns,
-            'aft10_row7_ns': self.pulse_aft10_row7_ns,
-            
-            'aft90_sum_ns': self.pulse_aft90_sum_ns,
-            'aft90_bot_ns': self.pulse_aft90_bot_ns,
-            'aft90_side_ns': self.pulse_aft90_side_ns,
-            
-            'aft90_row1_ns': self.pulse_aft90_row1_ns,
-            'aft90_row2_ns': self.pulse_aft90_row2_ns,
-            'aft90_row3_ns': self.pulse_aft90_row3_ns,
-            'aft90_row4_ns': self.pulse_aft90_row4_ns,
-            'aft90_row5_ns': self.pulse_aft90_row5_ns,
-            'aft90_row6_ns': self.pulse_aft90_row6_ns,
-            'aft90_row7_ns': self.pulse_aft90_row7_ns,
-            
-            'rise_sum_ns': self.pulse_rise_sum_ns,
-            'rise_bot_ns': self.pulse_rise_bot_ns,
-            'rise_side_ns': self.pulse_rise_side_ns,
-            'fall_sum_ns': self.pulse_fall_sum_ns,
-            'fall_bot_ns': self.pulse_fall_bot_ns,
-            'fall_side_ns': self.pulse_fall_side_ns,
-            'fp40_sum': self.pulse_fp40_sum,
-            'fp40_bot': self.pulse_fp40_bot,
-            'fp40_side': self.pulse_fp40_side,
-            'fp30_sum': self.pulse_fp30_sum,
-            'fp30_bot': self.pulse_fp30_bot,
-            'fp30_side': self.pulse_fp30_side,
-            'fp20_sum': self.pulse_fp20_sum,
-            'fp20_bot': self.pulse_fp20_bot,
-            'fp20_side': self.pulse_fp20_side,
-            'height_sum_pe': self.pulse_height_sum_pe,
-            'height_bot_pe': self.pulse_height_bot_pe,
-            'height_side_pe': self.pulse_height_side_pe,
-            'sba': self.pulse_sba,
-            'ptime_ns': self.pulse_ptime_ns,
-            'coincidence': self.pulse_coincidence,
-            'area_max_frac': self.pulse_area_max_frac,
-            'area_max_ch_id': self.pulse_area_max_ch_id,
-            'area_bot_max_frac': self.pulse_area_bot_max_frac,
-            'area_bot_max_ch_id': self.pulse_area_bot_max_ch_id,
-            'saturated': self.pulse_saturated,
-        }
+        data_event = {}
+        for name, _, _ in EVENT_RQ:
+            data_event[name] = self.event_buf[name][:n]
+        for name, buf in self.ch_buf.items():
+            data_event[name] = buf[:n]
+
+        counts = self.n_pulses[:n]
+        m = self.n_pulse_filled
+        data_pulse = {}
+        for name, _, _ in PULSE_RQ:
+            data_pulse[name] = ak.unflatten(self.pulse_buf[name][:m], counts)
         data_event['pulse']=ak.zip(data_pulse)
 
-        self.file['event'].extend(data_event)
+        self._extend(data_event)
+        if self.write_thread is not None:
+            self._swap_buffers()
         return None
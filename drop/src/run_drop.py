@@ -15,14 +15,25 @@ import os
 import re
 import glob
 from datetime import datetime
+from multiprocessing import get_context
+import threading
+import queue
+import time
 
 from yaml_reader import YamlReader
 from waveform import Waveform
-from pulse_finder import PulseFinder
+from waveform_batch import WaveformBatch
+from pulse_finder import PulseFinder, find_pulses_batch
 from rq_writer import RQWriter
+from checkpoint import Checkpoint, CHECKPOINT_SUFFIX
+from spe_calibration import get_spe_store
+from baseline_kernels import BASELINE_ALGOS
+from utilities import HIGH_PASS_METHODS
+from alignment import ChannelAlignment
 
 MAX_N_EVENT = 999999999 # Arbiarty large
 YAML_DIR = os.environ['YAML_DIR']
+DAQ_EVENT_BRANCHES = ['event_id', 'event_ttt_1', 'event_sanity']
 
 
 class RunDROP():
@@ -47,6 +58,7 @@ class RunDROP():
         self.batch = None
         self.load_run_info()
         self.load_pmt_info()
+        self.load_alignment()
         self.sanity_check()
 
     def sanity_check(self):
@@ -60,6 +72,10 @@ class RunDROP():
             sys.exit('Different list length between roi_start and roi_end.')
         if np.any(roi_end<=roi_start):
             sys.exit('roi_end must be strictly larger than roi_start')
+        if self.cfg.baseline_algo not in BASELINE_ALGOS:
+            sys.exit('ERROR: unknown baseline_algo %s. Use one of %s' % (self.cfg.baseline_algo, ', '.join(BASELINE_ALGOS)))
+        if self.cfg.high_pass_filter_method not in HIGH_PASS_METHODS:
+            sys.exit('ERROR: unknown high_pass_filter_method %s. Use one of %s' % (self.cfg.high_pass_filter_method, ', '.join(HIGH_PASS_METHODS)))
         return None
 
     def extract_datetime_from_str(self, s):
@@ -102,11 +118,47 @@ class RunDROP():
         tmp = a['active_ch_id'][0]
         if isscalar(tmp): # if only 1 active channels, tmp is a scalar and sort will fail
             tmp = [tmp]
-        self.ch_id = sorted(uint16(tmp))
-        self.ch_names = ["adc_b%d_ch%d" % (i // 100, i % 100) for i in self.ch_id]
-        self.ch_name_to_id_dict = dict(zip(self.ch_names, self.ch_id))
+        self.active_ch_id = sorted(uint16(tmp))
+        active_ch_names = ["adc_b%d_ch%d" % (i // 100, i % 100) for i in self.active_ch_id]
+        self.ch_name_to_id_dict = dict(zip(active_ch_names, self.active_ch_id))
+        # skipped PMTs are not read at all (non-signal channels are always kept);
+        # they keep their (NaN) columns in the RQ file, see RQWriter::fill
+        skip = set(self.cfg.skip_pmt_channels) - set(self.cfg.non_signal_channels)
+        self.ch_names = [ch for ch in active_ch_names if ch not in skip]
+        self.ch_id = [self.ch_name_to_id_dict[ch] for ch in self.ch_names]
         return None
 
+    def get_daq_branches(self):
+        """
+        The daq branches DROP needs: channels in self.ch_names, plus event
+        info. Other branches are never read.
+        """
+        return self.ch_names + DAQ_EVENT_BRANCHES
+
+    def iterate_batches(self, entry_start=None, entry_stop=None, step_size=None):
+        """
+        Iterate over the daq tree, batch_size events at a time, reading only
+        get_daq_branches() as numpy arrays (one (n_event, n_samples) array per
+        channel).
+
+        Args:
+            entry_start, entry_stop (int): entry range, default whole tree
+            step_size (int): default cfg.batch_size
+
+        Yield:
+            dict of branch name -> np.ndarray
+        """
+        if step_size is None:
+            step_size = self.cfg.batch_size
+        with uproot.open(self.if_path) as f:
+            tree = f['daq']
+            missing = [b for b in self.get_daq_branches() if b not in tree]
+            if missing:
+                sys.exit('ERROR: branches not found in daq tree: %s' % missing)
+            for batch in tree.iterate(self.get_daq_branches(), step_size=step_size,
+                    entry_start=entry_start, entry_stop=entry_stop, library='np'):
+                yield batch
+
     def _set_spe_result(self, fpath):
         try:
             df = pd.read_csv(fpath)
@@ -125,48 +177,38 @@ class RunDROP():
         PMT calibration results are saved in a csv file
         The path to the csv file is specified in yaml config file
         When interpolate_spe is True, it looks for the two most recent led and
-        interpolate.
+        interpolate, using the SPE calibration store of the csv directory
+        (see spe_calibration.py).
         """
         self.spe_mean = {}
         fpath = self.cfg.spe_fit_results_file
         if self.cfg.interpolate_spe:
             dt = self.extract_datetime_from_str(self.if_path)
-            fdir = os.path.dirname(fpath)
-            led_paths=glob.glob("%s/*.csv" % fdir)
-            p0, p1 = None, None
-            t0, t1 = 999999, 999999 # arbitary large
-            for p in led_paths:
-                delta = dt-self.extract_datetime_from_str(p)
-                delta_min = delta.total_seconds()/60
-                if delta_min>=0:
-                    if abs(delta_min)<t0:
-                        t0 = abs(delta_min)
-                        p0 = p
-                else:
-                    if abs(delta_min)<t1:
-                        t1 = abs(delta_min)
-                        p1 = p
+            store = get_spe_store(os.path.dirname(fpath))
+            df, p0, p1 = store.fit_results_at(dt)
+            if df is None:
+                sys.exit("ERROR: no SPE calibration before %s in %s" % (dt, store.fdir))
+            self.spe_fit_results = df # to be saved in root
+            self.spe_mean = dict(zip(df.index, df['spe_mean']))
             if p1 is None:
-                self._set_spe_result(p0)
                 print('Info: using calibration results from', p0)
             else:
-                self._set_spe_result(p0)
-                df0 = pd.read_csv(p0)
-                df1 = pd.read_csv(p1)
-                df0.set_index('ch_name', inplace=True)
-                df1.set_index('ch_name', inplace=True)
-                ch_names = df0.index
-                for ch in ch_names:
-                    x0 = df0['spe_mean'][ch]
-                    x1 = df1['spe_mean'][ch]
-                    self.spe_mean[ch] = x0 + (x1-x0)/(t0+t1) * t0
-                    # self.spe_fit_results['spe_mean'][ch] = self.spe_mean[ch]
-                    self.spe_fit_results.loc[ch, 'spe_mean'] = self.spe_mean[ch]
                 print('Info: Intepolate from calibration results', p0, 'and', p1)
         else:
             self._set_spe_result(fpath)
             print('Info: using calibration results from', fpath)
 
+    def load_alignment(self):
+        """
+        Channel time alignment table (see alignment.py). Alignment files may
+        name PMTs as in the pmt column of the SPE calibration.
+        """
+        pmt_to_ch = {}
+        df = self.spe_fit_results
+        if 'pmt' in df:
+            pmt_to_ch = dict((pmt, ch) for ch, pmt in zip(df.index, df['pmt']) if isinstance(pmt, str) and pmt)
+        self.alignment = ChannelAlignment(self.cfg, pmt_to_ch)
+
     def process_batch(self, batch, writer:RQWriter):
         """
         Process one batch at a time. Batch size is defined in the yaml file.
@@ -175,7 +217,11 @@ class RunDROP():
         - batch (high-level awkward array): a collection of raw events
         - writer (RQWriter). If None, nothing to fill & write, but save to memory.
         """
+        if self.cfg.vectorize_batch:
+            return self.process_batch_vectorized(batch, writer)
+
         # save ref for later ease of access
+        batch = as_numpy_batch(batch, self.get_daq_branches())
         self.batch = batch
 
         # reset writer
@@ -191,26 +237,36 @@ class RunDROP():
         wfm.ch_name_to_id_dict=self.ch_name_to_id_dict
         wfm.n_boards = self.n_boards
         wfm.spe_mean = self.spe_mean
+        wfm.alignment = self.alignment
         # create PulseFinder
         pf = PulseFinder(self.cfg, wfm)
 
         #print ('batch ', batch,' length ',len(batch))
         # loop over events in this batch
-        for i in range(len(batch)):
-            event_id = batch[i].event_id
+        for i in range(len(batch['event_id'])):
+            event_id = batch['event_id'][i]
             #print ('event_id ',event_id,' start_id ',self.start_id)
-            event_ttt = batch[i].event_ttt_1
             if event_id<self.start_id or event_id>=self.end_id:
                 continue
+            # without writer, events are kept in wfm_list; each needs its own objects
+            if writer is None and i>0 and self.wfm_list and self.wfm_list[-1] is wfm:
+                wfm = Waveform(self.cfg)
+                wfm.ch_names = self.ch_names
+                wfm.ch_id = self.ch_id
+                wfm.ch_name_to_id_dict=self.ch_name_to_id_dict
+                wfm.n_boards = self.n_boards
+                wfm.spe_mean = self.spe_mean
+                wfm.alignment = self.alignment
+                pf = PulseFinder(self.cfg, wfm)
             # waveform
             wfm.reset()
-            wfm.set_raw_data(batch[i])
+            wfm.set_raw_data(batch, i)
             wfm.find_saturation()
             wfm.subtract_flat_baseline()
             #wfm.find_ma_baseline()
             wfm.do_spe_normalization()
             wfm.define_trigger_position()
-            wfm.correct_daisy_chain_trg_delay()
+            wfm.align_channels()
             wfm.sum_channels()
             wfm.define_time_axis()
             wfm.integrate_waveform()
@@ -221,8 +277,7 @@ class RunDROP():
             pf.reset()
             pf.wfm = wfm
             pf.find_pulses()
-            #pf.calc_pulse_ch_info()
-            #pf.calc_pulse_info()
+            pf.calc_pulse_info()
             # fill rq event structure
             if writer is None:
                 self.wfm_list.append(wfm)
@@ -234,52 +289,178 @@ class RunDROP():
         self.batch_id += 1
         return None
 
+    def process_batch_vectorized(self, batch, writer:RQWriter):
+        """
+        Same as process_batch, but waveform steps run on the whole batch at
+        once via WaveformBatch. Enabled by `vectorize_batch` in the yaml file.
+        Peaks are still found per event, on a Waveform view of the batch, and
+        the pulse boundaries of the whole batch in one call.
+
+        Args:
+        - batch (high-level awkward array): a collection of raw events
+        - writer (RQWriter). If None, nothing to fill & write, but save to memory.
+        """
+        batch = as_numpy_batch(batch, self.get_daq_branches())
+        self.batch = batch
+        if writer is None:
+            self.wfm_list = []
+            self.pf_list = []
+        else:
+            writer.reset()
+
+        event_id = np.asarray(batch['event_id'])
+        mask = (event_id>=self.start_id) & (event_id<self.end_id)
+        if np.any(mask):
+            wfm_batch = WaveformBatch(self.cfg)
+            wfm_batch.ch_names = self.ch_names
+            wfm_batch.ch_id = self.ch_id
+            wfm_batch.ch_name_to_id_dict=self.ch_name_to_id_dict
+            wfm_batch.n_boards = self.n_boards
+            wfm_batch.spe_mean = self.spe_mean
+            wfm_batch.alignment = self.alignment
+            wfm_batch.set_raw_data(batch, mask)
+            wfm_batch.find_saturation()
+            wfm_batch.subtract_flat_baseline()
+            wfm_batch.do_spe_normalization()
+            wfm_batch.define_trigger_position()
+            wfm_batch.align_channels()
+            wfm_batch.sum_channels()
+            wfm_batch.define_time_axis()
+            wfm_batch.integrate_waveform()
+            wfm_batch.calc_roi_info()
+            wfm_batch.calc_aux_ch_info()
+
+            pf_list = []
+            for i in range(wfm_batch.n_events):
+                wfm = wfm_batch.get_event(i)
+                pf = PulseFinder(self.cfg, wfm)
+                pf.wfm = wfm
+                pf_list.append(pf)
+            find_pulses_batch(pf_list, wfm_batch.amp_pe_sum['sum'])
+            for pf in pf_list:
+                wfm = pf.wfm
+                pf.calc_pulse_info()
+                if writer is None:
+                    self.wfm_list.append(wfm)
+                    self.pf_list.append(pf)
+                else:
+                    writer.fill(wfm, pf)
+        if writer is not None:
+            writer.dump_event_rq()
+        self.batch_id += 1
+        return None
+
     def show_progress(self):
         """
         print progress on screen
         """
         pct = float(self.cfg.batch_size*self.batch_id/self.n_event_proc*100)
-        first_ev_id = self.batch[0].event_id
-        last_ev_id = self.batch[-1].event_id
+        first_ev_id = self.batch['event_id'][0]
+        last_ev_id = self.batch['event_id'][-1]
         print('processed event_id [%d ... %d]' % (first_ev_id, last_ev_id), end=' ')
         print("%dth batch, %.1f percent completed" % (self.batch_id, pct))
         return None
 
-def main(argv):
+class BatchPrefetcher():
     """
-    Main function
+    Read ahead: a background thread keeps up to depth batches of an iterator
+    (ex. RunDROP.iterate_batches) decompressed in a bounded queue, while the
+    main thread reconstructs. Iterate over it like the wrapped iterator.
+
+    Stats (see print_stats): number of batches, time the main thread waited
+    for a batch (stall), and queue depth seen by the main thread.
     """
-    parser = argparse.ArgumentParser(description='Data Reconstruction Offline Package')
-    parser.add_argument('--start_id', type=int, default=0, help='Optional. start process from start_id (default: 0)')
-    parser.add_argument('--end_id', type=int, default=MAX_N_EVENT, help='Optional. stop process at end_id (defalt: Arbiarty large)')
-    parser.add_argument('--output_dir', type=str, default="", help='Optional. Directory where output file goes. If not specified, same directory as the input file.' )
-    required = parser.add_argument_group('Required Arguments')
-    required.add_argument('-i', '--if_path', type=str, help='Required. full path to the raw data file', required=True)
-    required.add_argument('-c', '--yaml', type=str, help='Required. path to the yaml config file', required=True)
-    args = parser.parse_args()
+    def __init__(self, batches, depth=2):
+        """
+        Args:
+            batches: iterator of batches
+            depth (int): max number of batches read ahead
+        """
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.depth = depth
+        self.stop = threading.Event()
+        self.error = None
+        self.n_batches = 0
+        self.stall_s = 0.
+        self.max_stall_s = 0.
+        self.depth_sum = 0
+        self.t_start = time.time()
+        self.thread = threading.Thread(target=self._read, args=(batches,), name='drop-prefetch', daemon=True)
+        self.thread.start()
 
-    # RunDROP class is at the top of food-chain
-    run = RunDROP(args)
-    print("\nSummary of your config file:")
-    print(run.cfg.data)
-    print("")
+    def _read(self, batches):
+        try:
+            for batch in batches:
+                if not self._put(batch):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None) # end of iteration
 
-    # RQWriter creates output file, fill, and dump
-    n_aux_ch = len(run.cfg.non_signal_channels)
-    n_ch = len(run.ch_id)-n_aux_ch
-    writer = RQWriter(args, n_ch, n_aux_ch, basket_size=run.cfg.batch_size)
-    writer.init_basket_cap = int(run.n_event_proc/run.cfg.batch_size)+2
-    writer.create_output()
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    batch_list = uproot.iterate('%s:daq' % args.if_path, step_size=run.cfg.batch_size)
-    for batch in batch_list:
-        run.process_batch(batch, writer)
-        run.show_progress()
+    def __iter__(self):
+        try:
+            while True:
+                self.depth_sum += self.queue.qsize()
+                t0 = time.time()
+                batch = self.queue.get()
+                dt = time.time()-t0
+                if batch is None:
+                    break
+                self.stall_s += dt
+                self.max_stall_s = max(self.max_stall_s, dt)
+                self.n_batches += 1
+                yield batch
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
 
-    # write run tree once per file
-    # run rq includes from raw root data, and yaml config
-    # (uproot cannot save string; so ASCII->int->ASCII for spe_fit_results_file)
-    writer.dump_run_rq({
+    def close(self):
+        """
+        Stop the reader thread (if the main thread stops early).
+        """
+        self.stop.set()
+        self.thread.join()
+        return None
+
+    def print_stats(self):
+        tot = time.time()-self.t_start
+        print('Info: prefetch depth %d: %d batches, waited %.2f s for data (%.1f%% of %.2f s, max %.3f s), mean queue depth %.2f'
+            % (self.depth, self.n_batches, self.stall_s, 100*self.stall_s/max(tot, 1e-9), tot,
+            self.max_stall_s, self.depth_sum/max(self.n_batches, 1)))
+        return None
+
+def as_numpy_batch(batch, branches):
+    """
+    Columns of a batch as numpy arrays. Accepts what iterate_batches yields
+    (already numpy, nothing is copied) as well as awkward batches.
+
+    Args:
+        batch: dict of np.ndarray, or awkward array with fields
+        branches (list): branch names to keep
+    """
+    return dict((b, np.asarray(batch[b])) for b in branches)
+
+def get_run_rq(run):
+    """
+    Run tree content. One entry per file.
+    run rq includes from raw root data, and yaml config
+    (uproot cannot save string; so ASCII->int->ASCII for spe_fit_results_file)
+
+    Args:
+        run (RunDROP): the RunDROP object of this file
+    """
+    return {
         'start_year': [run.start_year],
         'start_month': [run.start_month],
         'start_day': [run.start_day],
@@ -289,7 +470,7 @@ def main(argv):
         'n_trg_read': [run.n_trg_read],
         'n_event_proc': [run.n_event_proc],
         'leftover_event_id': [run.leftover_event_id],
-        'ch_id': [run.ch_id],
+        'ch_id': [run.active_ch_id],
         'cfg_batch_size': [run.cfg.batch_size],
         'cfg_post_trigger': [run.cfg.post_trigger],
         'cfg_dgtz_dynamic_range_mV': [run.cfg.dgtz_dynamic_range_mV],
@@ -334,10 +515,232 @@ def main(argv):
         'cfg_scipy_pf_pars_height': [run.cfg.scipy_pf_pars.height],
         'cfg_scipy_pf_pars_prominence': [run.cfg.scipy_pf_pars.prominence],
         'cfg_spe_height_threshold': [run.cfg.spe_height_threshold],
-    })
+        'cfg_pulse_start_search_window': [run.cfg.pulse_start_search_window],
+        'cfg_pulse_end_search_window': [run.cfg.pulse_end_search_window],
+        'cfg_rq_compression_level': [run.cfg.rq_compression_level],
+    }
+
+def process_entry_range(args, part_id, entry_start, entry_stop):
+    """
+    Worker of the --workers mode. Run DROP on the daq tree entries
+    [entry_start, entry_stop) only, and write them to a partial RQ file.
+
+    Args:
+        args: return of parser.parse_args()
+        part_id (int): index of this entry range, used in the partial file name
+        entry_start (int): first entry to read
+        entry_stop (int): one past the last entry to read
+
+    Return:
+        str, path to the partial RQ file
+    """
+    # sys.exit in a pool worker is not passed to the parent and can hang the
+    # pool, so report it as an exception
+    try:
+        return _process_entry_range(args, part_id, entry_start, entry_stop)
+    except SystemExit as e:
+        raise RuntimeError('part %d, entries [%d, %d): %s' % (part_id, entry_start, entry_stop, e)) from None
+
+def _process_entry_range(args, part_id, entry_start, entry_stop):
+    run = RunDROP(args)
+    n_aux_ch = len(run.cfg.non_signal_channels)
+    n_ch = len(run.active_ch_id)-n_aux_ch
+    writer = RQWriter(args, n_ch, n_aux_ch, basket_size=run.cfg.batch_size,
+        compression=run.cfg.rq_compression, compression_level=run.cfg.rq_compression_level,
+        async_write=run.cfg.async_rq_writer, n_roi=len(run.cfg.roi_start_ns))
+    suffix = '_part%d' % part_id
+    ckpt = Checkpoint(writer.get_output_path(suffix), run)
+    ckpt.record['entry_start'] = int(entry_start)
+    if args.resume or args.incremental:
+        saved = ckpt.load()
+        if (saved is not None and saved['status']=='done' and ckpt.matches(saved)
+                and saved.get('entry_start')==entry_start and saved['next_entry']==entry_stop
+                and os.path.exists(writer.get_output_path(suffix))):
+            print('Info: part %d, entries [%d, %d), is already done' % (part_id, entry_start, entry_stop))
+            return writer.get_output_path(suffix)
+    writer.init_basket_cap = int((entry_stop-entry_start)/run.cfg.batch_size)+2
+    writer.create_output(suffix=suffix)
+    batch_list = run.iterate_batches(entry_start, entry_stop)
+    if args.prefetch>0:
+        batch_list = BatchPrefetcher(batch_list, args.prefetch)
+    for batch in batch_list:
+        run.process_batch(batch, writer)
+    print('Info: part %d done, entries [%d, %d)' % (part_id, entry_start, entry_stop))
+    writer.close()
+    ckpt.finish(entry_stop)
+    return writer.of_path
+
+def process_sharded(args, writer:RQWriter, entry_start=0):
+    """
+    Split the daq tree into args.workers contiguous entry ranges, and run each
+    range in its own process. The partial RQ files are then merged in order
+    into writer, so the output is the same as the single process one.
+    With --resume/--incremental, parts completed by a previous run (see
+    checkpoint.py) are reused.
+
+    Args:
+        args: return of parser.parse_args()
+        writer (RQWriter): the final output, already created
+        entry_start (int): first daq entry to process (default: 0)
+
+    Return:
+        (int, int): one past the last entry processed, and the last event_id
+        written (-1 if none)
+    """
+    with uproot.open(args.if_path) as f:
+        n_entries = f['daq'].num_entries
+    bounds = np.linspace(entry_start, max(n_entries, entry_start), args.workers+1).astype(int)
+    jobs = [(args, k, bounds[k], bounds[k+1]) for k in range(args.workers) if bounds[k+1]>bounds[k]]
+    if not jobs:
+        return bounds[-1], -1
+    with get_context("spawn").Pool(len(jobs)) as pool:
+        try:
+            part_paths = pool.starmap(process_entry_range, jobs)
+        except RuntimeError as e:
+            sys.exit('ERROR: worker failed, %s' % e)
+    last_event_id = -1
+    for p in part_paths:
+        writer.append_event_rq(p)
+        with uproot.open(p) as f:
+            event_id = f['event']['event_id'].array(library='np')
+        if len(event_id)>0:
+            last_event_id = int(event_id[-1])
+    # parts are kept until all of them are merged, in case the merge dies
+    writer.flush()
+    for p in part_paths:
+        os.remove(p)
+        os.remove(p + CHECKPOINT_SUFFIX)
+    return bounds[-1], last_event_id
+
+def resume_output(args, run, writer:RQWriter, ckpt:Checkpoint):
+    """
+    --resume and --incremental modes. uproot cannot extend the tree of an
+    existing file, so the RQ events recorded in the checkpoint are copied from
+    the previous output into a new one, and processing continues from the
+    next daq entry. Without checkpoint, the whole file is processed.
+
+    Args:
+        args: return of parser.parse_args()
+        run (RunDROP): run to process
+        writer (RQWriter): output, not yet created
+        ckpt (Checkpoint): checkpoint of this output
+
+    Return:
+        int, first daq entry to process, or None if there is nothing to do
+    """
+    of_path = writer.get_output_path()
+    old_path = of_path + '.resume'
+    if os.path.exists(old_path):
+        # the previous resume died while copying: the previous output is the
+        # .resume file, and of_path (if any) an incomplete copy of it
+        print('Info: restoring %s from %s' % (of_path, old_path))
+        os.replace(old_path, of_path)
+    saved = ckpt.load()
+    if saved is None or not os.path.exists(of_path):
+        print('Info: no checkpoint or output for %s, processing the whole file' % of_path)
+        writer.create_output()
+        ckpt.save()
+        return 0
+    ckpt.check(saved)
+    if saved['status']=='done':
+        with uproot.open(run.if_path) as f:
+            n_entries = f['daq'].num_entries
+        if not args.incremental:
+            print('Info: %s is complete. Use --incremental to process entries added since.' % of_path)
+            return None
+        if saved['next_entry']>=n_entries:
+            print('Info: no new entries in %s since the last run (%d entries)' % (run.if_path, n_entries))
+            return None
+    try:
+        with uproot.open(of_path) as f:
+            n_old = f['event'].num_entries
+    except Exception as e:
+        sys.exit('ERROR: cannot read %s (%s). Run without --resume/--incremental.' % (of_path, e))
+    if n_old<saved['n_events']:
+        sys.exit('ERROR: %s has %d events, but its checkpoint %d. Run without --resume/--incremental.' % (of_path, n_old, saved['n_events']))
+
+    os.replace(of_path, old_path)
+    try:
+        writer.create_output()
+        writer.append_event_rq(old_path, entry_stop=saved['n_events'])
+        writer.flush()
+    except BaseException:
+        # put the previous output back, so the next run does not find a
+        # .resume file left by this one
+        if getattr(writer, 'file', None) is not None:
+            writer.file.close()
+        os.replace(old_path, of_path)
+        raise
+    os.remove(old_path)
+    ckpt.start_from(saved)
+    run.batch_id = saved['batch_id']
+    print('Info: resuming at daq entry %d, after event_id %d; %d RQ events copied from the previous output'
+        % (saved['next_entry'], saved['last_event_id'], saved['n_events']))
+    return saved['next_entry']
+
+def main(argv):
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description='Data Reconstruction Offline Package')
+    parser.add_argument('--start_id', type=int, default=0, help='Optional. start process from start_id (default: 0)')
+    parser.add_argument('--end_id', type=int, default=MAX_N_EVENT, help='Optional. stop process at end_id (defalt: Arbiarty large)')
+    parser.add_argument('--output_dir', type=str, default="", help='Optional. Directory where output file goes. If not specified, same directory as the input file.' )
+    parser.add_argument('--workers', type=int, default=1, help='Optional. Number of processes. Each process reads a range of entries, and the partial outputs are merged at the end (default: 1)')
+    parser.add_argument('--prefetch', type=int, default=0, help='Optional. Read and decompress up to this many batches ahead in a background thread, while the current one is processed (default: 0, off)')
+    parser.add_argument('--resume', action='store_true', help='Optional. Continue an interrupted job from its checkpoint (<rq file>.ckpt.json) instead of starting over')
+    parser.add_argument('--incremental', action='store_true', help='Optional. Like --resume, and also process only the entries appended to the raw file since the last completed run')
+    required = parser.add_argument_group('Required Arguments')
+    required.add_argument('-i', '--if_path', type=str, help='Required. full path to the raw data file', required=True)
+    required.add_argument('-c', '--yaml', type=str, help='Required. path to the yaml config file', required=True)
+    args = parser.parse_args()
+
+    # RunDROP class is at the top of food-chain
+    run = RunDROP(args)
+    print("\nSummary of your config file:")
+    print(run.cfg.data)
+    print("")
+
+    # RQWriter creates output file, fill, and dump
+    n_aux_ch = len(run.cfg.non_signal_channels)
+    n_ch = len(run.active_ch_id)-n_aux_ch
+    writer = RQWriter(args, n_ch, n_aux_ch, basket_size=run.cfg.batch_size,
+        compression=run.cfg.rq_compression, compression_level=run.cfg.rq_compression_level,
+        async_write=run.cfg.async_rq_writer, n_roi=len(run.cfg.roi_start_ns))
+    writer.init_basket_cap = int(run.n_event_proc/run.cfg.batch_size)+2
+    ckpt = Checkpoint(writer.get_output_path(), run)
+    if args.resume or args.incremental:
+        entry_start = resume_output(args, run, writer, ckpt)
+        if entry_start is None:
+            return None
+    else:
+        entry_start = 0
+        writer.create_output()
+        ckpt.save()
+
+    if args.workers>1:
+        entry_stop, last_event_id = process_sharded(args, writer, entry_start)
+        # all merged events are in the file; count them on top of the resumed ones
+        ckpt.batch_done(entry_stop, writer.n_events_written-ckpt.record['n_events'], last_event_id, writer.n_events_written)
+    else:
+        entry_stop = entry_start
+        batch_list = run.iterate_batches(entry_start)
+        if args.prefetch>0:
+            batch_list = BatchPrefetcher(batch_list, args.prefetch)
+        for batch in batch_list:
+            run.process_batch(batch, writer)
+            entry_stop += len(batch['event_id'])
+            ckpt.batch_done(entry_stop, writer.n_filled, batch['event_id'][-1], writer.n_events_written)
+            run.show_progress()
+        if args.prefetch>0:
+            batch_list.print_stats()
+
+    # write run tree once per file
+    writer.dump_run_rq(get_run_rq(run))
     writer.dump_pmt_info(run.spe_fit_results)
     # remeber to close file
     writer.close()
+    ckpt.finish(entry_stop)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
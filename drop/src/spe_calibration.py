@@ -0,0 +1,292 @@
+'''
+SPE calibration store, for the interpolate_spe mode of run_drop.py.
+
+All SPE fit results (csv files with a YYmmddTHHMM datetime in their name) of
+a calibration directory are loaded once into time-sorted arrays of shape
+(n_files, n_channels), one per csv column. The arrays are cached in a compact
+binary file (npz, in $DROP_CACHE_DIR or ~/.cache/drop), which is rebuilt when a
+csv file is added, removed, or modified (mtime or size changed). Within one
+process, stores are also kept in memory (see get_spe_store).
+
+The SPE mean per channel at a time t is then a binary search for the
+calibrations before and after t, and a linear interpolation of all channels
+at once.
+'''
+
+import os
+import re
+import glob
+import hashlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.environ.get('DROP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'drop'))
+CACHE_VERSION = 1
+# csv columns, in file order. ch_name is the index of the fit results.
+NUMERIC_COLUMNS = ['ch_id', 'spe_mean', 'spe_width', 'chi2', 'dof', 'spe_mean_err', 'spe_width_err', 'HV']
+STRING_COLUMNS = ['pmt', 'fit_method']
+CSV_COLUMNS = ['ch_id', 'ch_name', 'pmt', 'spe_mean', 'spe_width', 'chi2', 'dof', 'spe_mean_err', 'spe_width_err', 'HV', 'fit_method']
+# calibrations further than this from the run are not used, in minutes
+MAX_DT_MIN = 999999
+EPOCH = datetime(1970, 1, 1)
+
+_stores = {}
+
+def datetime_from_str(s):
+    """
+    datetime in a str, following the fixed format YYmmddTHHMM. None if there
+    is none.
+    """
+    match = re.search(r'\d{6}T\d{4}', s)
+    if match is None:
+        return None
+    try:
+        return datetime.strptime(match.group(), '%y%m%dT%H%M')
+    except ValueError:
+        return None
+
+def to_minutes(dt):
+    """
+    Minutes since 1970-01-01 of a datetime, or of an array of datetime64.
+    """
+    if isinstance(dt, datetime):
+        return int((dt-EPOCH).total_seconds()//60)
+    return np.asarray(dt, dtype='datetime64[m]').astype(np.int64)
+
+def get_spe_store(fdir):
+    """
+    SPECalibrationStore of a directory, shared within the process. It is
+    reloaded if the csv files of the directory changed.
+    """
+    fdir = os.path.abspath(fdir)
+    store = _stores.get(fdir)
+    if store is None or not store.is_current():
+        store = SPECalibrationStore(fdir)
+        _stores[fdir] = store
+    return store
+
+class SPECalibrationStore():
+    """
+    All SPE fit results of a directory, sorted by time.
+
+    Attributes:
+        names (np.ndarray): csv file names, (n_files,)
+        times (np.ndarray): calibration time in minutes since 1970, (n_files,)
+        ch_names (np.ndarray): all channels seen, (n_ch,)
+        row (np.ndarray): row of each channel in each csv, -1 if absent, (n_files, n_ch)
+        num (dict): column -> float64 (n_files, n_ch), NaN if absent or not a number
+        text (dict): column -> str (n_files, n_ch)
+    """
+    def __init__(self, fdir):
+        """
+        Args:
+            fdir (str): directory of the SPE fit results csv files
+        """
+        self.fdir = os.path.abspath(fdir)
+        key = hashlib.sha1(self.fdir.encode()).hexdigest()[:16]
+        self.cache_path = os.path.join(CACHE_DIR, 'spe_%s.npz' % key)
+        self.listing = self.list_files()
+        if not self.load_cache():
+            self.load_csv()
+            self.save_cache()
+
+    def list_files(self):
+        """
+        csv files with a datetime in their name: (names, mtime_ns, sizes)
+        """
+        names, mtimes, sizes = [], [], []
+        for p in sorted(glob.glob(os.path.join(self.fdir, '*.csv'))):
+            if datetime_from_str(os.path.basename(p)) is None:
+                continue
+            st = os.stat(p)
+            names.append(os.path.basename(p))
+            mtimes.append(st.st_mtime_ns)
+            sizes.append(st.st_size)
+        return np.array(names, dtype=str), np.array(mtimes, dtype=np.int64), np.array(sizes, dtype=np.int64)
+
+    def is_current(self):
+        """
+        True if no csv file was added, removed or modified since loading.
+        """
+        return all(np.array_equal(a, b) for a, b in zip(self.listing, self.list_files()))
+
+    def load_csv(self):
+        """
+        Read every csv file, and fill the time-sorted arrays.
+        """
+        names = self.listing[0]
+        times = np.array([to_minutes(datetime_from_str(n)) for n in names], dtype=np.int64)
+        order = np.argsort(times, kind='stable')
+        self.names = names[order]
+        self.times = times[order]
+
+        dfs = [pd.read_csv(os.path.join(self.fdir, n)) for n in self.names]
+        ch_names = {}
+        for df in dfs:
+            for ch in df['ch_name']:
+                ch_names.setdefault(ch, len(ch_names))
+        self.ch_names = np.array(list(ch_names), dtype=str)
+
+        n_f, n_ch = len(dfs), len(ch_names)
+        self.row = np.full((n_f, n_ch), -1, dtype=np.int32)
+        self.num = dict((c, np.full((n_f, n_ch), np.nan)) for c in NUMERIC_COLUMNS)
+        self.text = dict((c, np.full((n_f, n_ch), '', dtype=object)) for c in STRING_COLUMNS)
+        # whether a csv has the column, and read it as integers
+        self.has_col = np.zeros((n_f, len(CSV_COLUMNS)), dtype=bool)
+        self.is_int = np.zeros((n_f, len(CSV_COLUMNS)), dtype=bool)
+        for i, df in enumerate(dfs):
+            idx = np.array([ch_names[ch] for ch in df['ch_name']], dtype=np.int64)
+            self.row[i, idx] = np.arange(len(df))
+            for k, c in enumerate(CSV_COLUMNS):
+                if c not in df:
+                    continue
+                self.has_col[i, k] = True
+                self.is_int[i, k] = pd.api.types.is_integer_dtype(df[c])
+                if c in self.num:
+                    self.num[c][i, idx] = pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=float)
+                elif c in self.text:
+                    self.text[c][i, idx] = df[c].fillna('').astype(str).to_numpy()
+        self.text = dict((c, v.astype(str)) for c, v in self.text.items())
+        print('Info: loaded %d SPE calibrations from %s' % (n_f, self.fdir))
+        return None
+
+    def load_cache(self):
+        """
+        Load the binary cache. False if there is none, or if it is outdated.
+        """
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as f:
+                if int(f['version'])!=CACHE_VERSION:
+                    return False
+                listing = (f['list_names'], f['list_mtimes'], f['list_sizes'])
+                if not all(np.array_equal(a, b) for a, b in zip(listing, self.listing)):
+                    return False
+                self.names = f['names']
+                self.times = f['times']
+                self.ch_names = f['ch_names']
+                self.row = f['row']
+                self.has_col = f['has_col']
+                self.is_int = f['is_int']
+                self.num = dict((c, f['num_'+c]) for c in NUMERIC_COLUMNS)
+                self.text = dict((c, f['text_'+c]) for c in STRING_COLUMNS)
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def save_cache(self):
+        """
+        Write the binary cache atomically. A cache directory that is not
+        writable only costs reading the csv files again next time.
+        """
+        arrays = {
+            'version': np.array(CACHE_VERSION),
+            'list_names': self.listing[0], 'list_mtimes': self.listing[1], 'list_sizes': self.listing[2],
+            'names': self.names,
+            'times': self.times, 'ch_names': self.ch_names, 'row': self.row,
+            'has_col': self.has_col, 'is_int': self.is_int,
+        }
+        for c in NUMERIC_COLUMNS:
+            arrays['num_'+c] = self.num[c]
+        for c in STRING_COLUMNS:
+            arrays['text_'+c] = self.text[c]
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print('Warning: cannot write SPE calibration cache %s (%s)' % (self.cache_path, e))
+        return None
+
+    def find(self, t):
+        """
+        Binary search for the calibrations around t.
+
+        Args:
+            t: datetime, or array of datetime64
+
+        Return:
+            (i0, i1): index of the last calibration at or before t, and of the
+            first one after t, -1 if none within MAX_DT_MIN minutes
+        """
+        tm = to_minutes(t)
+        n = len(self.times)
+        if n==0:
+            none = np.full(np.shape(tm), -1, dtype=np.int64)
+            return none, none.copy()
+        k = np.searchsorted(self.times, tm, side='right')
+        # several files at the same time: use the first one (by name)
+        i0 = np.searchsorted(self.times, self.times[np.maximum(k-1, 0)], side='left')
+        i0 = np.where(k>0, i0, -1)
+        i1 = np.where(k<n, k, -1)
+        i0 = np.where((i0>=0) & (tm-self.times[np.maximum(i0, 0)]<MAX_DT_MIN), i0, -1)
+        i1 = np.where((i1>=0) & (self.times[np.minimum(k, n-1)]-tm<MAX_DT_MIN), i1, -1)
+        return i0, i1
+
+    def spe_mean_at(self, t):
+        """
+        SPE mean of all channels at time t, linearly interpolated between the
+        calibrations before and after t. The calibration before t alone is
+        used if there is none after t, or if a channel is missing in it.
+
+        Args:
+            t: datetime, or array of datetime64 of shape (n,)
+
+        Return:
+            np.ndarray, (n_ch,) or (n, n_ch). NaN where there is no
+            calibration before t. Columns follow self.ch_names.
+        """
+        tm = to_minutes(t)
+        scalar = np.ndim(tm)==0
+        i0, i1 = self.find(t)
+        i0 = np.atleast_1d(i0)
+        i1 = np.atleast_1d(i1)
+        tm = np.atleast_1d(tm)
+        if len(self.times)==0:
+            x = np.full((len(tm), len(self.ch_names)), np.nan)
+            return x[0] if scalar else x
+        mean = self.num['spe_mean']
+        x0 = np.where((i0>=0)[:, None], mean[np.maximum(i0, 0)], np.nan)
+        x1 = mean[np.maximum(i1, 0)]
+        t0 = (tm-self.times[np.maximum(i0, 0)]).astype(float)[:, None]
+        t1 = (self.times[np.maximum(i1, 0)]-tm).astype(float)[:, None]
+        use_x1 = (i1>=0)[:, None] & ~np.isnan(x1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = np.where(use_x1, x0 + (x1-x0)/(t0+t1) * t0, x0)
+        return x[0] if scalar else x
+
+    def fit_results_at(self, t):
+        """
+        SPE fit results to use at time t: the calibration before t, with its
+        spe_mean interpolated to t (see spe_mean_at).
+
+        Args:
+            t (datetime): run start time
+
+        Return:
+            (df, p0, p1): fit results as read from the csv (index ch_name),
+            paths of the calibrations before and after t (p1 None if not
+            used). (None, None, None) if there is no calibration before t.
+        """
+        i0, i1 = self.find(t)
+        i0, i1 = int(i0), int(i1)
+        if i0<0:
+            return None, None, None
+        idx = np.flatnonzero(self.row[i0]>=0)
+        idx = idx[np.argsort(self.row[i0, idx])]
+        df = pd.DataFrame(index=pd.Index(self.ch_names[idx], name='ch_name'))
+        for k, c in enumerate(CSV_COLUMNS):
+            if c=='ch_name' or not self.has_col[i0, k]:
+                continue
+            if c in self.num:
+                col = self.num[c][i0, idx]
+                df[c] = col.astype(np.int64) if self.is_int[i0, k] else col
+            else:
+                df[c] = self.text[c][i0, idx]
+        df['spe_mean'] = self.spe_mean_at(t)[idx]
+        p0 = os.path.join(self.fdir, self.names[i0])
+        p1 = os.path.join(self.fdir, self.names[i1]) if i1>=0 else None
+        return df, p0, p1
@@ -2,8 +2,10 @@
 Utility functions that are used by DROP
 """
 import math
+from functools import lru_cache
 import numpy as np
 from scipy import signal
+from scipy import fft as sp_fft
 from matplotlib.colors import ListedColormap
 from matplotlib.cm import hsv
 from yaml_reader import SAMPLE_TO_NS
@@ -42,15 +44,82 @@ def generate_colormap(n_colors=32):
     return ListedColormap(initial_cm)
 
 
-def digitial_butter_highpass_filter(data, cutoff_Hz=3e6):
+HIGH_PASS_ORDER = 5
+HIGH_PASS_METHODS = ('sos', 'fft')
+
+@lru_cache(maxsize=None)
+def butter_highpass_sos(cutoff_Hz, fs_Hz, order=HIGH_PASS_ORDER):
     """
-    data: 1d ndarray
-    cutoff_Hz: cut off digitizer sampling freq in hz
-    Source: https://scipy-cookbook.readthedocs.io/items/ButterworthBandpass.html
+    Butterworth high pass filter as second-order sections. Designed once per
+    (cutoff, sampling rate, order), then cached.
     """
-    order=5
-    fs_Hz = 1e9/SAMPLE_TO_NS # digitizer sampling rate
     nyq = fs_Hz * 0.5
     Wn = cutoff_Hz/nyq
-    b, a = signal.butter(order, Wn, btype='high', analog=False)
-    return signal.filtfilt(b, a, data)
+    return signal.butter(order, Wn, btype='high', analog=False, output='sos')
+
+@lru_cache(maxsize=32)
+def _fft_response(n_fft, cutoff_Hz, fs_Hz, order=HIGH_PASS_ORDER):
+    """
+    Frequency response H(f) of the high pass filter at the rfft frequencies
+    of n_fft samples.
+    """
+    sos = butter_highpass_sos(cutoff_Hz, fs_Hz, order)
+    _, h = signal.sosfreqz(sos, worN=np.fft.rfftfreq(n_fft, d=1/fs_Hz), fs=fs_Hz)
+    h.flags.writeable = False
+    return h
+
+def _hold_edges(data, n_hold):
+    """
+    Extend the last axis by n_hold copies of the first and last samples.
+    """
+    return np.concatenate([np.repeat(data[..., :1], n_hold, axis=-1), data,
+        np.repeat(data[..., -1:], n_hold, axis=-1)], axis=-1)
+
+def _fft_filtfilt(data, cutoff_Hz, fs_Hz):
+    """
+    sosfiltfilt done with FFTs. Same odd extension of the records as
+    sosfiltfilt. Its initial conditions (filter in steady state with the
+    first sample of each pass) are reproduced by holding the edge values for
+    several filter time constants, so the circular convolution does not wrap
+    around: forward pass H(f), then backward pass conj(H(f)).
+    """
+    n = data.shape[-1]
+    sos = butter_highpass_sos(cutoff_Hz, fs_Hz)
+    n_taps = 2*len(sos) + 1 - min((sos[:, 2]==0).sum(), (sos[:, 5]==0).sum())
+    pad = min(n-1, 3*n_taps)
+    n_hold = int(math.ceil(8*fs_Hz/cutoff_Hz))
+    left = 2*data[..., :1] - data[..., pad:0:-1]
+    right = 2*data[..., -1:] - data[..., -2:-pad-2:-1]
+    ext = np.concatenate([left, data, right], axis=-1)
+    m = ext.shape[-1]
+    n_fft = sp_fft.next_fast_len(m + 2*n_hold, real=True)
+    h = _fft_response(n_fft, cutoff_Hz, fs_Hz)
+    y = sp_fft.irfft(sp_fft.rfft(_hold_edges(ext, n_hold), n_fft, axis=-1)*h, n_fft, axis=-1)
+    y = y[..., n_hold:n_hold+m]
+    y = sp_fft.irfft(sp_fft.rfft(_hold_edges(y, n_hold), n_fft, axis=-1)*np.conj(h), n_fft, axis=-1)
+    return y[..., n_hold+pad:n_hold+pad+n]
+
+def digitial_butter_highpass_filter(data, cutoff_Hz=3e6, method='sos'):
+    """
+    Zero-phase (forward-backward) Butterworth high pass filter along the
+    last axis, so a whole batch is filtered in one call.
+
+    Args:
+        data: ndarray (..., n_samples), ex. one waveform, (n_ch, n_samples)
+            or (n_events, n_ch, n_samples)
+        cutoff_Hz: cut off frequency in Hz
+        method (str): 'sos': scipy sosfiltfilt on second-order sections.
+            'fft': the same filter in the frequency domain (agrees with
+            'sos' to ~1e-6 adc). Its cost does not depend on the filter
+            order; with the order 5 filter 'sos' is faster.
+
+    Return:
+        float ndarray, same shape as data
+
+    Source: https://scipy-cookbook.readthedocs.io/items/ButterworthBandpass.html
+    """
+    fs_Hz = 1e9/SAMPLE_TO_NS # digitizer sampling rate
+    if method=='fft':
+        return _fft_filtfilt(np.asarray(data, dtype=float), cutoff_Hz, fs_Hz)
+    sos = butter_highpass_sos(cutoff_Hz, fs_Hz)
+    return signal.sosfiltfilt(sos, data, axis=-1)
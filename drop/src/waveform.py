@@ -17,6 +17,8 @@ sys.path.append(os.environ['LIB_DIR'])
 # import utilities_numba as util_nb
 from yaml_reader import YamlReader, SAMPLE_TO_NS, MY_QUANTILES
 from utilities import generate_colormap, digitial_butter_highpass_filter
+from baseline_kernels import flat_baseline
+from roi_kernels import roi_windows, roi_info
 
 class Waveform():
     """
@@ -35,6 +37,7 @@ class Waveform():
         self.ch_name_to_id_dict= None
         self.n_boards = None
         self.spe_mean = None
+        self.alignment = None
         self.reset()
         return None
 
@@ -58,11 +61,23 @@ class Waveform():
         self.ma_base_pe = {} # moving average mean
         self.ma_base_std_pe = {} # moving average std
 
-    def set_raw_data(self, val):
+    def set_raw_data(self, val, i=None):
         """
         Set raw data.
+
+        Args:
+            val: one event (awkward record), or if i is given, a batch of
+                numpy columns (see RunDROP::iterate_batches)
+            i (int): event index in the batch
         """
         self.raw_data = {}
+        if i is not None:
+            for ch in self.ch_names:
+                self.raw_data[ch] = val[ch][i]
+            self.event_id = val['event_id'][i]
+            self.event_ttt = val['event_ttt_1'][i]
+            self.event_sanity = val['event_sanity'][i]
+            return None
         for ch in self.ch_names:
             #print ('setting channel ', ch)
             self.raw_data[ch] = val[ch].to_numpy() # numpy is faster
@@ -122,19 +137,15 @@ class Waveform():
         Define a flat baseline. Find the median and std, and return them
 
         Args:
-            val: array of float
+            val: array of raw ADC values, or of float
+            summed_channel (bool): not used, kept for backward compatibility
 
         Return:
             float, float
         """
         if self.cfg.debug: 
             print('get_flat_baseline')
-        # qx = np.quantile(val, MY_QUANTILES)
-        if summed_channel:
-            qx = np.quantile(val, MY_QUANTILES)
-        else:
-            qx = np.quantile(val, MY_QUANTILES)
-        return qx[1], abs(qx[2]-qx[0])/2
+        return flat_baseline(val, MY_QUANTILES, self.cfg.baseline_algo)
 
     def subtract_flat_baseline(self):
         """
@@ -157,9 +168,6 @@ class Waveform():
             self.flat_base_mV[ch] = med # save a copy
             self.flat_base_std_mV[ch] = std # save a copy
             amp = -(val-med)
-            if self.cfg.apply_high_pass_filter:
-                cutoff_Hz = self.cfg.high_pass_cutoff_Hz
-                amp = digitial_butter_highpass_filter(amp, cutoff_Hz)
             if 'b4' in ch:
                 self.amp_mV[ch] = amp*adc_to_mV_b4
             else:
@@ -168,6 +176,24 @@ class Waveform():
                 print ('test2 ch ', ch, ' size ',len(self.amp_mV[ch]))
                 print ('adc values ',amp)
                 print ('mv values  ',self.amp_mV[ch])
+        if self.cfg.apply_high_pass_filter:
+            self.high_pass_filter()
+        return None
+
+    def high_pass_filter(self):
+        """
+        High pass filter amp_mV of all channels. Channels of the same length
+        are stacked and filtered in one call (the filter is linear, so this is
+        the same as filtering the adc values before the mV conversion).
+        """
+        same_len = {}
+        for ch in self.ch_names:
+            same_len.setdefault(len(self.amp_mV[ch]), []).append(ch)
+        for chs in same_len.values():
+            amp = digitial_butter_highpass_filter(np.stack([self.amp_mV[ch] for ch in chs]),
+                self.cfg.high_pass_cutoff_Hz, self.cfg.high_pass_filter_method)
+            for ch, a in zip(chs, amp):
+                self.amp_mV[ch] = a
         return None
 
     def do_spe_normalization(self):
@@ -196,316 +222,24 @@ class Waveform():
                 print ('test3 ch ', ch, ' size ',len(self.raw_data[ch]))
         return None
 
-    def correct_chn_time_delay(self):
-        if self.cfg.debug:
-            print('correct_chn_time_delay')
-        with open('%s/alpha_time_correction.json' % os.environ['YAML_DIR'], 'r') as myfile:
-            data=myfile.read()
-        obj = json.loads(data)
-        for ch, a in self.amp_pe.items():
-            a_corr = a.copy()
-            if "b1_ch1" in ch:
-                dS = obj["bt_p1"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch2" in ch:
-                dS = obj["bt_p2"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch3" in ch:
-                dS = obj["bt_p3"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch4" in ch:
-                dS = obj["bt_p4"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch5" in ch:
-                dS = obj["bt_p5"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch6" in ch:
-                dS = obj["bt_p6"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch7" in ch:
-                dS = obj["bt_p7"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch8" in ch:
-                dS = obj["bt_p8"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch9" in ch:
-                dS = obj["bt_p9"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch10" in ch:
-                dS = obj["bt_p10"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch11" in ch:
-                dS = obj["bt_p11"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch12" in ch:
-                dS = obj["bt_p12"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch13" in ch:
-                dS = obj["bt_p13"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch14" in ch:
-                dS = obj["bt_p14"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch15" in ch:
-                dS = obj["bt_p15"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch0" in ch:
-                dS = obj["bt_p16"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch1" in ch:
-                dS = obj["bt_p17"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch2" in ch:
-                dS = obj["bt_p18"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch3" in ch:
-                dS = obj["bt_p19"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch4" in ch:
-                dS = obj["bt_p20"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch5" in ch:
-                dS = obj["bt_p21"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch6" in ch:
-                dS = obj["bt_p22"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch7" in ch:
-                dS = obj["bt_p23"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch8" in ch:
-                dS = obj["bt_p24"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch9" in ch:
-                dS = obj["bt_p25"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch10" in ch:
-                dS = obj["bt_p26"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch11" in ch:
-                dS = obj["bt_p27"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch12" in ch:
-                dS = obj["bt_p28"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch13" in ch:
-                dS = obj["bt_p29"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch14" in ch:
-                dS = obj["bt_p30"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b4" in ch or "b4" in ch:
-                a_corr=a[0:1900]
-            self.amp_pe[ch] = a_corr
-
-
-    def correct_chn_time_delay(self):
-        with open('/home/guang/work/bnl1t/drop/src/alpha_time_correction.json', 'r') as myfile:
-            data=myfile.read()
-        obj = json.loads(data)
-        for ch, a in self.amp_pe.items():
-            a_corr = a.copy()
-            #print(a.shape)
-            #print(len(a))
-            if "b1_ch1" in ch:
-                #print("before: ",a_corr)
-
-                dS = obj["bt_p1"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                #print("dS and bt_p1 ",dS," ",obj["bt_p1"])
-                a_corr=a[dS:1900+dS]
-                #print("after: ",a_corr)
-                #print("shape after: ",a_corr.shape)
-            if "b1_ch2" in ch:
-                dS = obj["bt_p2"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch3" in ch:
-                dS = obj["bt_p3"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch4" in ch:
-                dS = obj["bt_p4"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch5" in ch:
-                dS = obj["bt_p5"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch6" in ch:
-                dS = obj["bt_p6"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch7" in ch:
-                dS = obj["bt_p7"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch8" in ch:
-                dS = obj["bt_p8"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch9" in ch:
-                dS = obj["bt_p9"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch10" in ch:
-                dS = obj["bt_p10"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch11" in ch:
-                dS = obj["bt_p11"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch12" in ch:
-                dS = obj["bt_p12"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch13" in ch:
-                dS = obj["bt_p13"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch14" in ch:
-                dS = obj["bt_p14"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b1_ch15" in ch:
-                dS = obj["bt_p15"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch0" in ch:
-                dS = obj["bt_p16"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch1" in ch:
-                dS = obj["bt_p17"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch2" in ch:
-                dS = obj["bt_p18"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch3" in ch:
-                dS = obj["bt_p19"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch4" in ch:
-                dS = obj["bt_p20"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch5" in ch:
-                dS = obj["bt_p21"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch6" in ch:
-                dS = obj["bt_p22"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch7" in ch:
-                dS = obj["bt_p23"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch8" in ch:
-                dS = obj["bt_p24"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch9" in ch:
-                dS = obj["bt_p25"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch10" in ch:
-                dS = obj["bt_p26"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch11" in ch:
-                dS = obj["bt_p27"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch12" in ch:
-                dS = obj["bt_p28"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch13" in ch:
-                dS = obj["bt_p29"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b2_ch14" in ch:
-                dS = obj["bt_p30"]//int(SAMPLE_TO_NS)
-                dS = int(dS)
-                a_corr=a[dS:1900+dS]
-            if "b4" in ch or "b4" in ch:
-                a_corr=a[0:1900]
-            self.amp_pe[ch] = a_corr
-
-
-    def correct_daisy_chain_trg_delay(self):
+    def align_channels(self):
         """
-        Shift a channel's waveform based on which board it is. The 48 ns delay
-        from V1730s trg_in to trg_out is calibrated with a square pulse. We do
-        not expect it changes. Hence hard coded below.
+        Time alignment of all channels: daisy chain trigger delay of each
+        board, and per-channel delays if any (see alignment.py). The start
+        sample of each channel comes from the ChannelAlignment table; the
+        aligned waveforms are views of the original ones.
 
         Remember to shift trigger position too.
-
-        TODO:
-            1. save the delay in config yaml file.
-            2. what about FAN-OUT?
-
-        Notes:
-            boardId is baked into ch_name.
         """
         if self.cfg.debug:
-            print('correct_daisy_chain_trg_delay')
-        dT_ns = 48 # externally calibrated parameter
-        dS = dT_ns//int(SAMPLE_TO_NS)
-        for ch, a in self.amp_pe.items():
-            a_corr = a.copy()
-            #if "_b4" in ch:
-            #    a_corr=a[:-88]
-            if "_b1" in ch:
-                a_corr=a[dS*3:]
-            elif "_b2" in ch:
-                a_corr=a[dS*2:-dS]
-            elif ("_b3" in ch):
-                a_corr=a[dS:-dS*2]
-            #elif ("_b4" in ch):
-            #    a_corr=a[0:-dS*3]
-            #elif ("_b5" in ch):
-            #    a_corr=a[0:-dS*3]
-            #else:
-            #    print("ERROR in correct_trg_delay: invalid boardId")
-            #    return None
-            self.amp_pe[ch] = a_corr
-        self.trg_pos -= dS*2
-        self.trg_time_ns -= dT_ns*2
+            print('align_channels')
+        ch_names = list(self.amp_pe.keys())
+        start, length = self.alignment.get_windows(ch_names, [len(self.amp_pe[ch]) for ch in ch_names])
+        for ch, s, n in zip(ch_names, start, length):
+            self.amp_pe[ch] = self.amp_pe[ch][s:s+n]
+        self.trg_pos -= self.alignment.trg_shift
+        self.trg_time_ns -= self.alignment.trg_shift*SAMPLE_TO_NS
+        return None
 
     def sum_channels(self):
         """
@@ -515,85 +249,26 @@ class Waveform():
             - "side" means the sum of all side PMTs
             - 'user' means a user-defined list.
             - all in skip are skipped.
+        All summed channels come from one product of the channel membership
+        matrix (YamlReader::get_group_matrix) with the stacked channels.
         """
         if self.cfg.debug:
             print('sum_channels')
-        tot_pe = 0
-        bt_pe = 0
-        ir_pe = 0
-        side_pe=0
-        r1_pe, r2_pe, r3_pe, r4_pe, r5_pe, r6_pe, r7_pe = 0, 0, 0, 0, 0, 0, 0
-        c1_pe, c2_pe, c3_pe, c4_pe, c5_pe, c6_pe, c7_pe, c8_pe = 0, 0, 0, 0, 0, 0, 0, 0
-        user_pe = 0
-        #print ("hodoscope channels: ", self.cfg.hodoscope_pmt_channels)
-        #print ("skipping channels : ", self.cfg.skip_pmt_channels)
-        for ch, val in self.amp_pe.items():
-            if 'adc_' in ch:
-                if ch in self.cfg.skip_pmt_channels:
-                    continue
-                if 'b4' in ch:
-                    continue
-    
-                #print (ch)
-                tot_pe += val
-                if ch in self.cfg.bottom_pmt_channels:
-                    bt_pe += val
-                if ch in self.cfg.side_pmt_channels:
-                    side_pe += val
-                if ch in self.cfg.row1_pmt_channels:
-                    r1_pe += val
-                if ch in self.cfg.row2_pmt_channels:
-                    r2_pe += val
-                if ch in self.cfg.row3_pmt_channels:
-                    r3_pe += val
-                if ch in self.cfg.row4_pmt_channels:
-                    r4_pe += val
-                if ch in self.cfg.row5_pmt_channels:
-                    r5_pe += val
-                if ch in self.cfg.row6_pmt_channels:
-                    r6_pe += val
-                if ch in self.cfg.row7_pmt_channels:
-                    r7_pe += val
-                if ch in self.cfg.col1_pmt_channels:
-                    c1_pe += val
-                if ch in self.cfg.col2_pmt_channels:
-                    c2_pe += val
-                if ch in self.cfg.col3_pmt_channels:
-                    c3_pe += val
-                if ch in self.cfg.col4_pmt_channels:
-                    c4_pe += val
-                if ch in self.cfg.col5_pmt_channels:
-                    c5_pe += val
-                if ch in self.cfg.col6_pmt_channels:
-                    c6_pe += val
-                if ch in self.cfg.col7_pmt_channels:
-                    c7_pe += val
-                if ch in self.cfg.col8_pmt_channels:
-                    c8_pe += val
-                if ch in self.cfg.user_pmt_channels:
-                    user_pe += val
-        self.amp_pe['sum'] = tot_pe
-        med, std = self.get_flat_baseline(tot_pe, summed_channel=True)
+        ch_names = list(self.amp_pe.keys())
+        names, cols, mat = self.cfg.get_group_matrix(ch_names)
+        if len(cols)>0:
+            grp_pe = mat @ np.stack([self.amp_pe[ch_names[i]] for i in cols])
+        else:
+            # no channel to sum (ex. all skipped): the sums are flat zeros, as
+            # long as the aligned waveforms of the other boards would be
+            other = [ch for ch in self.amp_mV if 'b4' not in ch]
+            _, length = self.alignment.get_windows(other, [len(self.amp_mV[ch]) for ch in other])
+            grp_pe = np.zeros((len(names), length[0] if len(other)>0 else 0))
+        for g, name in enumerate(names):
+            self.amp_pe[name] = grp_pe[g]
+        med, std = self.get_flat_baseline(self.amp_pe['sum'], summed_channel=True)
         self.flat_base_pe['sum'] = med
         self.flat_base_std_pe['sum'] = std
-        self.amp_pe['sum_bot'] = bt_pe
-        self.amp_pe['sum_side'] = side_pe
-        self.amp_pe['sum_row1'] = r1_pe
-        self.amp_pe['sum_row2'] = r2_pe
-        self.amp_pe['sum_row3'] = r3_pe
-        self.amp_pe['sum_row4'] = r4_pe
-        self.amp_pe['sum_row5'] = r5_pe
-        self.amp_pe['sum_row6'] = r6_pe
-        self.amp_pe['sum_row7'] = r7_pe
-        self.amp_pe['sum_col1'] = c1_pe
-        self.amp_pe['sum_col2'] = c2_pe
-        self.amp_pe['sum_col3'] = c3_pe
-        self.amp_pe['sum_col4'] = c4_pe
-        self.amp_pe['sum_col5'] = c5_pe
-        self.amp_pe['sum_col6'] = c6_pe
-        self.amp_pe['sum_col7'] = c7_pe
-        self.amp_pe['sum_col8'] = c8_pe
-        self.amp_pe['sum_user'] = user_pe
         return None
 
     def define_time_axis(self):
@@ -651,49 +326,34 @@ class Waveform():
         - height, in unit of PE/ns
         - low, in uint of PE/ns
         - std, in unit of PE/ns and mV
+
+        All ROIs of all channels are computed at once (see roi_kernels.py),
+        and saved as arrays of (n_roi, n_ch), channels in roi_ch order.
         """
         if self.cfg.debug:
             print('calc_roi_info')
-        self.roi_area_pe=[]
-        self.roi_height_pe=[]
-        self.roi_low_pe=[]
-        self.roi_std_pe=[]
-        self.roi_std_mV=[]
-        for i in range(len(self.cfg.roi_start_ns)):
-            start= self.trg_pos + (self.cfg.roi_start_ns[i]//int(SAMPLE_TO_NS))
-            end= self.trg_pos + (self.cfg.roi_end_ns[i]//int(SAMPLE_TO_NS))
-            start=max(0, start)
-            end = min(self.n_samp-1, end)
-            start2 = max(0, start)
-            end2 = min(self.n_samp_b4-1, end)
-            height_pe={}
-            area_pe = {}
-            low_pe = {}
-            std_pe = {}
-            std_mV = {}
-            for ch, a in self.amp_pe.items():
-                if ch[0:4]!='adc_':
-                    continue
-                #print ("roi ch. ", ch)
-                if 'b4' in ch:
-                    height_pe[ch] = np.max(a[start2:end2])
-                    low_pe[ch] = np.min(a[start2:end2])
-                    std_pe[ch] = np.std(a[start2:end2])
-                    std_mV[ch] = std_pe[ch]*50*self.spe_mean[ch]
-                    a_int =  self.amp_pe_int[ch]
-                    area_pe[ch] = a_int[end2]-a_int[start2]
-                else:
-                    height_pe[ch] = np.max(a[start:end])
-                    low_pe[ch] = np.min(a[start:end])
-                    std_pe[ch] = np.std(a[start:end])
-                    std_mV[ch] = std_pe[ch]*50*self.spe_mean[ch]
-                    a_int =  self.amp_pe_int[ch]
-                    area_pe[ch] = a_int[end]-a_int[start]
-            self.roi_height_pe.append(height_pe)
-            self.roi_area_pe.append(area_pe)
-            self.roi_low_pe.append(low_pe)
-            self.roi_std_pe.append(std_pe)
-            self.roi_std_mV.append(std_mV)
+        self.roi_ch = [ch for ch in self.amp_pe.keys() if ch[0:4]=='adc_']
+        n_roi = len(self.cfg.roi_start_ns)
+        n_ch = len(self.roi_ch)
+        self.roi_area_pe = np.zeros((n_roi, n_ch))
+        self.roi_height_pe = np.zeros((n_roi, n_ch))
+        self.roi_low_pe = np.zeros((n_roi, n_ch))
+        self.roi_std_pe = np.zeros((n_roi, n_ch))
+        is_b4 = np.array(['b4' in ch for ch in self.roi_ch], dtype=bool)
+        for b4, n_samp in ((False, self.n_samp), (True, min(self.n_samp, self.n_samp_b4))):
+            k = np.flatnonzero(is_b4==b4)
+            if len(k)==0:
+                continue
+            start, end = roi_windows(self.cfg, self.trg_pos, n_samp)
+            amp = np.stack([self.amp_pe[self.roi_ch[i]] for i in k])
+            amp_int = np.stack([self.amp_pe_int[self.roi_ch[i]] for i in k])
+            area, height, low, std = roi_info(amp, amp_int, start, end)
+            self.roi_area_pe[:, k] = area.T
+            self.roi_height_pe[:, k] = height.T
+            self.roi_low_pe[:, k] = low.T
+            self.roi_std_pe[:, k] = std.T
+        spe_mean = np.array([self.spe_mean[ch] for ch in self.roi_ch])
+        self.roi_std_mV = self.roi_std_pe*50*spe_mean
         return None
 
     def calc_aux_ch_info(self):
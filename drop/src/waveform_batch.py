@@ -0,0 +1,401 @@
+'''
+Batch of waveforms. One object per batch of events.
+
+Same reconstruction steps as the Waveform class, but every step runs as
+array operations over a (n_events, n_channels, n_samples) array per board,
+instead of looping over events and channels in python.
+
+Outline
+- stack raw data of a batch board by board
+- baseline subtraction, SPE normalization, daisy chain correction
+- sum channels, accumulated integral, ROI and auxiliary channel info
+- get_event(i) returns a Waveform view of event i for PulseFinder & RQWriter
+'''
+import sys
+import numpy as np
+from numpy import cumsum, argmax
+from yaml_reader import YamlReader, SAMPLE_TO_NS, MY_QUANTILES
+from baseline_kernels import flat_baseline
+from roi_kernels import roi_windows, roi_info
+from utilities import digitial_butter_highpass_filter
+from waveform import Waveform
+
+class WaveformBatch():
+    """
+    WaveformBatch class. One object per batch of events.
+
+    Channels are grouped by board, since boards may have different number of
+    samples (ex. V1740 on b4) and receive different daisy chain shifts. For
+    each board b, arrays are shaped (n_events, n_channels_on_b, n_samples_b).
+    """
+    def __init__(self, cfg: YamlReader):
+        """Constructor.
+
+        Args:
+            cfg (YamlReader): the config objection from YamlReader class.
+        """
+        self.cfg = cfg
+        self.ch_names = None
+        self.ch_id = None
+        self.ch_name_to_id_dict= None
+        self.n_boards = None
+        self.spe_mean = None
+        self.alignment = None
+        self.reset()
+        return None
+
+    def reset(self):
+        """
+        Variables that needs to be reset from batch to batch
+        """
+        self.n_events = 0
+        self.boards = [] # sorted boardId
+        self.board_ch = {} # boardId -> list of ch names on that board
+        self.pe_ch = {} # boardId -> list of ch names that are SPE normalized
+        self.pe_idx = {} # boardId -> index of pe_ch within board_ch
+        self.spe = {} # boardId -> spe_mean array of pe_ch
+
+        # from raw data
+        self.raw_data = {}
+        self.event_id = None
+        self.event_ttt = None
+        self.event_sanity = None
+
+        # amplitude is baseline subtracted waveform, in unit of mV or PE
+        self.amp_mV = {}
+        self.amp_pe = {}
+        self.amp_pe_int = {}
+        self.amp_pe_sum = {} # summed channels, ex. sum, sum_bot
+        self.amp_pe_sum_int = {}
+
+        # calculated baseline
+        self.flat_base_mV = {}
+        self.flat_base_std_mV = {}
+        self.flat_base_pe = {}
+        self.flat_base_std_pe = {}
+        self.flat_base_pe_sum = None
+        self.flat_base_std_pe_sum = None
+
+    def _board_of(self, ch):
+        return int(self.ch_name_to_id_dict[ch]) // 100
+
+    def set_raw_data(self, batch, mask=None):
+        """
+        Set raw data. Stack channels of the same board into one array.
+
+        Args:
+            batch: uproot batch (awkward array, or dict of numpy arrays)
+            mask: bool array. Only keep events where mask is True.
+        """
+        if self.ch_names is None:
+            sys.exit('ERROR: WaveformBatch::ch_names is not specified.')
+        if mask is None:
+            mask = slice(None)
+        self.event_id = np.asarray(batch['event_id'])[mask]
+        self.event_ttt = np.asarray(batch['event_ttt_1'])[mask]
+        self.event_sanity = np.asarray(batch['event_sanity'])[mask]
+        self.n_events = len(self.event_id)
+
+        for ch in self.ch_names:
+            b = self._board_of(ch)
+            if b not in self.board_ch:
+                self.board_ch[b] = []
+            self.board_ch[b].append(ch)
+        self.boards = sorted(self.board_ch)
+        for b in self.boards:
+            chs = self.board_ch[b]
+            self.raw_data[b] = np.stack([np.asarray(batch[ch])[mask] for ch in chs], axis=1)
+            self.pe_ch[b] = [ch for ch in chs
+                if ch not in self.cfg.non_signal_channels and ch in self.spe_mean]
+            self.pe_idx[b] = np.array([chs.index(ch) for ch in self.pe_ch[b]], dtype=int)
+            self.spe[b] = np.array([self.spe_mean[ch] for ch in self.pe_ch[b]], dtype=float)
+        return None
+
+    def find_saturation(self):
+        """
+        A channel is saturated if it cross below ch_saturated_threshold in adc.
+        An event is saturated if any of the signal channels are saturated.
+        """
+        if self.cfg.debug:
+            print('find_saturation')
+        thresh = self.cfg.ch_saturated_threshold
+        self.ch_saturated = {}
+        self.event_saturated = np.full(self.n_events, False)
+        for b in self.boards:
+            sat = self.raw_data[b].min(axis=-1)<=thresh
+            self.ch_saturated[b] = sat
+            signal = [ch not in self.cfg.non_signal_channels for ch in self.board_ch[b]]
+            self.event_saturated |= np.any(sat[:, signal], axis=1)
+        return None
+
+    def define_trigger_position(self):
+        """
+        Same as Waveform::define_trigger_position. Master board is b1; fall back
+        to b4 if b1 is not active. All events in a batch share the same value.
+        """
+        if self.cfg.debug:
+            print('define_trigger_position')
+        if self.cfg.daisy_chain:
+            for b in [1, 4]:
+                if b in self.boards:
+                    n_samp = self.raw_data[b].shape[-1]
+                    pre_trg_frac = 1.0-self.cfg.post_trigger
+                    self.trg_pos = int(n_samp*pre_trg_frac)
+                    self.trg_time_ns = self.trg_pos*(SAMPLE_TO_NS)
+                    return None
+        else:
+            print('Sorry pal. Fan-out not yet implemented.')
+
+    def get_flat_baseline(self, val):
+        """
+        Define a flat baseline along the last axis. Find the median and std.
+
+        Args:
+            val: array of raw ADC values or of float, shape (..., n_samples)
+
+        Return:
+            array, array. Shape (...)
+        """
+        return flat_baseline(val, MY_QUANTILES, self.cfg.baseline_algo)
+
+    def subtract_flat_baseline(self):
+        """
+        Subtract a flat baseline for all channels of all events at once.
+        """
+        if self.cfg.debug:
+            print('subtract_flat_baseline')
+        adc_to_mV = self.cfg.dgtz_dynamic_range_mV/(2**14-1)
+        adc_to_mV_b4 = self.cfg.dgtz_dynamic_range_mV/(2**12-1)
+        for b in self.boards:
+            val = self.raw_data[b]
+            med, std = self.get_flat_baseline(val)
+            self.flat_base_mV[b] = med
+            self.flat_base_std_mV[b] = std
+            amp = -(val-med[..., None])
+            if self.cfg.apply_high_pass_filter:
+                amp = digitial_butter_highpass_filter(amp, self.cfg.high_pass_cutoff_Hz, self.cfg.high_pass_filter_method)
+            if b==4:
+                self.amp_mV[b] = amp*adc_to_mV_b4
+            else:
+                self.amp_mV[b] = amp*adc_to_mV
+        return None
+
+    def do_spe_normalization(self):
+        """
+        SPE normalization for all signal channels that have a spe_mean.
+        """
+        if self.cfg.debug:
+            print('do_spe_normalization')
+        if self.spe_mean is None:
+            sys.exit('ERROR: spe_mean not specified in WaveformBatch. Unable to normalized.')
+        for b in self.boards:
+            idx = self.pe_idx[b]
+            spe = self.spe[b]
+            self.amp_pe[b] = self.amp_mV[b][:, idx]/50/spe[:, None]
+            self.flat_base_pe[b] = self.flat_base_mV[b][:, idx]/50/spe
+            self.flat_base_std_pe[b] = self.flat_base_std_mV[b][:, idx]/50/spe
+        return None
+
+    def align_channels(self):
+        """
+        Same as Waveform::align_channels, for all events at once. A board
+        whose channels share one start sample (daisy chain delay only) is
+        sliced, a view with no copy. With per-channel delays, its aligned
+        samples are read in one gather.
+        """
+        if self.cfg.debug:
+            print('align_channels')
+        ch_names = [ch for b in self.boards for ch in self.pe_ch[b]]
+        n_samp = [self.amp_pe[b].shape[-1] for b in self.boards for ch in self.pe_ch[b]]
+        start, length = self.alignment.get_windows(ch_names, n_samp)
+        k0 = 0
+        for b in self.boards:
+            n_ch = len(self.pe_ch[b])
+            if n_ch==0:
+                continue
+            s = start[k0:k0+n_ch]
+            n = length[k0]
+            a = self.amp_pe[b]
+            if np.all(s==s[0]):
+                self.amp_pe[b] = a[..., s[0]:s[0]+n]
+            else:
+                idx = s[:, None] + np.arange(n)
+                self.amp_pe[b] = np.take_along_axis(a, idx[None], axis=-1)
+            k0 += n_ch
+        self.trg_pos -= self.alignment.trg_shift
+        self.trg_time_ns -= self.alignment.trg_shift*SAMPLE_TO_NS
+        return None
+
+    def sum_channels(self):
+        """
+        Sum up channels. See Waveform::sum_channels. The membership matrix is
+        applied board by board: (n_groups, n_ch_b) @ (n_events, n_ch_b, n_samples).
+        """
+        if self.cfg.debug:
+            print('sum_channels')
+        ch_names = [ch for b in self.boards if b!=4 for ch in self.pe_ch[b]]
+        names, cols, mat = self.cfg.get_group_matrix(ch_names)
+        grp_pe = 0
+        k0 = 0
+        for b in self.boards:
+            if b==4:
+                continue
+            n_ch = len(self.pe_ch[b])
+            sel = (cols>=k0) & (cols<k0+n_ch)
+            if sel.any():
+                grp_pe = grp_pe + np.matmul(mat[:, sel], self.amp_pe[b][:, cols[sel]-k0])
+            k0 += n_ch
+        if np.ndim(grp_pe)==0:
+            # no channel to sum (ex. all skipped): the sums are flat zeros, as
+            # long as the aligned waveforms of the other boards would be
+            other = [ch for b in self.boards if b!=4 for ch in self.board_ch[b]]
+            n_samp = [self.raw_data[self._board_of(ch)].shape[-1] for ch in other]
+            _, length = self.alignment.get_windows(other, n_samp)
+            grp_pe = np.zeros((self.n_events, len(names), length[0] if len(other)>0 else 0))
+        for g, name in enumerate(names):
+            self.amp_pe_sum[name] = grp_pe[:, g]
+        med, std = self.get_flat_baseline(self.amp_pe_sum['sum'])
+        self.flat_base_pe_sum = med
+        self.flat_base_std_pe_sum = std
+        return None
+
+    def define_time_axis(self):
+        """
+        This is the time axis after daisy chain correction
+        """
+        if self.cfg.debug:
+            print('define_time_axis')
+        n_samp = np.shape(self.amp_pe_sum['sum'])[-1]
+        self.time_axis_ns = np.linspace(0, (n_samp-1)*SAMPLE_TO_NS, n_samp)
+        self.n_samp = n_samp
+        if 4 in self.boards:
+            n_samp_b4 = self.raw_data[4].shape[-1]
+        else:
+            n_samp_b4 = n_samp
+        self.time_axis_ns_b4 = np.linspace(0, (n_samp_b4-1)*SAMPLE_TO_NS, n_samp_b4)
+        self.n_samp_b4 = n_samp_b4
+
+    def integrate_waveform(self):
+        """
+        Compute accumulated integral along the sample axis.
+        """
+        for b in self.boards:
+            self.amp_pe_int[b] = cumsum(self.amp_pe[b], axis=-1)*(SAMPLE_TO_NS)
+        for name, val in self.amp_pe_sum.items():
+            self.amp_pe_sum_int[name] = cumsum(val, axis=-1)*(SAMPLE_TO_NS)
+
+    def calc_roi_info(self):
+        """
+        Calculate variables within each ROI for every event and channel, all
+        ROIs at once per board (see roi_kernels.py). Results are saved as
+        arrays of (n_events, n_roi, n_ch), channels in roi_ch order.
+        """
+        if self.cfg.debug:
+            print('calc_roi_info')
+        self.roi_ch = [ch for b in self.boards for ch in self.pe_ch[b]]
+        n_roi = len(self.cfg.roi_start_ns)
+        shape = (self.n_events, n_roi, len(self.roi_ch))
+        self.roi_area_pe = np.zeros(shape)
+        self.roi_height_pe = np.zeros(shape)
+        self.roi_low_pe = np.zeros(shape)
+        self.roi_std_pe = np.zeros(shape)
+        self.roi_std_mV = np.zeros(shape)
+        k0 = 0
+        for b in self.boards:
+            n_ch = len(self.pe_ch[b])
+            k = slice(k0, k0+n_ch)
+            k0 += n_ch
+            if n_ch==0:
+                continue
+            start, end = roi_windows(self.cfg, self.trg_pos, min(self.n_samp, self.n_samp_b4) if b==4 else self.n_samp)
+            area, height, low, std = roi_info(self.amp_pe[b], self.amp_pe_int[b], start, end)
+            self.roi_area_pe[..., k] = area.swapaxes(-1, -2)
+            self.roi_height_pe[..., k] = height.swapaxes(-1, -2)
+            self.roi_low_pe[..., k] = low.swapaxes(-1, -2)
+            self.roi_std_pe[..., k] = std.swapaxes(-1, -2)
+            self.roi_std_mV[..., k] = std.swapaxes(-1, -2)*50*self.spe[b]
+        return None
+
+    def calc_aux_ch_info(self):
+        """
+        Area around the peak of non-signal (auxiliary) channels. The +/-50
+        samples window is gathered for all events at once; windows clipped by
+        the waveform edges are summed one by one.
+        """
+        if self.cfg.debug:
+            print('calc_aux_ch_info')
+        self.aux_ch_area_mV={}
+        for ch in self.cfg.non_signal_channels:
+            b = self._board_of(ch)
+            a = self.amp_mV[b][:, self.board_ch[b].index(ch)]
+            n = a.shape[-1]
+            pp = argmax(a, axis=-1)
+            start = np.maximum(pp-50, 0)
+            end = np.minimum(pp+50, n-1)
+            area = np.zeros(self.n_events)
+            full = (end-start)==100
+            if np.any(full):
+                idx = start[full, None] + np.arange(100)
+                area[full] = np.sum(np.take_along_axis(a[full], idx, axis=-1), axis=-1)
+            for i in np.flatnonzero(~full):
+                area[i] = np.sum(a[i, start[i]:end[i]])
+            self.aux_ch_area_mV[ch] = area*SAMPLE_TO_NS
+        return None
+
+    def get_event(self, i):
+        """
+        Return a Waveform of the i-th event in this batch. Arrays are views into
+        the batch arrays, so PulseFinder, RQWriter and EventDisplay can consume
+        it as if it was processed event by event.
+
+        Args:
+            i (int): index of event in this batch
+
+        Return:
+            Waveform
+        """
+        wfm = Waveform(self.cfg)
+        wfm.ch_names = self.ch_names
+        wfm.ch_id = self.ch_id
+        wfm.ch_name_to_id_dict = self.ch_name_to_id_dict
+        wfm.n_boards = self.n_boards
+        wfm.spe_mean = self.spe_mean
+        wfm.event_id = self.event_id[i]
+        wfm.event_ttt = self.event_ttt[i]
+        wfm.event_sanity = self.event_sanity[i]
+        wfm.event_saturated = bool(self.event_saturated[i])
+        wfm.raw_data = {}
+        wfm.ch_saturated = {}
+        for b in self.boards:
+            for k, ch in enumerate(self.board_ch[b]):
+                wfm.raw_data[ch] = self.raw_data[b][i, k]
+                wfm.ch_saturated[ch] = bool(self.ch_saturated[b][i, k])
+                wfm.flat_base_mV[ch] = self.flat_base_mV[b][i, k]
+                wfm.flat_base_std_mV[ch] = self.flat_base_std_mV[b][i, k]
+                wfm.amp_mV[ch] = self.amp_mV[b][i, k]
+            for k, ch in enumerate(self.pe_ch[b]):
+                wfm.amp_pe[ch] = self.amp_pe[b][i, k]
+                wfm.amp_pe_int[ch] = self.amp_pe_int[b][i, k]
+                wfm.flat_base_pe[ch] = self.flat_base_pe[b][i, k]
+                wfm.flat_base_std_pe[ch] = self.flat_base_std_pe[b][i, k]
+        for name, val in self.amp_pe_sum.items():
+            wfm.amp_pe[name] = val[i]
+            wfm.amp_pe_int[name] = self.amp_pe_sum_int[name][i]
+        wfm.flat_base_pe['sum'] = self.flat_base_pe_sum[i]
+        wfm.flat_base_std_pe['sum'] = self.flat_base_std_pe_sum[i]
+
+        wfm.trg_pos = self.trg_pos
+        wfm.trg_time_ns = self.trg_time_ns
+        wfm.time_axis_ns = self.time_axis_ns
+        wfm.n_samp = self.n_samp
+        wfm.time_axis_ns_b4 = self.time_axis_ns_b4
+        wfm.n_samp_b4 = self.n_samp_b4
+
+        wfm.roi_ch = self.roi_ch
+        wfm.roi_area_pe = self.roi_area_pe[i]
+        wfm.roi_height_pe = self.roi_height_pe[i]
+        wfm.roi_low_pe = self.roi_low_pe[i]
+        wfm.roi_std_pe = self.roi_std_pe[i]
+        wfm.roi_std_mV = self.roi_std_mV[i]
+        wfm.aux_ch_area_mV = dict((ch, val[i]) for ch, val in self.aux_ch_area_mV.items())
+        return wfm
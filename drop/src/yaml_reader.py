@@ -1,5 +1,6 @@
+import sys
 import yaml
-from numpy import array
+from numpy import array, zeros
 
 """
 The following parameters do not change often. So hard coded here
@@ -7,6 +8,29 @@ The following parameters do not change often. So hard coded here
 SAMPLE_TO_NS=2
 MY_QUANTILES= array([0.15865, 0.5, 0.84135])
 
+# summed channels (Waveform.amp_pe key), and the config attribute listing
+# their members. More can be added in the yaml file, see channel_groups.
+SUMMED_CHANNELS = [
+    ('sum_bot', 'bottom_pmt_channels'),
+    ('sum_side', 'side_pmt_channels'),
+    ('sum_row1', 'row1_pmt_channels'),
+    ('sum_row2', 'row2_pmt_channels'),
+    ('sum_row3', 'row3_pmt_channels'),
+    ('sum_row4', 'row4_pmt_channels'),
+    ('sum_row5', 'row5_pmt_channels'),
+    ('sum_row6', 'row6_pmt_channels'),
+    ('sum_row7', 'row7_pmt_channels'),
+    ('sum_col1', 'col1_pmt_channels'),
+    ('sum_col2', 'col2_pmt_channels'),
+    ('sum_col3', 'col3_pmt_channels'),
+    ('sum_col4', 'col4_pmt_channels'),
+    ('sum_col5', 'col5_pmt_channels'),
+    ('sum_col6', 'col6_pmt_channels'),
+    ('sum_col7', 'col7_pmt_channels'),
+    ('sum_col8', 'col8_pmt_channels'),
+    ('sum_user', 'user_pmt_channels'),
+]
+
 class ScipyPeakFindingParam():
     """
     Collection of scipy peak finder parameters
@@ -66,6 +90,33 @@ class YamlReader():
         else:
             print("ERROR: not a list")
 
+    def get_group_matrix(self, ch_names):
+        """
+        Membership matrix of the summed channels: row g has 1 for the channels
+        of channel_groups g. Built once per list of channel names.
+
+        Args:
+            ch_names (list): channel names, in the order they are stacked
+
+        Return:
+            (names, cols, mat): names of the summed channels ('sum' first,
+            then channel_groups), index in ch_names of the channels that are
+            summed (skip_pmt_channels and board 4 excluded), and the 0/1 float
+            matrix of shape (len(names), len(cols))
+        """
+        key = tuple(ch_names)
+        if key not in self._group_matrix:
+            skip = set(self.skip_pmt_channels)
+            cols = [i for i, ch in enumerate(ch_names) if 'adc_' in ch and 'b4' not in ch and ch not in skip]
+            names = ['sum'] + list(self.channel_groups)
+            mat = zeros((len(names), len(cols)))
+            mat[0] = 1
+            for g, name in enumerate(names[1:], 1):
+                members = set(self.channel_groups[name])
+                mat[g] = [ch_names[i] in members for i in cols]
+            self._group_matrix[key] = (names, array(cols, dtype=int), mat)
+        return self._group_matrix[key]
+
     def type_casting(self):
         """
         The right variable type
@@ -94,20 +145,36 @@ class YamlReader():
         self.user_pmt_channels=self.get_ch_names( self.data['user_pmt_channels'] )
         self.skip_pmt_channels=self.get_ch_names( self.data['skip_pmt_channels'] )
         self.hodoscope_pmt_channels=self.get_ch_names( self.data['hodoscope_pmt_channels'] )
+        self.channel_groups = dict((name, getattr(self, attr)) for name, attr in SUMMED_CHANNELS)
+        for name, chs in (self.data.get('channel_groups') or {}).items():
+            if 'sum_'+name in self.channel_groups:
+                sys.exit('ERROR: channel_groups: %s is already defined.' % name)
+            self.channel_groups['sum_'+name] = self.get_ch_names(chs)
+        self._group_matrix = {}
         self.ch_saturated_threshold = int(self.data['ch_saturated_threshold'])
 
         self.spe_fit_results_file = self.data['spe_fit_results_file']
         self.interpolate_spe = bool(self.data['interpolate_spe'])
 
         self.daisy_chain = bool(self.data['daisy_chain'])
+        self.daisy_chain_boards = [int(b) for b in self.data.get('daisy_chain_boards', [1, 2, 3])]
+        self.daisy_chain_delay_ns = int(self.data.get('daisy_chain_delay_ns', 48))
+        self.channel_delay_file = str(self.data.get('channel_delay_file') or '')
         self.apply_high_pass_filter = bool(self.data['apply_high_pass_filter'])
         self.high_pass_cutoff_Hz = float(self.data['high_pass_cutoff_Hz'])
+        self.high_pass_filter_method = str(self.data.get('high_pass_filter_method', 'sos'))
         self.moving_avg_length = int(self.data['moving_avg_length'])
         self.sigma_above_baseline = float(self.data['sigma_above_baseline'])
         self.pre_pulse = int(self.data['pre_pulse'])
         self.post_pulse = int(self.data['post_pulse'])
         self.use_hodoscope = bool(self.data['use_hodoscope'])
         self.debug = bool(self.data['debug'])
+        self.vectorize_batch = bool(self.data.get('vectorize_batch', False))
+        self.baseline_algo = str(self.data.get('baseline_algo', 'quantile'))
+        # RQ output file
+        self.rq_compression = str(self.data.get('rq_compression', 'ZLIB'))
+        self.rq_compression_level = int(self.data.get('rq_compression_level', 1))
+        self.async_rq_writer = bool(self.data.get('async_rq_writer', False))
 
         self.roi_start_ns = array(self.data['roi_start_ns'], dtype=int)
         self.roi_end_ns = array(self.data['roi_end_ns'], dtype=int)
@@ -119,5 +186,8 @@ class YamlReader():
         self.scipy_pf_pars.height = int(self.data['scipy_peak_finder_parameters']['height'])
         self.scipy_pf_pars.prominence = int(self.data['scipy_peak_finder_parameters']['prominence'])
         self.spe_height_threshold = float(self.data['spe_height_threshold'])
+        # pulse boundary search window in samples, left and right of the peak
+        self.pulse_start_search_window = int(self.data.get('pulse_start_search_window', 8))
+        self.pulse_end_search_window = int(self.data.get('pulse_end_search_window', 42))
 
         return None
@@ -0,0 +1,39 @@
+"""
+The histogram baseline must give exactly the same quantiles as np.quantile.
+
+Run from the drop directory, after source setup.sh:
+    python -m pytest test
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from baseline_kernels import quantiles
+
+Q = np.array([0.15865, 0.5, 0.84135])
+
+def random_waveforms(n_rows, n_samp, n_bits, seed=0):
+    """ Integer ADC waveforms around mid-range, with pulses and saturation in some """
+    rng = np.random.default_rng(seed)
+    val = rng.normal(2**(n_bits-1), 5, (n_rows, n_samp))
+    k = rng.integers(0, n_rows, n_rows//10)
+    val[k, :n_samp//4] -= rng.exponential(2**(n_bits-2), (len(k), n_samp//4))
+    return np.clip(np.round(val), 0, 2**n_bits-1).astype(np.uint16)
+
+@pytest.mark.parametrize('n_samp, n_bits', [(1000, 14), (250, 12), (7, 14), (1, 14)])
+@pytest.mark.parametrize('dtype', ['uint16', 'float64', 'int32'])
+def test_histogram_quantiles(n_samp, n_bits, dtype):
+    val = random_waveforms(2000, n_samp, n_bits)
+    if dtype=='float64':
+        val = val.astype(np.float64)
+    elif dtype=='int32':
+        val = val.astype(np.int32)-2**(n_bits-1)
+    res = quantiles(val, Q, 'histogram')
+    ref = np.moveaxis(np.quantile(val, Q, axis=-1), 0, -1)
+    np.testing.assert_array_equal(res, ref)
+
+def test_histogram_quantiles_1d():
+    for row in random_waveforms(20, 1000, 14):
+        np.testing.assert_array_equal(quantiles(row, Q, 'histogram'), np.quantile(row, Q))
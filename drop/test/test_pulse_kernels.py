@@ -0,0 +1,91 @@
+"""
+Compiled (numba) and python pulse kernels must give the same pulse RQs.
+
+Run from the drop directory, after source setup.sh:
+    python -m pytest test
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import pulse_kernels as pk
+
+def random_event(rng):
+    """ Arguments of pulse_features for one random event """
+    n_samp = int(rng.integers(100, 400))
+    n_ch = int(rng.integers(1, 20))
+    t_ax = np.arange(n_samp)*2.
+    grp_amp = rng.exponential(0.3, (pk.N_GRP, n_samp))
+    grp_amp[rng.integers(0, pk.N_GRP)] = 0. # an empty group
+    grp_int = np.cumsum(grp_amp, axis=1)*2.
+    # some channels shorter than the others, like board 4
+    ch_len = rng.choice([n_samp, n_samp//3], n_ch)
+    ch_amp = rng.normal(0., 0.5, (n_ch, n_samp))
+    for c in range(n_ch):
+        ch_amp[c, ch_len[c]:] = 0.
+    ch_int = np.cumsum(ch_amp, axis=1)*2.
+    ch_id = rng.integers(100, 500, n_ch)
+    ch_is_bot = rng.random(n_ch)<0.5
+    ch_sat = rng.random(n_ch)<0.3
+    raw = rng.integers(0, 16384, (n_ch, n_samp)).astype(np.float64)
+    raw_len = ch_len.copy()
+    n_pulses = int(rng.integers(0, 6))
+    start = rng.integers(1, n_samp-60, n_pulses)
+    end = start + rng.integers(2, 50, n_pulses)
+    return (t_ax, grp_amp, grp_int, ch_amp, ch_int, ch_len, ch_id,
+        ch_is_bot, ch_sat, raw, raw_len, start, end, 0.125, 100, 2.)
+
+@pytest.mark.skipif(not pk.HAVE_NUMBA, reason='numba is not installed')
+@pytest.mark.parametrize('seed', range(50))
+def test_pulse_features(seed):
+    args = random_event(np.random.default_rng(seed))
+    res_nb = pk.pulse_features(*args, use_numba=True)
+    res_py = pk.pulse_features(*args, use_numba=False)
+    assert len(res_nb)==len(res_py)
+    for a, b in zip(res_nb, res_py):
+        np.testing.assert_allclose(a, b, rtol=1e-9, atol=0)
+
+def pulse_boundaries_loop(a, peaks, thresh, left_window, right_window):
+    """ The original PulseFinder.find_pulses loop, reference of pulse_boundaries """
+    start = np.zeros(len(peaks), dtype=np.int64)
+    end = np.zeros(len(peaks), dtype=np.int64)
+    for i, peak in enumerate(peaks):
+        pk_l = peak
+        pk_r = peak
+        for j in range(left_window):
+            pk_l -= 1
+            if a[pk_l]<=thresh or pk_l<=0:
+                break
+        for j in range(right_window):
+            pk_r += 1
+            if a[pk_r]<=thresh or pk_r>=(len(a)-1):
+                break
+        start[i] = pk_l
+        end[i] = pk_r
+    return start, end
+
+@pytest.mark.parametrize('seed', range(50))
+def test_pulse_boundaries(seed):
+    rng = np.random.default_rng(seed)
+    a = rng.exponential(0.3, int(rng.integers(100, 400)))
+    peaks = rng.integers(1, len(a)-1, 8)
+    thr = float(np.median(a))
+    ref = pulse_boundaries_loop(a, peaks, thr, 8, 42)
+    for use_numba in (False, True):
+        start, end = pk.pulse_boundaries(a, peaks, thr, 8, 42, use_numba=use_numba)
+        np.testing.assert_array_equal(start, ref[0])
+        np.testing.assert_array_equal(end, ref[1])
+
+@pytest.mark.parametrize('use_numba', [False, True])
+def test_pulse_boundaries_batch(use_numba):
+    rng = np.random.default_rng(1)
+    a = rng.exponential(0.3, (20, 300))
+    thr = np.median(a, axis=1)
+    peaks = [rng.integers(1, 299, int(rng.integers(0, 10))) for k in range(len(a))]
+    ev = np.repeat(np.arange(len(a)), [len(p) for p in peaks])
+    start, end = pk.pulse_boundaries(a, np.concatenate(peaks), thr, 8, 42, ev=ev, use_numba=use_numba)
+    ref = [pulse_boundaries_loop(a[k], peaks[k], thr[k], 8, 42) for k in range(len(a))]
+    np.testing.assert_array_equal(start, np.concatenate([r[0] for r in ref]))
+    np.testing.assert_array_equal(end, np.concatenate([r[1] for r in ref]))
@@ -0,0 +1,27 @@
+"""
+The ROI kernels must match the per-ROI numpy reductions.
+
+Run from the drop directory, after source setup.sh:
+    python -m pytest test
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import roi_kernels as rk
+from yaml_reader import SAMPLE_TO_NS
+
+def test_roi_info():
+    rng = np.random.default_rng(0)
+    # large mean and small spread, where a one-pass std cancels
+    amp = 1e4 + rng.normal(0., 1e-3, (3, 5, 500))
+    amp_int = np.cumsum(amp, axis=-1)*SAMPLE_TO_NS
+    start = np.array([0, 100, 300])
+    end = np.array([50, 250, 499])
+    area, height, low, std = rk.roi_info(amp, amp_int, start, end)
+    for r, (s, e) in enumerate(zip(start, end)):
+        np.testing.assert_allclose(std[..., r], np.std(amp[..., s:e], axis=-1), rtol=1e-12)
+        np.testing.assert_array_equal(height[..., r], np.max(amp[..., s:e], axis=-1))
+        np.testing.assert_array_equal(low[..., r], np.min(amp[..., s:e], axis=-1))
+        np.testing.assert_array_equal(area[..., r], amp_int[..., e]-amp_int[..., s])
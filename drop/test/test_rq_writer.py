@@ -0,0 +1,111 @@
+"""
+RQ files written by RQWriter must be copied back event by event, as in the
+run_drop.py --workers merge and --resume/--incremental.
+
+Run from the drop directory, after source setup.sh:
+    python -m pytest test
+"""
+import os
+import sys
+import argparse
+from types import SimpleNamespace
+import numpy as np
+import uproot
+import awkward as ak
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from rq_writer import RQWriter
+from checkpoint import Checkpoint
+import run_drop
+
+N_PMT_CH = 3
+
+def make_writer(tmp_path, n_aux_ch):
+    args = argparse.Namespace(output_dir=str(tmp_path), if_path=str(tmp_path/'raw.root'))
+    return RQWriter(args, N_PMT_CH, n_aux_ch, basket_size=10)
+
+def write_rq(tmp_path, suffix, event_id, n_aux_ch):
+    """ RQ file with the given event_id and a few channel values """
+    writer = make_writer(tmp_path, n_aux_ch)
+    writer.create_output(suffix=suffix)
+    for k in range(0, len(event_id), writer.basket_size):
+        ids = event_id[k:k+writer.basket_size]
+        n = len(ids)
+        writer.n_filled = n
+        writer.event_buf['event_id'][:n] = ids
+        writer.ch_buf['ch_id'][:n] = np.arange(N_PMT_CH)
+        writer.ch_buf['ch_roi0_area_pe'][:n] = ids[:, None]*0.5
+        writer.ch_buf['aux_ch_id'][:n] = 305
+        writer.ch_buf['aux_ch_area_mV'][:n] = ids[:, None]*2.
+        writer.n_pulses[:n] = ids%3
+        m = writer.n_pulse_filled = int(np.sum(ids%3))
+        writer.pulse_buf['id'][:m] = np.concatenate([np.arange(c) for c in ids%3])
+        writer.pulse_buf['area_sum_pe'][:m] = np.repeat(ids, ids%3)*1.5
+        writer.dump_event_rq()
+        writer.reset()
+    writer.close()
+    return writer.of_path
+
+def read_event_rq(path, n_aux_ch):
+    with uproot.open(path) as f:
+        tree = f['event']
+        # the zero-width aux_ch_* branches can not be read back by uproot
+        names = [k for k in tree.keys() if n_aux_ch>0 or not k.startswith('aux_ch_')]
+        return tree.arrays(names)
+
+@pytest.mark.parametrize('n_aux_ch', [0, 1])
+def test_append_event_rq(tmp_path, n_aux_ch):
+    parts = [write_rq(tmp_path, '_part%d' % k, np.arange(25*k, 25*k+25, dtype=np.uint32), n_aux_ch)
+             for k in range(3)]
+    writer = make_writer(tmp_path, n_aux_ch)
+    writer.create_output()
+    for p in parts:
+        writer.append_event_rq(p)
+    writer.close()
+    ref = read_event_rq(write_rq(tmp_path, '_serial', np.arange(75, dtype=np.uint32), n_aux_ch), n_aux_ch)
+    merged = read_event_rq(writer.of_path, n_aux_ch)
+    assert merged.fields==ref.fields
+    for k in ref.fields:
+        assert ak.to_list(merged[k])==ak.to_list(ref[k]), k
+    assert ak.sum(merged['npulse'])>0
+    with uproot.open(writer.of_path) as f:
+        assert f['event'].num_entries==75
+        assert 'aux_ch_id' in f['event'].keys() and 'aux_ch_area_mV' in f['event'].keys()
+
+def resume_setup(tmp_path, n_aux_ch):
+    """ previous output of 30 events, whose checkpoint has the first 20 done """
+    of_path = write_rq(tmp_path, '', np.arange(30, dtype=np.uint32), n_aux_ch)
+    run = SimpleNamespace(if_path=str(tmp_path/'raw.root'), cfg=SimpleNamespace(data={}),
+        start_id=0, end_id=100, spe_fit_results=None, batch_id=0)
+    writer = make_writer(tmp_path, n_aux_ch)
+    ckpt = Checkpoint(writer.get_output_path(), run)
+    ckpt.record.update(next_entry=20, n_events=20, last_event_id=19, batch_id=2)
+    ckpt.save()
+    return of_path, run, writer, ckpt
+
+@pytest.mark.parametrize('n_aux_ch', [0, 1])
+def test_resume_output(tmp_path, n_aux_ch):
+    of_path, run, writer, ckpt = resume_setup(tmp_path, n_aux_ch)
+    args = argparse.Namespace(incremental=False)
+    assert run_drop.resume_output(args, run, writer, ckpt)==20
+    writer.close()
+    assert run.batch_id==2
+    assert not os.path.exists(of_path + '.resume')
+    ref = read_event_rq(write_rq(tmp_path, '_ref', np.arange(20, dtype=np.uint32), n_aux_ch), n_aux_ch)
+    resumed = read_event_rq(of_path, n_aux_ch)
+    assert resumed.fields==ref.fields
+    for k in ref.fields:
+        assert ak.to_list(resumed[k])==ak.to_list(ref[k]), k
+
+def test_resume_output_failed_copy(tmp_path, monkeypatch):
+    of_path, run, writer, ckpt = resume_setup(tmp_path, 0)
+    def fail(path, entry_stop=None):
+        raise OSError('disk full')
+    monkeypatch.setattr(writer, 'append_event_rq', fail)
+    with pytest.raises(OSError):
+        run_drop.resume_output(argparse.Namespace(incremental=False), run, writer, ckpt)
+    # the previous output is back in place, with all its events
+    assert not os.path.exists(of_path + '.resume')
+    with uproot.open(of_path) as f:
+        assert f['event'].num_entries==30
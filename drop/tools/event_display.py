@@ -17,11 +17,13 @@ import re
 src_path = os.environ['SOURCE_DIR']
 YAML_DIR = os.environ['YAML_DIR']
 sys.path.append(src_path)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from utilities import generate_colormap
 from run_drop import RunDROP
 from pulse_finder import PulseFinder
 from yaml_reader import SAMPLE_TO_NS
+from event_index import EventIndex
 
 class Args:
     start_id = 0
@@ -63,6 +65,9 @@ class EventDisplay():
         self.run = RunDROP(self.args)
         self.grabbed_event_id = []
 
+        # event_id -> entry lookup, built once per raw file (see event_index.py)
+        self.index = EventIndex(raw_data_path)
+
         self.user_summed_channel_list=None
 
         # useful to give user hints
@@ -116,37 +121,28 @@ class EventDisplay():
         return None
 
     def get_bound_id(self):
-
-        self.wfm_list = []
-        self.pf_list = []
-        batch_list = uproot.iterate('%s:daq' % self.args.if_path, step_size=100)
-        for batch in batch_list:
-            arr = batch.event_id.to_numpy()
-            run = self.run
-
-            # record min and max event_id for hints
-            self.min_event_id = np.min([self.min_event_id, np.min(arr)])
-            self.max_event_id = np.max([self.max_event_id, np.max(arr)])
-
-        self.wfm_list = [item for sublist in self.wfm_list for item in sublist] # flatten list
-        self.pf_list = [item for sublist in self.pf_list for item in sublist]
-        self.grabbed_event_id = [wfm.event_id for wfm in self.wfm_list]
-
+        """
+        Return the min and max event_id of the raw file, from the event index.
+        """
+        self.min_event_id = self.index.min_event_id
+        self.max_event_id = self.index.max_event_id
         return self.min_event_id, self.max_event_id
 
     def grab_events(self, wanted_event_id):
         """
         Grab raw data matching event_id. Process them using RunDrop.
 
+        Only the entries holding wanted_event_id are read, using the event index.
+
         Args:
             wanted_event_id: int or list. ex. [1000, 1001, 3000, 30]. The grabbed events
-        will be sorted in that order.
+        are sorted by their order in the raw file.
 
         Return:
             int, length of events grabbed
         """
-        if isinstance(wanted_event_id, int):
-            wanted_event_id = [wanted_event_id]
+        if isinstance(wanted_event_id, (int, np.integer)):
+            wanted_event_id = [int(wanted_event_id)]
         elif isinstance(wanted_event_id, list):
             pass
         else:
@@ -155,18 +151,14 @@ class EventDisplay():
 
         self.wfm_list = []
         self.pf_list = []
-        batch_list = uproot.iterate('%s:daq' % self.args.if_path, step_size=100)
-        for batch in batch_list:
-            arr = batch.event_id.to_numpy()
-            mask = np.isin(arr, wanted_event_id)
-            run = self.run
-            run.process_batch(batch[mask], None)
-            self.wfm_list.append(run.wfm_list)
-            self.pf_list.append(run.pf_list)
-
-            # record min and max event_id for hints
-            self.min_event_id = np.min([self.min_event_id, np.min(arr)])
-            self.max_event_id = np.max([self.max_event_id, np.max(arr)])
+        self.get_bound_id()
+        entries = self.index.get_entries(wanted_event_id)
+        run = self.run
+        for entry_start, entry_stop in self.index.get_entry_ranges(entries):
+            for batch in run.iterate_batches(entry_start, entry_stop, step_size=100):
+                run.process_batch(batch, None)
+                self.wfm_list.append(run.wfm_list)
+                self.pf_list.append(run.pf_list)
 
         self.wfm_list = [item for sublist in self.wfm_list for item in sublist] # flatten list
         self.pf_list = [item for sublist in self.pf_list for item in sublist]
@@ -176,6 +168,32 @@ class EventDisplay():
             print('Hint: event_id is in this range [%d, %d]' % (self.min_event_id, self.max_event_id))
         return len(self.grabbed_event_id)
 
+    def grab_triggered_events(self, trigger_channels, trigger_threshold=100.0, max_events=None):
+        """
+        Grab events where any of trigger_channels goes below its baseline by
+        more than trigger_threshold mV. The trigger decision comes from the
+        event index, so only the triggered entries are read.
+
+        Args:
+            trigger_channels (list): board 4 channels, ex. ['adc_b4_ch9'] or ['b4_ch9']
+            trigger_threshold (float): trigger threshold in mV
+            max_events (int): grab at most this many events (default: all)
+
+        Return:
+            int, length of events grabbed
+        """
+        trigger_channels = [ch if ch.startswith('adc_') else 'adc_'+ch for ch in trigger_channels]
+        mask = self.index.get_triggered_mask(trigger_channels, trigger_threshold)
+        entries = np.flatnonzero(mask)[:max_events]
+        wanted_event_id = [int(e) for e in self.index.event_id[entries]]
+        if not wanted_event_id:
+            print('Info: no event passes the trigger.')
+            self.wfm_list = []
+            self.pf_list = []
+            self.grabbed_event_id = []
+            return 0
+        return self.grab_events(wanted_event_id)
+
     def display_waveform(self, event_id, ch, baseline_subtracted=True, no_show=False):
         """
         Plot waveform, for individual channel, all channels, summed channel,
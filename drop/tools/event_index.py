@@ -0,0 +1,241 @@
+"""
+Persistent event_id -> entry index for raw root files
+
+The index is built once per raw file, by one pass over the daq tree, and
+saved next to it as `<raw file>.evidx.npz`. Later lookups (EventDisplay,
+web app) read the sidecar and go straight to the entries they need with
+entry_start/entry_stop, instead of scanning the whole daq tree.
+
+Only event_id is read when the index is built. The trigger depth of the
+board 4 channels needs every adc_b4 waveform, so it is computed on the first
+trigger query (get_triggered_mask), and then saved in the sidecar too.
+
+The sidecar is rebuilt automatically if the raw file size or mtime changes.
+"""
+import os
+import sys
+import numpy as np
+import uproot
+
+# same ADC conversion and baseline window as the trigger selection of the web app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from analysis import ADC_TO_MV_B4, N_BASELINE_SAMPLES
+
+INDEX_SUFFIX = '.evidx.npz'
+INDEX_VERSION = 2
+
+class EventIndex():
+    def __init__(self, raw_data_path, step_size=1000, rebuild=False):
+        """Constructor:
+
+        Load the sidecar index of raw_data_path, or build and save it if it
+        does not exist or is outdated.
+
+        Args:
+            raw_data_path (str): path to the raw root file
+            step_size (int): entries per read when building the index
+            rebuild (bool): force rebuilding the index
+
+        Notes:
+            If the directory of the raw file is not writable, the index is
+            kept in memory only, and rebuilt next time.
+        """
+        self.raw_data_path = raw_data_path
+        self.index_path = raw_data_path + INDEX_SUFFIX
+        self.step_size = step_size
+
+        st = os.stat(raw_data_path)
+        self.source_size = st.st_size
+        self.source_mtime = st.st_mtime
+
+        if rebuild or not self.load():
+            self.build()
+            self.save()
+
+    def load(self):
+        """
+        Read the sidecar index. Return True if it exists and matches the raw file.
+        """
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with np.load(self.index_path, allow_pickle=False) as d:
+                if int(d['version'])!=INDEX_VERSION:
+                    return False
+                if int(d['source_size'])!=self.source_size or float(d['source_mtime'])!=self.source_mtime:
+                    return False
+                self.event_id = d['event_id']
+                self.basket_offsets = d['basket_offsets']
+                self.trigger_channels = [str(ch) for ch in d['trigger_channels']]
+                self.trigger_depth_mV = d['trigger_depth_mV'] if 'trigger_depth_mV' in d else None
+        except (OSError, KeyError, ValueError) as e:
+            print('Warning: cannot read event index %s (%s), rebuilding' % (self.index_path, e))
+            return False
+        self._sort()
+        return True
+
+    def build(self):
+        """
+        Read the event_id branch. Record event_id of every entry, the basket
+        boundaries, and the names of the board 4 (trigger) channels. The
+        trigger depth is left to build_trigger_depth.
+        """
+        print('Info: building event index for', self.raw_data_path)
+        with uproot.open(self.raw_data_path) as f:
+            tree = f['daq']
+            self.basket_offsets = np.asarray(tree['event_id'].entry_offsets, dtype=np.int64)
+            self.trigger_channels = [k for k in tree.keys() if k.startswith('adc_b4_')]
+            self.event_id = np.asarray(tree['event_id'].array(library='np'), dtype=np.int64)
+        self.trigger_depth_mV = None
+        self._sort()
+        return None
+
+    def build_trigger_depth(self):
+        """
+        One pass over the board 4 branches. Record the trigger depth of each
+        board 4 channel.
+
+        trigger depth is the largest negative excursion from the baseline
+        (median of the first 100 samples), in mV. An event fires trigger
+        channel ch at threshold thr if trigger_depth_mV[entry, ch] > thr.
+        """
+        print('Info: building trigger summary of the event index for', self.raw_data_path)
+        depth = []
+        with uproot.open(self.raw_data_path) as f:
+            tree = f['daq']
+            if self.trigger_channels:
+                for batch in tree.iterate(self.trigger_channels, step_size=self.step_size, library='np'):
+                    n = len(batch[self.trigger_channels[0]])
+                    d = np.zeros((n, len(self.trigger_channels)), dtype=np.float32)
+                    for j, ch in enumerate(self.trigger_channels):
+                        d[:, j] = get_trigger_depth_mV(batch[ch])
+                    depth.append(d)
+        if depth:
+            self.trigger_depth_mV = np.concatenate(depth)
+        else:
+            self.trigger_depth_mV = np.zeros((self.n_entries, len(self.trigger_channels)), dtype=np.float32)
+        return None
+
+    def save(self):
+        """
+        Write the sidecar index next to the raw file.
+        """
+        tmp_path = self.index_path + '.tmp.npz'
+        data = dict(
+            version=INDEX_VERSION,
+            source_size=self.source_size,
+            source_mtime=self.source_mtime,
+            event_id=self.event_id,
+            basket_offsets=self.basket_offsets,
+            trigger_channels=np.array(self.trigger_channels, dtype=str),
+        )
+        if self.trigger_depth_mV is not None:
+            data['trigger_depth_mV'] = self.trigger_depth_mV
+        try:
+            np.savez(tmp_path, **data)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print('Warning: cannot save event index to %s (%s)' % (self.index_path, e))
+        return None
+
+    def _sort(self):
+        """
+        event_id are not guaranteed to be in entry order; keep a sorted view
+        for binary search.
+        """
+        self._order = np.argsort(self.event_id, kind='stable')
+        self._sorted_event_id = self.event_id[self._order]
+        self.n_entries = len(self.event_id)
+        if self.n_entries>0:
+            self.min_event_id = int(self._sorted_event_id[0])
+            self.max_event_id = int(self._sorted_event_id[-1])
+        else:
+            self.min_event_id = 0
+            self.max_event_id = 0
+        return None
+
+    def get_entries(self, wanted_event_id):
+        """
+        Map event_id to entry number. Unknown event_id are dropped.
+
+        Args:
+            wanted_event_id: int or list of int
+
+        Return:
+            np.ndarray of int64, sorted entry numbers
+        """
+        wanted = np.unique(np.atleast_1d(np.asarray(wanted_event_id, dtype=np.int64)))
+        # duplicated event_id (rare, but possible after a DAQ restart) give all entries
+        lo = np.searchsorted(self._sorted_event_id, wanted, side='left')
+        hi = np.searchsorted(self._sorted_event_id, wanted, side='right')
+        entries = [self._order[l:h] for l, h in zip(lo, hi) if h>l]
+        if not entries:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(entries))
+
+    def get_basket_id(self, entries):
+        """
+        Which event_id basket each entry lives in.
+        """
+        return np.searchsorted(self.basket_offsets, entries, side='right')-1
+
+    def get_entry_ranges(self, entries, max_gap=0):
+        """
+        Group sorted entries into [start, stop) ranges, so that nearby entries
+        are read together.
+
+        Args:
+            entries (np.ndarray): sorted entry numbers
+            max_gap (int): merge two entries if at most max_gap entries in between
+
+        Return:
+            list of (entry_start, entry_stop)
+        """
+        if len(entries)==0:
+            return []
+        split = np.where(np.diff(entries)>max_gap+1)[0]+1
+        return [(int(g[0]), int(g[-1])+1) for g in np.split(entries, split)]
+
+    def get_triggered_mask(self, trigger_channels, threshold_mV=100.0):
+        """
+        Entry mask of events where any of trigger_channels goes below the
+        baseline by more than threshold_mV.
+
+        Args:
+            trigger_channels (list): branch names, ex. ['adc_b4_ch9']
+            threshold_mV (float): trigger threshold
+
+        Return:
+            np.ndarray of bool, one per entry
+        """
+        if self.trigger_depth_mV is None:
+            self.build_trigger_depth()
+            self.save()
+        mask = np.zeros(self.n_entries, dtype=bool)
+        for ch in trigger_channels:
+            if ch not in self.trigger_channels:
+                print('Warning: %s is not summarized in the event index' % ch)
+                continue
+            mask |= self.trigger_depth_mV[:, self.trigger_channels.index(ch)] > threshold_mV
+        return mask
+
+def get_trigger_depth_mV(wfs, n_baseline=N_BASELINE_SAMPLES):
+    """
+    Largest negative excursion from the baseline, in mV, for a batch of board 4
+    waveforms.
+
+    Args:
+        wfs: np.ndarray (n_event, n_samp), or object array of per-event arrays
+
+    Return:
+        np.ndarray of float32, one per event
+    """
+    try:
+        a = np.asarray(np.stack(wfs) if wfs.dtype==object else wfs, dtype=np.float64)
+    except ValueError:
+        # ragged waveforms; fall back to one by one
+        return np.array([get_trigger_depth_mV(np.asarray(w)[None, :], n_baseline)[0] for w in wfs], dtype=np.float32)
+    if a.shape[-1]==0:
+        return np.zeros(len(a), dtype=np.float32)
+    baseline = np.median(a[:, :n_baseline], axis=1)
+    return ((baseline-np.min(a, axis=1))*ADC_TO_MV_B4).astype(np.float32)